@@ -17,8 +17,16 @@ More dynamic behavior is required. Placing this logic into Tactic objects would
 dependency inversion, and I think Unfetter Analytic obeys a similar pattern: each tactic/technique defines its
 own evaluation/detection. Just like a character or object in a video game might implement its survival/destruction
 logic.
+
+The table can also be loaded from a json data file (see AttackFeatureModel.Load()), rather than the class attributes below.
+Either way, it is compiled once into inverted indexes, from each port and event id to its techniques and tactics, and
+per-tactic feature sets and indicator arrays, so scoring code never has to re-walk the table.
 """
 
+import json
+
+import numpy as np
+
 #TODO: Seems like an indicator of poor code factoring to bring query_builder into here to construct detection-feature queries; and only currently used for network-scan-detection query
 from elastic_query_builder import QueryBuilder
 
@@ -54,9 +62,9 @@ class AttackFeatureModel(object):
 	App_Deployment_Software = Technique(portList=[80,443,8443,8082], broEvents=[], winlogEvents=[])
 	Distributed_Component_Object_Model = Technique(portList=[135,138,139,445], broEvents=[], winlogEvents=[528,552,4648])
 	Logon_Scripts = Technique(portList=[445,139], broEvents=[], winlogEvents=[528,552])
-	Pass_The_Hash = Technique(portList=[445,139], broEvents=[], winlogEvents=[4624])
+	Pass_The_Hash = Technique(portList=[445,139], broEvents=[], winlogEvents=[4624,4625])
 	Pass_The_Ticket = Technique(portList=[464,389], broEvents=[], winlogEvents=[])
-	Remote_Desktop_Protocol = Technique(portList=[3389], broEvents=[], winlogEvents=[1149])
+	Remote_Desktop_Protocol = Technique(portList=[3389], broEvents=[], winlogEvents=[1149,4625])
 	Remote_File_Copy = Technique(portList=[20,21,22,445,3389], broEvents=[], winlogEvents=[1149])
 	SSH_Hijacking= Technique(portList=[22], broEvents=[], winlogEvents=[])
 	Shared_Webroot = Technique(portList=[80,443], broEvents=[], winlogEvents=[])
@@ -82,7 +90,15 @@ class AttackFeatureModel(object):
 	Service_Registry_Perms_Weakness = Technique(winlogEvents=[4657])
 	Valid_Accounts = Technique(winlogEvents=[528, 552, 4648])
 	
-	def __init__(self):
+	def __init__(self, featurePath=None):
+		"""
+		@featurePath: Optional json data file of the feature table, in the format written by Save(); if None, the table is
+					built from the techniques defined as class attributes.
+		"""
+		if featurePath is not None:
+			self.Load(featurePath)
+			return
+
 		#Store lateral movement techniques as a list
 		self.Lateral_Movement_Techniques = [
 									self.Apple_Script, 
@@ -126,4 +142,119 @@ class AttackFeatureModel(object):
 		self.AttackTable["execution"] = self.Execution_Techniques
 		self.AttackTable["privilege_escalation"] = self.Privilege_Escalation_Techniques
 		self.AttackTable["discovery"] = self.Discovery_Techniques
+		#every technique defined on the class, by name, e.g. "Pass_The_Hash"
+		self._techniques = dict((name, val) for name, val in vars(type(self)).items() if isinstance(val, Technique))
+		self._compileIndex()
 
+	def Load(self, featurePath):
+		"""
+		Loads the feature table from the json data file @featurePath, a dict of tactic -> technique name -> features, e.g.:
+		
+			{"lateral_movement" : {"Pass_The_Hash" : {"ports" : [445, 139], "winlogEvents" : [4624]}, ...}, "discovery" : {...}, ...}
+		
+		Each technique may also list "broEvents", and an "esQuery", either an elastic query body or the name of a QueryBuilder
+		method building one (e.g. "BuildNetworkScanDetectionQuery"). A technique listed under several tactics must have the
+		same features under each.
+		"""
+		with open(featurePath, "r") as ifile:
+			table = json.load(ifile)
+		
+		self._techniques = dict()
+		self.AttackTable = dict()
+		for tactic, techniques in table.items():
+			self.AttackTable[tactic] = []
+			for name, features in sorted(techniques.items()):
+				esQuery = features.get("esQuery", None)
+				if esQuery is not None and not isinstance(esQuery, dict):
+					esQuery = getattr(QueryBuilder, str(esQuery))()
+				technique = Technique(portList=features.get("ports", []), broEvents=features.get("broEvents", []), winlogEvents=features.get("winlogEvents", []), esQuery=esQuery)
+				if name in self._techniques:
+					other = self._techniques[name]
+					if (other.Ports, other.BroEvents, other.WinlogEvents) != (technique.Ports, technique.BroEvents, technique.WinlogEvents):
+						print("ERROR technique {} has different features under different tactics in {}".format(name, featurePath))
+						raise Exception("Inconsistent technique definition: "+name)
+					technique = other
+				self._techniques[name] = technique
+				self.AttackTable[tactic].append(technique)
+		self.Lateral_Movement_Techniques = self.AttackTable.setdefault("lateral_movement", [])
+		self.Discovery_Techniques = self.AttackTable.setdefault("discovery", [])
+		self.Execution_Techniques = self.AttackTable.setdefault("execution", [])
+		self.Privilege_Escalation_Techniques = self.AttackTable.setdefault("privilege_escalation", [])
+		
+		self._compileIndex()
+		
+	def Save(self, featurePath):
+		#Writes the feature table to @featurePath in the json format read by Load(), e.g. to move the built-in table into a data file
+		names = dict((id(technique), name) for name, technique in self._techniques.items())
+		table = dict((tactic, dict((names[id(t)], {"ports" : t.Ports, "broEvents" : t.BroEvents, "winlogEvents" : t.WinlogEvents, "esQuery" : t.ElasticQuery})
+							for t in techniques)) for tactic, techniques in self.AttackTable.items())
+		with open(featurePath, "w") as ofile:
+			json.dump(table, ofile, indent=1, sort_keys=True)
+
+	def _compileIndex(self):
+		"""
+		Builds the inverted indexes over the table: for each port and winlog event id, the names of the techniques and tactics
+		it is a feature of; for each tactic, the sets of its ports and event ids; and for each tactic, boolean indicator
+		arrays over the sorted vocabularies of all ports (PortVocabulary) and event ids (EventVocabulary).
+		"""
+		names = dict((id(technique), name) for name, technique in self._techniques.items())
+		self._portTechniques, self._eventTechniques = dict(), dict()
+		self._portTactics, self._eventTactics = dict(), dict()
+		self._tacticPorts, self._tacticEvents = dict(), dict()
+		for tactic, techniques in self.AttackTable.items():
+			ports, events = set(), set()
+			for technique in techniques:
+				for port in technique.Ports:
+					self._portTechniques.setdefault(port, set()).add(names[id(technique)])
+					self._portTactics.setdefault(port, set()).add(tactic)
+				for event in technique.WinlogEvents:
+					self._eventTechniques.setdefault(event, set()).add(names[id(technique)])
+					self._eventTactics.setdefault(event, set()).add(tactic)
+				ports.update(technique.Ports)
+				events.update(technique.WinlogEvents)
+			self._tacticPorts[tactic] = frozenset(ports)
+			self._tacticEvents[tactic] = frozenset(events)
+		
+		self.PortVocabulary = sorted(self._portTechniques.keys())
+		self.EventVocabulary = sorted(self._eventTechniques.keys())
+		portIndex = dict((port, i) for i, port in enumerate(self.PortVocabulary))
+		eventIndex = dict((event, i) for i, event in enumerate(self.EventVocabulary))
+		self.TacticPortIndicators = dict((tactic, self.GetTacticIndicator(tactic, portIndex, "port")) for tactic in self.AttackTable)
+		self.TacticEventIndicators = dict((tactic, self.GetTacticIndicator(tactic, eventIndex, "event")) for tactic in self.AttackTable)
+
+	def GetTechniqueNames(self):
+		return sorted(self._techniques.keys())
+
+	def GetTechnique(self, name):
+		return self._techniques[name]
+
+	def GetTacticPorts(self, tactic):
+		#Returns the frozenset of all ports that are features of any of @tactic's techniques
+		return self._tacticPorts[tactic]
+
+	def GetTacticEvents(self, tactic):
+		#Returns the frozenset of all winlog event ids that are features of any of @tactic's techniques
+		return self._tacticEvents[tactic]
+
+	def GetPortTechniques(self, port):
+		return self._portTechniques.get(port, set())
+
+	def GetPortTactics(self, port):
+		return self._portTactics.get(port, set())
+
+	def GetEventTechniques(self, eventId):
+		return self._eventTechniques.get(eventId, set())
+
+	def GetEventTactics(self, eventId):
+		return self._eventTactics.get(eventId, set())
+
+	def GetTacticIndicator(self, tactic, colIndex, featureType="port"):
+		"""
+		Returns a boolean array over the columns of @colIndex, a map of ports (or event ids, if @featureType is "event") to
+		column indices such as returned by NetFlowModel.GetEdgeDistributionMatrix(), which is True at the columns of @tactic's
+		features. E.g. the port counts of @tactic on every edge are then just the matrix' product with the indicator.
+		"""
+		features = self._tacticPorts[tactic] if featureType == "port" else self._tacticEvents[tactic]
+		indicator = np.zeros(len(colIndex), dtype=bool)
+		indicator[[colIndex[key] for key in features if key in colIndex]] = True
+		return indicator
@@ -101,7 +101,11 @@ class QueryBuilder(object):
 		print(str(aggDict1==aggDict2))
 		
 	@staticmethod
-	def BuildNetworkScanDetectionQuery():
+	def BuildNetworkScanDetectionQuery(interval="1m", minBucketPorts=5, minBucketHosts=5, maxPorts=1024, \
+										srcField="netflow.ipv4_src_addr", \
+										dstField="netflow.ipv4_dst_addr", \
+										portField="netflow.l4_dst_port", \
+										timeField="@timestamp"):
 		"""
 		There are likely many threshold-based queries to detect network scans, especially given nmap-detection countermeasures:
 			*non-contiguous ports scanned: adversary might not scan ports sequentially; could skip ports, e.g., scan even ports
@@ -113,9 +117,53 @@ class QueryBuilder(object):
 			1) Canonical: query for contiguous sequence of k ports scanned by a specific source (src ip)
 			2) Mathematical: Query for any specific source (src ip) scanning greater than k ports in some
 			time span.
+
+		This builds the server-side half of both: per src ip, a date_histogram of @interval buckets, each with the cardinality
+		of the dst ports and dst hosts it contacted, and the ports themselves (up to @maxPorts) so contiguity can be checked.
+		A bucket_selector drops every bucket below @minBucketPorts distinct ports and @minBucketHosts distinct hosts, so only
+		candidate buckets are returned. The thresholds here are deliberately low: a scan spread over time (disjoint or slow
+		scans) rarely crosses a high per-bucket threshold, so the final decision is left to the client-side sliding window
+		of scan_detector.NetworkScanDetector. Lowering them catches slower scans at the cost of larger responses.
+
+		Note that _buildAggBucketDict() is not used, since date_histogram and cardinality aggs don't accept its "size" param.
+
+		@interval: The date_histogram interval, eg "1m", "10m"
+		@minBucketPorts: Minimum number of distinct dst ports for a bucket to be returned
+		@minBucketHosts: Minimum number of distinct dst hosts for a bucket to be returned (a horizontal scan/sweep)
+		@maxPorts: The most port values listed per bucket; the cardinality is still exact (to elastic's precision) beyond it
+		@srcField/@dstField/@portField/@timeField: The netflow fields; pass the ipv6 address fields to query ipv6 traffic
 		"""
-		#TODO
-		return None
+		return {
+			"size": 0,
+			"aggs": {
+				"src_addr": {
+					"terms": {
+						"field": srcField,
+						"size": 40000 #see _buildAggBucketDict() header
+					},
+					"aggs": {
+						"time": {
+							"date_histogram": {
+								"field": timeField,
+								"interval": interval,
+								"min_doc_count": 1
+							},
+							"aggs": {
+								"num_ports": {"cardinality": {"field": portField}},
+								"num_hosts": {"cardinality": {"field": dstField}},
+								"ports": {"terms": {"field": portField, "size": maxPorts}},
+								"candidates": {
+									"bucket_selector": {
+										"buckets_path": {"ports": "num_ports", "hosts": "num_hosts"},
+										"script": "params.ports >= {} || params.hosts >= {}".format(int(minBucketPorts), int(minBucketHosts))
+									}
+								}
+							}
+						}
+					}
+				}
+			}
+		}
 		
 	@staticmethod
 	def BuildOsFingerprintingQuery():
@@ -126,13 +174,50 @@ class QueryBuilder(object):
 		return None
 		
 	@staticmethod
-	def BuildFailedLoginQuery():
+	def BuildFailedLoginQuery(interval="10m", maxAccounts=100, \
+								hostField="computer_name", \
+								accountField="event_data.TargetUserName", \
+								timeField="@timestamp"):
 		"""
 		This seems like another example of low-hanging fruit: detect failedl login attempts,
 		indicating things like rdp attacks and pass-the-hash events part of
 		discovery or lateral movement techniques. See windows event 4625.
+
+		Counts the failed logons (event 4625) per host and @interval time bucket, and within each bucket, per target account
+		(up to @maxAccounts; the cardinality of all accounts is also returned). Nothing but the counts is returned, so the
+		burst detection itself is done client-side; see logon_detector.FailedLogonDetector.
+
+		@interval: The date_histogram interval, eg "10m"
+		@maxAccounts: The most target accounts listed per bucket
+		@hostField/@accountField/@timeField: The winlogbeat fields
 		"""
-		return None
+		return {
+			"size": 0,
+			"query": {
+				"term": {"event_id": 4625}
+			},
+			"aggs": {
+				"host": {
+					"terms": {
+						"field": hostField,
+						"size": 40000 #see _buildAggBucketDict() header
+					},
+					"aggs": {
+						"time": {
+							"date_histogram": {
+								"field": timeField,
+								"interval": interval,
+								"min_doc_count": 1
+							},
+							"aggs": {
+								"num_accounts": {"cardinality": {"field": accountField}},
+								"account": {"terms": {"field": accountField, "size": maxAccounts}}
+							}
+						}
+					}
+				}
+			}
+		}
 		
 	def BuildNestedAggsQuery(self, bucketList, size=0, filterQuery={"match_all":{}}):
 		"""
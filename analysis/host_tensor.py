@@ -0,0 +1,64 @@
+"""
+Many of the matrices in this project are indexed by hosts along their first two axes: D_attack (from the random walks),
+D_system (from the netflow model), and their products. Each carries its own mapping from host names to row/col indices,
+and since those mappings are arbitrary, the matrices must be subset, re-keyed and re-ordered before they can be combined.
+
+HostTensor bundles a matrix with its host index, so these alignment steps are done in one place, and always by
+fancy-indexing (np.ix_) whole blocks of the matrix rather than copying cells one host pair at a time.
+"""
+
+import numpy as np
+
+class HostTensor(object):
+	def __init__(self, matrix, hostIndex):
+		"""
+		@matrix: An n x n or n x n x k numpy array; the first two axes are hosts, any third axis (e.g. tactics) is carried along unchanged.
+		@hostIndex: A map of host names to their row/col indices in @matrix
+		"""
+		if matrix.shape[0] != matrix.shape[1]:
+			raise Exception("HostTensor matrix must be square along its host axes, got shape "+str(matrix.shape))
+		if len(hostIndex) != matrix.shape[0]:
+			raise Exception("HostTensor index has {} hosts, but matrix has {} rows".format(len(hostIndex), matrix.shape[0]))
+
+		self.Matrix = matrix
+		self.HostIndex = hostIndex
+
+	def Hosts(self):
+		#Returns the host names in row/col order
+		return [host for host, i in sorted(self.HostIndex.items(), key = lambda t: t[1])]
+
+	def _take(self, hosts):
+		#Returns a new HostTensor with rows/cols for @hosts, in the order given; every host must be in this tensor's index
+		rows = np.array([self.HostIndex[host] for host in hosts], dtype=np.int64)
+		matrix = self.Matrix[np.ix_(rows, rows)]
+		return HostTensor(matrix, dict((host, i) for i, host in enumerate(hosts)))
+
+	def Filter(self, hostWhitelist):
+		"""
+		Returns a HostTensor consisting only of the subset of rows/cols for the hosts in @hostWhitelist, ordered as in @hostWhitelist.
+		"""
+		return self._take(list(hostWhitelist))
+
+	def Reorder(self, targetIndex):
+		"""
+		Returns a HostTensor re-ordered so that each host's row/col is the one given by @targetIndex. @targetIndex must have
+		the same keys as this tensor's index, and values 0..n-1.
+		"""
+		missing = set(targetIndex.keys()).symmetric_difference(set(self.HostIndex.keys()))
+		if any(missing):
+			raise Exception("Reorder target index does not have the same hosts as the tensor; mismatched: {}".format(sorted(missing)))
+		hosts = [host for host, i in sorted(targetIndex.items(), key = lambda t: t[1])]
+		return self._take(hosts)
+
+	def Alias(self, keyAliasMap):
+		"""
+		Returns a HostTensor sharing this tensor's matrix, with every host name replaced by its alias in @keyAliasMap.
+		"""
+		return HostTensor(self.Matrix, dict((keyAliasMap[key], val) for key, val in self.HostIndex.items()))
+
+	def AlignTo(self, other):
+		"""
+		Returns a HostTensor with exactly the rows/cols of @other (another HostTensor), in @other's order, such that the two
+		matrices can be combined elementwise. Every host in @other must be in this tensor.
+		"""
+		return self._take(other.Hosts())
@@ -0,0 +1,164 @@
+"""
+Implements the "Attack Sequence Information Gain" metric sketched in sandbox/paper.tex: the detectability of a technique
+t on some feature N is the relative entropy between the normal feature distribution B_{T,N} and the same distribution
+with t's events injected, B'_{T,N}:
+
+	D_KL(B' | B) = sum_i B'(i) log(B'(i) / B(i))
+
+(The draft writes this with a leading minus sign; the standard, non-negative form is used here.) The features are the
+port histograms on every edge and the winlog event-id histograms on every host of a NetFlowModel, and the injected events
+are the ports and event ids of each Technique in an AttackFeatureModel.
+
+With additive smoothing (alpha per category, over a vocabulary of K categories), injecting m events into each of t's
+features T only changes those categories, and rescales every other one by the same ratio Z / Z', so the divergence has
+the closed form
+
+	D_KL = (1 - sum_{i in T} B'(i)) log(Z / Z') + sum_{i in T} B'(i) log((c_i + alpha + m) / (c_i + alpha) * Z / Z')
+
+where c_i are the counts, Z = sum(c) + K alpha and Z' = Z + |T| m. Hence scoring needs only the counts at each technique's
+own features, which are gathered for all hosts/edges at once from the sparse count matrices, and the log terms are then
+evaluated for every (row, technique) pair in one array operation.
+"""
+
+from __future__ import print_function
+
+import ast
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+from walk_corpus import WalkCorpusReader
+
+class InformationGainScorer(object):
+	def __init__(self, netflowModel, featureModel, alpha=1.0, injectCount=1.0):
+		"""
+		@netflowModel: A NetFlowModel with "port" edge models and, optionally, an "event_id" vertex model
+		@featureModel: An AttackFeatureModel
+		@alpha: Additive smoothing per category, so that unseen categories have non-zero probability under B
+		@injectCount: The number of events m injected into each of a technique's features
+		"""
+		self._alpha = alpha
+		self._inject = injectCount
+		#every Technique in the feature model, keyed by name, e.g. "Pass_The_Hash"
+		self.TechniqueNames = featureModel.GetTechniqueNames()
+		techniques = [featureModel.GetTechnique(name) for name in self.TechniqueNames]
+		self._techniqueIndex = dict((self._normalizeName(name), k) for k, name in enumerate(self.TechniqueNames))
+
+		edgeHists = netflowModel.GetEdgeDistributions("port") or {}
+		self.EdgeIndex = dict((edge, i) for i, edge in enumerate(edgeHists.keys()))
+		self._edgeCounts, self._portIndex = self._buildCounts(list(edgeHists.values()), [t.Ports for t in techniques])
+
+		hostHists = netflowModel.GetVertexDistributions("event_id") or {}
+		self.HostIndex = dict((host, i) for i, host in enumerate(hostHists.keys()))
+		self._hostCounts, self._eventIndex = self._buildCounts(list(hostHists.values()), [t.WinlogEvents for t in techniques])
+
+		self._portFeatures = [sorted(set(self._portIndex[p] for p in t.Ports)) for t in techniques]
+		self._eventFeatures = [sorted(set(self._eventIndex[e] for e in t.WinlogEvents)) for t in techniques]
+		self._edgeScores = None
+		self._hostScores = None
+
+	def _normalizeName(self, name):
+		#Matches AttackFeatureModel names ("Pass_The_Hash") to MITRE technique names in walks ("Pass the Hash")
+		return name.lower().replace(" ", "_").replace("-", "_")
+
+	def _buildCounts(self, hists, featureLists):
+		"""
+		Builds a CSR count matrix of @hists (one row each) over the vocabulary of all observed categories plus every
+		technique feature in @featureLists, so each technique's features have a column even if never observed.
+		"""
+		vocab = sorted(set(key for hist in hists for key in hist.keys()).union(f for features in featureLists for f in features))
+		index = dict((key, i) for i, key in enumerate(vocab))
+		lengths = np.array([len(hist) for hist in hists], dtype=np.int64)
+		indptr = np.zeros(len(hists) + 1, dtype=np.int64)
+		np.cumsum(lengths, out=indptr[1:])
+		cols = np.fromiter((index[key] for hist in hists for key in hist.keys()), dtype=np.int64, count=int(lengths.sum()))
+		vals = np.fromiter((val for hist in hists for val in hist.values()), dtype=np.float64, count=int(lengths.sum()))
+		counts = sp.csr_matrix((vals, cols, indptr), shape=(len(hists), len(vocab)))
+		return counts, index
+
+	def _score(self, counts, featureLists):
+		"""
+		Returns the rows x techniques matrix of D_KL(B' | B) for the count matrix @counts, per the closed form in the header.
+		Techniques with no features in this matrix' vocabulary score 0.
+		"""
+		n, K = counts.shape
+		scores = np.zeros((n, len(featureLists)))
+		if n == 0:
+			return scores
+		a, m = self._alpha, self._inject
+		Z = np.asarray(counts.sum(axis=1)).ravel() + K * a
+		#gather the counts at every technique feature for all rows at once: n x (total features over techniques)
+		flatCols = np.array([c for features in featureLists for c in features], dtype=np.int64)
+		owners = np.array([k for k, features in enumerate(featureLists) for c in features], dtype=np.int64)
+		if len(flatCols) == 0:
+			return scores
+		C = counts[:, flatCols].toarray() + a
+		sizes = np.bincount(owners, minlength=len(featureLists)).astype(np.float64)
+		Zp = Z[:,np.newaxis] + sizes[owners][np.newaxis,:] * m
+		ratio = Z[:,np.newaxis] / Zp
+		Bp = (C + m) / Zp
+		terms = Bp * np.log((C + m) / C * ratio)
+		#sum the per-feature terms into their techniques
+		featureSums = np.zeros((n, len(featureLists)))
+		massSums = np.zeros((n, len(featureLists)))
+		np.add.at(featureSums.T, owners, terms.T)
+		np.add.at(massSums.T, owners, Bp.T)
+		hasFeatures = sizes > 0
+		logRatio = np.log(Z[:,np.newaxis] / (Z[:,np.newaxis] + sizes[np.newaxis,:] * m))
+		scores[:,hasFeatures] = ((1.0 - massSums) * logRatio + featureSums)[:,hasFeatures]
+		return scores
+
+	def ScoreEdges(self):
+		#Returns the n_edges x n_techniques matrix of port-feature divergences; rows per self.EdgeIndex, columns per self.TechniqueNames
+		if self._edgeScores is None:
+			self._edgeScores = self._score(self._edgeCounts, self._portFeatures)
+		return self._edgeScores
+
+	def ScoreHosts(self):
+		#Returns the n_hosts x n_techniques matrix of event-id-feature divergences; rows per self.HostIndex, columns per self.TechniqueNames
+		if self._hostScores is None:
+			self._hostScores = self._score(self._hostCounts, self._eventFeatures)
+		return self._hostScores
+
+	def ScoreWalks(self, walkPath, hostMap=None):
+		"""
+		Computes D_KL^S, the sum of technique divergences over each attack sequence S in the walk file @walkPath (one walk per line,
+		as written by RandomWalkGenerator), or in the walk corpus directory @walkPath (see walk_corpus.py). Each step contributes its technique's event-id divergence at the step's host, plus its
+		port divergence on the edge from the previous step's host, if that edge is in the model. Techniques not defined in the
+		AttackFeatureModel, and hosts not in the model, contribute 0.
+
+		@hostMap: Optional map from walk host names (e.g. "scada") to model vertex names (ips); "NULL" or missing means unmapped.
+
+		Returns: A numpy array with one D_KL^S per walk.
+		"""
+		edgeScores = self.ScoreEdges()
+		hostScores = self.ScoreHosts()
+		totals = []
+		for walk in self._readWalks(walkPath):
+			total = 0.0
+			prevHost = None
+			for step in walk:
+				host = step["host"] if hostMap is None else hostMap.get(step["host"], "NULL")
+				k = self._techniqueIndex.get(self._normalizeName(step["technique_name"]))
+				if k is not None:
+					if host in self.HostIndex:
+						total += hostScores[self.HostIndex[host], k]
+					if (prevHost, host) in self.EdgeIndex:
+						total += edgeScores[self.EdgeIndex[(prevHost, host)], k]
+				prevHost = host
+			totals.append(total)
+
+		return np.array(totals)
+
+	def _readWalks(self, walkPath):
+		#Yields the walks of @walkPath, either a walk corpus directory or a legacy walk file
+		if os.path.isdir(walkPath):
+			for walk in WalkCorpusReader(walkPath).GetWalks():
+				yield walk
+			return
+
+		with open(walkPath, "r") as ifile:
+			for line in ifile:
+				if len(line.strip()) > 0:
+					yield ast.literal_eval(line.strip())
@@ -0,0 +1,210 @@
+"""
+Failed logon (windows event 4625) burst detection over the winlogbeat indices, per QueryBuilder.BuildFailedLoginQuery().
+
+Elastic counts the failed logons per host, time bucket and target account; no raw events are returned. Per host, the
+detector keeps an exponentially weighted moving average (EWMA) of its failed logons per bucket, along with their EWMA
+variance, and raises an alert when a bucket's count is far above that baseline. An alert over many target accounts
+is labelled a password "spray"; one over few accounts a "brute-force" attempt.
+
+The query only returns non-empty buckets, so before each bucket the baseline is decayed over the empty buckets preceding
+it. Hosts are first seen at their first failed logon, but their baseline is taken to start at the beginning of the
+first index processed, with no failed logons, so a host's first burst is also detected.
+
+As with scan_detector.NetworkScanDetector, each index is queried once, in time order, and the detector state can be saved
+and re-read, so each run only queries the indices created since the previous one.
+
+UpdateEventModel() writes the failed logons found in bursts into a winlog event-id model (see
+ModelBuilder.BuildWinlogEventIdModel()) as event 4625, so that NetFlowModel._getVertexEventProb() reflects bursts of
+failed logons rather than the occasional mistyped password.
+"""
+
+from __future__ import print_function
+
+import datetime
+import math
+import os
+import pickle
+import re
+
+from elastic_client import ElasticClient
+from elastic_query_builder import QueryBuilder
+
+class FailedLogonDetector(object):
+	def __init__(self, client, indexRegex="winlogbeat-", intervalMinutes=10, alpha=0.05, zThreshold=4.0, minCount=10, warmupBuckets=144, sprayAccounts=5):
+		"""
+		@client: An ElasticClient
+		@indexRegex: Regex matching (via re.match) the indices to query. Index names must sort in time order, as daily indices do.
+		@intervalMinutes: The length of the time buckets
+		@alpha: The EWMA smoothing factor; the baseline has a memory of roughly 1/@alpha buckets
+		@zThreshold: Number of baseline standard deviations above its mean for a bucket to be a burst
+		@minCount: Minimum failed logons in a bucket for it to be a burst
+		@warmupBuckets: Number of buckets, from the start of the first index processed, before any alerts are raised
+		@sprayAccounts: Minimum number of target accounts in a burst for it to be labelled a spray
+		"""
+		self._client = client
+		self._indexRegex = re.compile(indexRegex)
+		self._intervalMs = int(intervalMinutes) * 60 * 1000
+		self._alpha = float(alpha)
+		self._zThreshold = zThreshold
+		self._minCount = minCount
+		self._warmupBuckets = warmupBuckets
+		self._sprayAccounts = sprayAccounts
+		self._qDict = QueryBuilder.BuildFailedLoginQuery(interval="{}m".format(int(intervalMinutes)))
+		#the indices queried so far, and the time of the first bucket of the first of them
+		self._processed = set()
+		self._startTime = None
+		#per host, its baseline as [time of last bucket, ewma mean, ewma variance]
+		self._baselines = dict()
+		#per host, its total failed logons, and those within bursts
+		self._failedCounts = dict()
+		self._burstCounts = dict()
+		self._alerts = []
+
+	def Update(self):
+		"""
+		Queries every matching index not queried before, in time order, and returns their names. The newest index is
+		skipped, since it is likely still being written to; it is queried by the first Update() after its successor appears.
+		"""
+		indices = self._client.listIndices(filterRegex=self._indexRegex)[:-1]
+		newIndices = [index for index in indices if index not in self._processed]
+		for index in newIndices:
+			if len(self._processed) > 0 and index < max(self._processed):
+				print("WARNING index {} is older than those already processed; its buckets are skipped by the host baselines".format(index))
+			self._processIndex(index)
+
+		return newIndices
+
+	def _processIndex(self, index):
+		response = self._client.aggregate(index, self._qDict)
+		if "statusCode" in response.keys() and response["statusCode"] in [502,"502"]:
+			raise Exception("Bad gateway 502 error, elastic server likely down. Returned json: "+str(response))
+		if "error" in response.keys():
+			print("ERROR failed logon query failed on index "+index)
+			raise Exception("Failed logon query failed on index {}: {}".format(index, response["error"]))
+		if response["_shards"]["failed"] > 0:
+			print("WARNING {} shards failed for index {}".format(response["_shards"]["failed"], index))
+
+		hostBuckets = response["aggregations"]["host"]["buckets"]
+		if self._startTime is None:
+			times = [int(timeBucket["key"]) for hostBucket in hostBuckets for timeBucket in hostBucket["time"]["buckets"]]
+			if len(times) > 0:
+				self._startTime = min(times)
+
+		for hostBucket in hostBuckets:
+			host = hostBucket["key"]
+			for timeBucket in hostBucket["time"]["buckets"]:
+				accounts = dict((pair["key"], pair["doc_count"]) for pair in timeBucket["account"]["buckets"])
+				self._addBucket(host, int(timeBucket["key"]), timeBucket["doc_count"], accounts, timeBucket["num_accounts"]["value"])
+
+		self._processed.add(index)
+
+	def _decay(self, mean, var, numEmpty):
+		#Applies the ewma update for @numEmpty buckets of zero failed logons
+		if numEmpty * self._alpha > 20.0:
+			#the baseline has long since forgotten any failed logons
+			return 0.0, 0.0
+		for i in range(numEmpty):
+			mean, var = (1.0 - self._alpha) * mean, (1.0 - self._alpha) * (var + self._alpha * mean * mean)
+
+		return mean, var
+
+	def _addBucket(self, host, t, count, accounts, numAccounts):
+		"""
+		Scores the bucket of @count failed logons at @host at time @t (ms since epoch) against @host's baseline, then adds it
+		to the baseline. @accounts maps the target accounts to their counts, and @numAccounts is their cardinality.
+		"""
+		lastTime, mean, var = self._baselines.get(host, [self._startTime - self._intervalMs, 0.0, 0.0])
+		if t <= lastTime:
+			return
+		mean, var = self._decay(mean, var, (t - lastTime) // self._intervalMs - 1)
+		self._failedCounts[host] = self._failedCounts.get(host, 0) + count
+
+		#the standard deviation is floored as for poisson counts, so a quiet host's first few failures aren't a burst
+		z = (count - mean) / math.sqrt(max(var, mean, 1.0))
+		warm = (t - self._startTime) // self._intervalMs >= self._warmupBuckets
+		if warm and count >= self._minCount and z >= self._zThreshold:
+			self._burstCounts[host] = self._burstCounts.get(host, 0) + count
+			self._alerts.append({
+									"host" : host,
+									"time" : t,
+									"count" : count,
+									"baseline" : mean,
+									"z" : z,
+									"numAccounts" : numAccounts,
+									"accounts" : accounts,
+									"kind" : "spray" if numAccounts >= self._sprayAccounts else "brute-force"
+								})
+
+		diff = count - mean
+		mean += self._alpha * diff
+		var = (1.0 - self._alpha) * (var + self._alpha * diff * diff)
+		self._baselines[host] = [t, mean, var]
+
+	def GetAlerts(self):
+		"""
+		Returns the alerts so far, in time order per host, as dicts of:
+			"host": the computer_name of the host logging the failed logons
+			"time": the start (ms since epoch) of the bursting bucket
+			"count": the failed logons in the bucket
+			"baseline": the host's ewma failed logons per bucket before it
+			"z": the number of baseline standard deviations @count is above @baseline
+			"numAccounts": the number of target accounts
+			"accounts": target account -> failed logons, for up to the query's maxAccounts accounts
+			"kind": "spray" or "brute-force"
+		"""
+		return list(self._alerts)
+
+	def GetBurstCounts(self):
+		#Returns a dict of host -> the number of its failed logons within bursts, for every host with at least one failed logon
+		return dict((host, self._burstCounts.get(host, 0)) for host in self._failedCounts)
+
+	def UpdateEventModel(self, eventModel, hostMap=None):
+		"""
+		Sets the event 4625 counts of @eventModel, a dict of host -> {"event_id" : event-id histogram} as returned by
+		ModelBuilder.BuildWinlogEventIdModel(), to each host's failed logons within bursts; hosts with failed logons but
+		no bursts get a count of 0. Hosts missing from @eventModel are added. Do this before storing the model with
+		NetFlowModel.MergeVertexModel().
+
+		@hostMap: An optional dict mapping computer names to the keys of @eventModel, eg ip addresses; hosts not in it are skipped.
+		"""
+		for host, count in self.GetBurstCounts().items():
+			if hostMap is not None:
+				if host not in hostMap:
+					print("WARNING failed logon host {} not in hostMap, skipped".format(host))
+					continue
+				host = hostMap[host]
+			eventModel.setdefault(host, dict()).setdefault("event_id", dict())[4625] = count
+
+		return eventModel
+
+	def Print(self):
+		toStr = lambda ms: datetime.datetime.utcfromtimestamp(ms / 1000.0).strftime("%Y-%m-%d %H:%M")
+		print("{} indices processed, {} hosts with failed logons, {} bursts".format(len(self._processed), len(self._failedCounts), len(self._alerts)))
+		for alert in self._alerts:
+			top = sorted(alert["accounts"].items(), key = lambda pair: -pair[1])[:5]
+			print("  {}  {}  failed={}  baseline={:.2f}  z={:.1f}  {} accounts={}  top: {}".format(alert["host"], toStr(alert["time"]), alert["count"], alert["baseline"], alert["z"], alert["kind"], alert["numAccounts"], top))
+
+	def Save(self, fpath):
+		#Pickles the detector state, including its parameters, but not its client
+		state = dict((k, v) for k, v in self.__dict__.items() if k != "_client")
+		with open(fpath, "wb") as ofile:
+			pickle.dump(state, ofile, pickle.HIGHEST_PROTOCOL)
+
+	def Read(self, fpath):
+		#Restores the state written by Save(); the detector's own parameters are replaced by the saved ones
+		with open(fpath, "rb") as ifile:
+			self.__dict__.update(pickle.load(ifile))
+
+def main():
+	servAddr = "http://192.168.0.91:80/elasticsearch"
+	statePath = "logon_detector.pickle"
+	detector = FailedLogonDetector(ElasticClient(servAddr))
+	if os.path.isfile(statePath):
+		detector.Read(statePath)
+	newIndices = detector.Update()
+	print("Processed {} new indices".format(len(newIndices)))
+	detector.Save(statePath)
+	detector.Print()
+
+if __name__ == "__main__":
+	main()
@@ -473,7 +473,7 @@ class ModelBuilder(object):
 
 		return d
 
-	def BuildNetFlowModel(self, indexPattern="netflow*", ipVersion="all", ipBlacklist=None, ipWhitelist=None):
+	def BuildNetFlowModel(self, indexPattern="netflow*", ipVersion="all", ipBlacklist=None, ipWhitelist=None, checkIntegrity=True, integrityTolerance=0.01):
 		"""
 		Builds a very specific kind of flow model, represented as a graph with edges and
 		vertices containing further information.
@@ -484,6 +484,10 @@ class ModelBuilder(object):
 		@ipWhitelist: A list of ips to exclusively include.
 		
 		Of course, @ipBlacklist/@ipWhitelist should be treated as mutually exclusive.
+		
+		@checkIntegrity: If true, raise an exception when any edge model fails NetFlowModel.CheckEdgeModelIntegrity(), so a
+					scheduled build exits with an error instead of saving an inconsistent model. If false, failures are only reported.
+		@integrityTolerance: The relative error tolerance passed to CheckEdgeModelIntegrity()
 		"""
 		
 		#friendly reminder about ip black/whitelists
@@ -514,6 +518,17 @@ class ModelBuilder(object):
 		if not flowModel.MergeEdgeModel(pktSizeModel, "in_bytes"):
 			print("ERROR could not merge port model into flow model")
 
+		#verify the histogram totals of each edge model against the flow counts of the host graph; see netflow_model.py header
+		failedModels = []
+		for modelName, edgeModel in [("protocol", protocolModel), ("port", portModel), ("in_bytes", pktSizeModel)]:
+			report = flowModel.CheckEdgeModelIntegrity(modelName, tolerance=integrityTolerance, edgeModel=edgeModel)
+			if not report["passed"]:
+				failedModels.append(modelName)
+		#gates the build: a model failing the check is not returned, and so is never saved
+		if len(failedModels) > 0 and checkIntegrity:
+			print("ERROR edge models {} failed the integrity check".format(failedModels))
+			raise Exception("Edge models {} failed the integrity check; pass checkIntegrity=False to build the model anyway".format(failedModels))
+
 		"""
 		#FUTURE
 		#aggregate host-to-host port traffic by time-stamp
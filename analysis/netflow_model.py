@@ -27,9 +27,12 @@ and the numerical mistakes can completely upset proper probability distributions
 
 
 """
+import os
+import pickle
 import traceback
 import igraph
 import numpy as np
+import scipy.sparse as sp
 
 class NetFlowModel(object):
 	def __init__(self, ipTrafficModel=None):
@@ -44,11 +47,15 @@ class NetFlowModel(object):
 			self._graph["edgeModels"] = [] # a list of the edge-based model names (histograms, weights, etc) added to the model
 		
 		self._mitreModelName = "ATT&CK_Model"
+		#vertex/edge attributes that make up the base graph (topology and weights); everything else is a model, which may be saved and loaded separately
+		self._baseAttributes = ["name", "weight", "label", "vertex_label", "exec_capable", "entry_point"]
+		#models deferred by Read(lazy=True), as modelName -> (seqName, modelPath), where seqName is "vs" or "es"
+		self._lazyModels = dict()
 		
 	def _getGraphVertexNames(self):
 		return sorted([v["name"] for v in self._graph.vs])
 
-	def GetEdgeDistributionMatrix(self, distName):
+	def GetEdgeDistributionMatrix(self, distName, sparse=False, normalizeRows=False, logTransform=False, tfidf=False):
 		"""
 		This is not for edge-distributions per se, but rather for the distributions stored in the edges, such 
 		as the port-number distribution storing a map of port number keys to frequency values (number of netflows for that port#).
@@ -56,27 +63,37 @@ class NetFlowModel(object):
 		defined in the header for GetCategoricalDistributionsAsNumpyMatrix(), but consists of all the distributions
 		stacked on top one another. So each row in the matrix is one distribution, and thus the matrix has a number 
 		of rows equal to the number of distributions. The columns reflect the number of categories over all distributions.
+		
+		@sparse: If true, return a scipy CSR matrix built by GetCategoricalDistributionsAsSparseMatrix(). The dense port
+				matrix of a large network will not fit in memory, since it can have up to 65k columns.
+		@normalizeRows, @logTransform, @tfidf: Transforms applied to the sparse matrix; see GetCategoricalDistributionsAsSparseMatrix().
+				These are only supported when @sparse is true.
 		"""
 		if distName not in self._graph["edgeModels"]:
 			print("ERROR, {} not in edge models".format(distName))
 			return None, None
 
-		dists = self.GetEdgeDistributions(distName).values()
-		matrix, colIndex = self.GetCategoricalDistributionsAsNumpyMatrix(dists)
+		dists = list(self.GetEdgeDistributions(distName).values())
+		if sparse:
+			matrix, colIndex = self.GetCategoricalDistributionsAsSparseMatrix(dists, normalizeRows=normalizeRows, logTransform=logTransform, tfidf=tfidf)
+		else:
+			if normalizeRows or logTransform or tfidf:
+				print("WARNING matrix transforms are only applied when sparse=True in GetEdgeDistributionMatrix()")
+			matrix, colIndex = self.GetCategoricalDistributionsAsNumpyMatrix(dists)
 		
 		return matrix, colIndex
 			
 	def HasEventModel(self):
 		#Returns whether or not the winlog event-id distribution has been stored; good to check before
 		#deriving analytics, which will be incomplete if not winlog data has been stored in the model.
-		return "event_id" in self._graph.vs.attribute_names()
+		return "event_id" in self._getModelNames("vs")
 		
 	def HasPortModel(self):
-		return "port" in self._graph.es.attribute_names()
+		return "port" in self._getModelNames("es")
 	def HasProtocolModel(self):
-		return "protocol" in self._graph.es.attribute_names()
+		return "protocol" in self._getModelNames("es")
 	def HasMitreAttackModel(self):
-		return self._mitreModelName in self._graph.vs.attribute_names()
+		return self._mitreModelName in self._getModelNames("vs")
 			
 	def InitializeMitreHostTacticModel(self, featureModel):
 		"""
@@ -108,7 +125,8 @@ class NetFlowModel(object):
 		#@edgeView may be one of {"in","out","undirected"}, indicating which edges to evaluate relational/edge-based probability distributions.
 		edgeView = "undirected"
 		#Initialize a model at each vertex; each host/vertex stores an 'ATT&CK_Model' table, which in turn
-		#maps each tactic name (e.g. 'lateral_movement') to its probability.
+		#maps each tactic name (e.g. 'lateral_movement') to its probability. Any previously saved, deferred copy is discarded.
+		self._lazyModels.pop(modelName, None)
 		for v in self._graph.vs:
 			v[modelName] = dict()
 
@@ -125,15 +143,48 @@ class NetFlowModel(object):
 
 		#assign lateral movement tactic probability to all nodes
 		for v in self._graph.vs:
-			attackTable = v[modelName]
-			#Lateral movement can be characterized as both a host-level and relational/edge-based. The former
-			#gives a single value per-host; the latter gives multiple values for a host, one for each of its peers (a transition model).
-			#I build and store both, since both may be useful.
-			attackTable["lateral_movement_relational"] = self._relationalTacticProb(v, featureModel, "lateral_movement")
-			attackTable["lateral_movement"] = self._simpleTacticProb(v, featureModel, "lateral_movement", edgeView)
-			attackTable["execution"] = self._simpleTacticProb(v, featureModel, "execution", edgeView)
-			attackTable["discovery"] = self._simpleTacticProb(v, featureModel, "discovery", edgeView)
-			attackTable["privilege_escalation"] = self._simpleTacticProb(v, featureModel, "privilege_escalation", edgeView)
+			self._buildHostAttackTable(v, featureModel, edgeView)
+	
+	def _buildHostAttackTable(self, v, featureModel, edgeView="undirected"):
+		attackTable = v[self._mitreModelName]
+		#Lateral movement can be characterized as both a host-level and relational/edge-based. The former
+		#gives a single value per-host; the latter gives multiple values for a host, one for each of its peers (a transition model).
+		#I build and store both, since both may be useful.
+		attackTable["lateral_movement_relational"] = self._relationalTacticProb(v, featureModel, "lateral_movement")
+		attackTable["lateral_movement"] = self._simpleTacticProb(v, featureModel, "lateral_movement", edgeView)
+		attackTable["execution"] = self._simpleTacticProb(v, featureModel, "execution", edgeView)
+		attackTable["discovery"] = self._simpleTacticProb(v, featureModel, "discovery", edgeView)
+		attackTable["privilege_escalation"] = self._simpleTacticProb(v, featureModel, "privilege_escalation", edgeView)
+		
+	def UpdateMitreHostTacticModel(self, featureModel, hostNames):
+		"""
+		Recomputes the ATT&CK tables built by InitializeMitreHostTacticModel() only for the hosts whose tables depend on data
+		that changed at @hostNames: each changed host and its in/out neighbors. A host's undirected port probabilities depend on
+		all of its edges, and its relational lateral-movement probabilities depend on the event models of its destinations, so
+		updating the port histograms of edge (i,j) or the event model of host j must refresh both endpoints and j's sources.
+		Pass both endpoints of any updated or new edge in @hostNames.
+		
+		Returns: The sorted names of all hosts whose tables were recomputed.
+		"""
+		if not self.HasMitreAttackModel():
+			print("ERROR UpdateMitreHostTacticModel called before InitializeMitreHostTacticModel")
+			return []
+		self._loadModel(self._mitreModelName)
+		
+		names = self._graph.vs["name"]
+		affected = set()
+		for name in hostNames:
+			vId = self._getHostVertexIndex(name)
+			affected.add(vId)
+			affected.update(self._graph.neighbors(vId, mode="all"))
+		
+		for vId in affected:
+			v = self._graph.vs[vId]
+			if v[self._mitreModelName] is None:
+				v[self._mitreModelName] = dict()
+			self._buildHostAttackTable(v, featureModel)
+			
+		return sorted(names[vId] for vId in affected)
 		
 	def PrintAttackModels(self):
 		"""
@@ -143,6 +194,7 @@ class NetFlowModel(object):
 			print("ERROR not ATT&CK model initialized in model")
 			return
 			
+		self._loadModel(self._mitreModelName)
 		for v in self._graph.vs:
 			model = v[self._mitreModelName]
 			print("{} model: {}".format(v["name"], model))
@@ -154,6 +206,7 @@ class NetFlowModel(object):
 			print("ERROR called _getVertexEventProb without an initialized event-id model")
 			return 0.0
 		
+		self._loadModel("event_id")
 		eventModel = vertex["event_id"]
 		#print("{}".format(eventModel))
 		#vertex' event_id model is None if it has no data, as for many ied's, such as the relays. Event ids typically pertain only to scada, fw, hmi, and similar devices.
@@ -202,6 +255,7 @@ class NetFlowModel(object):
 		if arcType not in {"in", "out", "undirected"}:
 			print("ERROR arcType {} invalid in _getVertexPortEventProb()".format(arcType))
 			return 0.0
+		self._loadModel("port")
 
 		#aggregate the edges over which to evaluate port activity
 		if arcType == "out":
@@ -257,19 +311,14 @@ class NetFlowModel(object):
 		@featureModel: An AttackFeatureModel object
 		@tactic: One of "lateral_movement", "discovery", "execution", or "privilege_escalation".
 		"""
-		ports = []
-		eventIds = []
-		#first union all of the unique features to analyze, since there is significant overlap
-		for technique in featureModel.AttackTable[tactic]:
-			ports += technique.Ports
-			eventIds += technique.WinlogEvents
-		#uniquify the events and ports, since there will often be repeats over all of the techniques for a given tactic
-		ports = list(set(ports))
-		eventIds = list(set(eventIds))
+		#the unique features of all of the tactic's techniques, from the feature model's compiled index
+		ports = featureModel.GetTacticPorts(tactic)
+		eventIds = featureModel.GetTacticEvents(tactic)
 		
 		#print("PORTS: "+str(ports))
 		
 		#calculate the probability of the given features for all neighboring hosts in the netflow model
+		self._loadModel("port")
 		neighborProbs = []
 		for edge in self._graph.es.select(_source=vertex.index):
 			#get the probability of these port events per each destination host
@@ -277,7 +326,7 @@ class NetFlowModel(object):
 			hostname = host["name"]
 			portModel = edge["port"]["port"]
 			z = float(sum([val for val in portModel.values()]))
-			pPorts = float(sum([portModel[port] for port in ports if port in portModel.keys()]))
+			pPorts = float(sum([portModel[port] for port in ports.intersection(portModel)]))
 			print("SUM PORTS FREQ: "+str(pPorts))
 			if z > 0:
 				pPorts = pPorts / z
@@ -302,15 +351,9 @@ class NetFlowModel(object):
 		@arcType: Whether or not to evaluate flow-based (relational) probabilities on the basis of outgoing
 				  host edges, incident edges, or undirected (both incident and outgoing edges).
 		"""
-		ports = []
-		eventIds = []
-		#first union all of the unique features to analyze, since there is significant overlap
-		for technique in featureModel.AttackTable[tactic]:
-			ports += technique.Ports
-			eventIds += technique.WinlogEvents
-		#uniquify the events and ports, since there will often be repeats over all of the techniques for a given tactic
-		ports = list(set(ports))
-		eventIds = list(set(eventIds))
+		#the unique features of all of the tactic's techniques, from the feature model's compiled index
+		ports = featureModel.GetTacticPorts(tactic)
+		eventIds = featureModel.GetTacticEvents(tactic)
 		
 		#with unique set of ports and event-ids, calculate the attack probability as the sum of all these events
 		eventProb = self._getVertexEventProb(vertex, eventIds)
@@ -351,34 +394,41 @@ class NetFlowModel(object):
 		nTactics = len(tacticIndex.keys())
 		D_system = np.zeros(shape=(nHosts, nHosts, nTactics), dtype=np.float)
 		#populate the matrix
+		self._loadModel(self._mitreModelName)
 		for v in self._graph.vs:
-			#get the vertex' attack probability table
-			attackTable = v[self._mitreModelName]
-			print("ATTACK TABLE: "+str(attackTable))
-			#get this host's row/col index in the matrix
-			v_i = hostIndex[v["name"]]
-			#fill diagonal elements with on-host attack event feature probabilities: discovery, execution, privilege escalation
-			#get exe prob
-			exeProb = attackTable["execution"]
-			exe_k = tacticIndex["execution"]
-			D_system[v_i, v_i, exe_k] = exeProb
-			#get discovery prob
-			discProb = attackTable["discovery"]
-			disc_k = tacticIndex["discovery"]
-			D_system[v_i, v_i, disc_k] = discProb
-			#privilege escalation
-			peProb = attackTable["privilege_escalation"]
-			pe_k = tacticIndex["privilege-escalation"]
-			D_system[v_i, v_i, pe_k] = peProb
-			#now set the off-diagonal elements with individual lateral-movement feature probabilities
-			lm_k = tacticIndex["lateral-movement"]
-			for neighbor, lmProb in attackTable["lateral_movement_relational"]:
-				neighbor_i = hostIndex[neighbor]
-				D_system[v_i, neighbor_i, lm_k] = lmProb
+			self._fillSystemMitreRow(D_system[hostIndex[v["name"]]], v, hostIndex, tacticIndex)
 				
 		return D_system, hostIndex, tacticIndex
+	
+	def GetSystemMitreAttackRows(self, hostNames, hostIndex, tacticIndex):
+		"""
+		Returns just the rows of the D_system matrix built by GetSystemMitreAttackDistribution() for the hosts in @hostNames,
+		as a len(@hostNames) x n x #tactics matrix whose columns follow @hostIndex. @hostIndex may be a filtered/aligned
+		subset of the graph's hosts; lateral-movement peers outside it are omitted. This is used to refresh a few rows
+		of a previously built system matrix, without rebuilding it.
+		"""
+		self._loadModel(self._mitreModelName)
+		rows = np.zeros(shape=(len(hostNames), len(hostIndex), len(tacticIndex)), dtype=np.float64)
+		for i, name in enumerate(hostNames):
+			self._fillSystemMitreRow(rows[i], self._getVertexByName(name), hostIndex, tacticIndex)
+		return rows
+	
+	def _fillSystemMitreRow(self, row, v, hostIndex, tacticIndex):
+		#Fills @row, the n x #tactics row of D_system for vertex @v, from its ATT&CK table; peers not in @hostIndex are skipped
+		#get the vertex' attack probability table
+		attackTable = v[self._mitreModelName]
+		#get this host's row/col index in the matrix
+		v_i = hostIndex[v["name"]]
+		#fill diagonal elements with on-host attack event feature probabilities: discovery, execution, privilege escalation
+		row[v_i, tacticIndex["execution"]] = attackTable["execution"]
+		row[v_i, tacticIndex["discovery"]] = attackTable["discovery"]
+		row[v_i, tacticIndex["privilege-escalation"]] = attackTable["privilege_escalation"]
+		#now set the off-diagonal elements with individual lateral-movement feature probabilities
+		lm_k = tacticIndex["lateral-movement"]
+		for neighbor, lmProb in attackTable["lateral_movement_relational"]:
+			if neighbor in hostIndex:
+				row[hostIndex[neighbor], lm_k] = lmProb
 				
-		
 	def GetCategoricalDistributionsAsNumpyMatrix(self, dists, dtype=np.float32):
 		"""
 		Accepts @dists, a set of n k-dimensional categorical distributions, and converts each distribution to a numpy 
@@ -411,6 +461,55 @@ class NetFlowModel(object):
 
 		return matrix, colIndex
 	
+	def GetCategoricalDistributionsAsSparseMatrix(self, dists, dtype=np.float32, normalizeRows=False, logTransform=False, tfidf=False):
+		"""
+		The sparse analog of GetCategoricalDistributionsAsNumpyMatrix(): converts @dists, a set of n categorical distributions,
+		into an n x k scipy CSR matrix, where k is the number of categories over all distributions. The matrix is built
+		in a single pass, by flattening all keys/values into arrays and interning keys as columns, rather than filling a dense
+		matrix cell by cell. As in GetCategoricalDistributionsAsNumpyMatrix(), columns are in order of each key's first appearance.
+		
+		The optional transforms only touch the stored (non-zero) entries, so the matrix stays sparse. They are applied in
+		the order listed:
+		@logTransform: Replace each frequency f with log(1 + f), dampening the heavy-tailed port counts.
+		@tfidf: Scale each column by its smoothed inverse document frequency, log((1 + n) / (1 + df)) + 1, where df is the
+				number of distributions containing that category. This down-weights ubiquitous categories (e.g. port 80).
+		@normalizeRows: Divide each row by its sum, converting rows to probability distributions. Empty rows are left at zero.
+		
+		Returns: An (n x k) CSR matrix as described, along with @columnIndex, a dict mapping distribution keys
+		(class names) to their columnar indices in the matrix.
+		"""
+		dists = list(dists)
+		n = len(dists)
+		lengths = np.fromiter((len(dist) for dist in dists), dtype=np.int64, count=n)
+		nnz = int(lengths.sum())
+		keyList = [key for dist in dists for key in dist.keys()]
+		values = np.fromiter((val for dist in dists for val in dist.values()), dtype=dtype, count=nnz)
+		
+		#map every key to its column in first-seen order; @cols is aligned with @values. Keys are interned in a dict rather than
+		#passed through np.unique, which would coerce mixed int/str keys to strings and fails on tuple keys of different lengths.
+		interned = dict()
+		cols = np.fromiter((interned.setdefault(key, len(interned)) for key in keyList), dtype=np.int64, count=nnz)
+		categories = sorted(interned, key=interned.get)
+		indptr = np.zeros(n + 1, dtype=np.int64)
+		np.cumsum(lengths, out=indptr[1:])
+		matrix = sp.csr_matrix((values, cols.ravel(), indptr), shape=(n, len(categories)), dtype=dtype)
+		matrix.sort_indices()
+		colIndex = dict((key, i) for i, key in enumerate(categories))
+		
+		if logTransform:
+			np.log1p(matrix.data, out=matrix.data)
+		if tfidf:
+			docFreq = np.bincount(matrix.indices, minlength=matrix.shape[1])
+			idf = np.log((1.0 + n) / (1.0 + docFreq)) + 1.0
+			matrix.data *= idf[matrix.indices].astype(dtype)
+		if normalizeRows:
+			rowSums = np.asarray(matrix.sum(axis=1)).ravel()
+			scale = np.zeros(n, dtype=dtype)
+			scale[rowSums > 0] = 1.0 / rowSums[rowSums > 0]
+			matrix.data *= np.repeat(scale, np.diff(matrix.indptr))
+		
+		return matrix, colIndex
+	
 	def GetEdgeDistributions(self, distName):
 		"""
 		Returns all of the port# distributions for each direct edge (host1 -> host2),
@@ -420,6 +519,7 @@ class NetFlowModel(object):
 		
 		@distName: The name of the distribution to fetch, e.g. "port"
 		"""
+		self._loadModel(distName)
 		if distName in self._graph.es.attribute_names():
 			hists = {}
 			for edge in self._graph.es:
@@ -433,6 +533,96 @@ class NetFlowModel(object):
 
 		return hists
 	
+	def GetEdgeNames(self):
+		#Returns the (src-name, dst-name) pair of every edge, in edge-id order
+		names = self._graph.vs["name"]
+		return [(names[src], names[dst]) for src, dst in self._graph.get_edgelist()]
+
+	def GetEdgeHistogram(self, src, dst, distName):
+		"""
+		Returns the @distName histogram (e.g. "port") stored on the edge @src -> @dst, or None if there is no such edge or model.
+		"""
+		self._loadModel(distName)
+		try:
+			value = self._getEdge(src, dst)[distName]
+		except:
+			return None
+		return None if value is None else value[distName]
+	
+	def GetVertexDistributions(self, distName):
+		"""
+		The vertex analog of GetEdgeDistributions(): returns a dict of vertex name -> @distName histogram (e.g. "event_id"),
+		with an empty histogram for hosts that have no data (e.g. ied's with no winlog events). Returns None if no vertex
+		models are stored under @distName.
+		"""
+		self._loadModel(distName)
+		if distName not in self._graph.vs.attribute_names():
+			return None
+		
+		hists = {}
+		for v in self._graph.vs:
+			model = v[distName]
+			#vertex models are stored as the whole merged model; see MergeVertexModel()
+			if model is None or v["name"] not in model:
+				hists[v["name"]] = dict()
+			else:
+				hists[v["name"]] = model[v["name"]][distName]
+				
+		return hists
+	
+	def SetHostFlag(self, flagName, hostNames):
+		"""
+		Sets the boolean vertex attribute @flagName to True at the hosts in @hostNames, and False at all others. Flags mark host
+		roles that are not derived from data, such as the execution-capable hosts and entry points read by GetWalkTopology().
+		"""
+		hostNames = set(hostNames)
+		missing = hostNames.difference(self._graph.vs["name"])
+		if len(missing) > 0:
+			print("WARNING hosts not in model ignored by SetHostFlag({}): {}".format(flagName, sorted(missing)))
+		self._graph.vs[flagName] = [name in hostNames for name in self._graph.vs["name"]]
+		
+	def _getFlaggedHosts(self, flagName):
+		#Returns the names of the hosts whose vertex attribute @flagName is set; none if the attribute does not exist
+		self._loadModel(flagName)
+		if flagName not in self._graph.vs.attribute_names():
+			return []
+		return [v["name"] for v in self._graph.vs if v[flagName]]
+		
+	def GetWalkTopology(self, execFlag="exec_capable", entryFlag="entry_point", edgeView="undirected"):
+		"""
+		Returns the host graph in the form walked by a BatchWalkSimulator, so attack walks can be run on the monitored network
+		itself rather than on a hand-built graph. The execution-capable hosts and the entry points walks start at are read
+		from the boolean vertex attributes @execFlag and @entryFlag, as set by SetHostFlag().
+		
+		@edgeView: "undirected" if hosts are neighbors when flows were observed in either direction, or "out" if walks may only
+				move from a flow's source to its destination
+		
+		Returns: @topology, a (hosts, indptr, indices) CSR adjacency over the vertex names, in vertex order, @execHosts and @entryHosts
+		"""
+		names = self._graph.vs["name"]
+		n = len(names)
+		edges = np.array(self._graph.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+		src, dst = edges[:,0], edges[:,1]
+		if edgeView == "undirected":
+			src, dst = np.concatenate((src, dst)), np.concatenate((dst, src))
+		elif edgeView != "out":
+			print("ERROR unknown edgeView {} passed to GetWalkTopology".format(edgeView))
+			raise Exception("edgeView must be one of undirected or out, got "+str(edgeView))
+		#flows from a host to itself are not moves, and parallel/reciprocal edges are merged by the csr conversion
+		keep = src != dst
+		adjacency = sp.csr_matrix((np.ones(keep.sum()), (src[keep], dst[keep])), shape=(n, n))
+		adjacency.sort_indices()
+		
+		execHosts = self._getFlaggedHosts(execFlag)
+		entryHosts = self._getFlaggedHosts(entryFlag)
+		if len(entryHosts) == 0:
+			print("ERROR no entry hosts flagged by vertex attribute {}; see SetHostFlag()".format(entryFlag))
+			raise Exception("No walk entry points in netflow model")
+		if len(execHosts) == 0:
+			print("WARNING no execution-capable hosts flagged by vertex attribute {}; walks will never end by execution".format(execFlag))
+		
+		return (names, adjacency.indptr, adjacency.indices), execHosts, entryHosts
+	
 	def Print(self):
 		print("Vertices:")
 		for v in self._graph.vs:
@@ -446,38 +636,72 @@ class NetFlowModel(object):
 			
 		print("Edge models: {}".format(self._graph["edgeModels"]))
 	
-	def _isValidEdgeModel(self, edgeModel, modelName):
+	def _getEdgeIndex(self):
+		#Returns a hash index mapping (src-name, dst-name) -> edge id for every edge, built in a single pass over the edge list
+		names = self._graph.vs["name"]
+		return dict(((names[src], names[dst]), eId) for eId, (src, dst) in enumerate(self._graph.get_edgelist()))
+
+	def DiffEdgeModel(self, edgeModel, edgeIndex=None):
+		"""
+		Structurally compares @edgeModel, a nested dict [src][dst] -> value as passed to MergeEdgeModel(), against the
+		edges of the graph. This is the check described in the file header: aggs queries used to build edge models
+		may return edges that are not in the host graph, or omit edges that are.
+		
+		@edgeIndex: Optionally, a (src,dst) -> edge id index as returned by _getEdgeIndex(), to avoid rebuilding it
+		
+		Returns: A dict with the following keys:
+			"missing_vertices": sorted names in @edgeModel that are not vertices of the graph
+			"extra_edges": sorted (src,dst) pairs in @edgeModel with no corresponding edge in the graph
+			"missing_edges": sorted (src,dst) pairs of graph edges for which @edgeModel has no value
+			"matched": a dict mapping (src,dst) pairs present in both to their edge ids
+		"""
+		if edgeIndex is None:
+			edgeIndex = self._getEdgeIndex()
+		vertexNames = set(self._graph.vs["name"])
+		
+		modelKeys = set()
+		matched = dict()
+		extraEdges = []
+		for src, dsts in edgeModel.items():
+			modelKeys.add(src)
+			for dst in dsts.keys():
+				modelKeys.add(dst)
+				eId = edgeIndex.get((src, dst))
+				if eId is None:
+					extraEdges.append((src, dst))
+				else:
+					matched[(src, dst)] = eId
+		
+		diff = dict()
+		diff["missing_vertices"] = sorted(modelKeys.difference(vertexNames))
+		diff["extra_edges"] = sorted(extraEdges)
+		diff["missing_edges"] = sorted(key for key in edgeIndex.keys() if key not in matched)
+		diff["matched"] = matched
+		
+		return diff
+
+	def _isValidEdgeModel(self, edgeModel, modelName, diff=None):
 		"""
 		Given an edgeModel we want to merge into the graph, we need to verify that:
 			1) every key in edgeModels inner/outer dict keys is in the network graph
 			2) every pair of (outer,inner) keys in @edgeModel has a corresponding edge in the graph
 			3) the edge model name doesn't already exist in the edges
+			
+		@diff: Optionally, the result of DiffEdgeModel(@edgeModel), if the caller already has it
 		"""
 		isValid = True
-		#build the set of keys in @edgeModel
-		modelKeys = set()
-		for src in edgeModel.keys():
-			modelKeys.add(src)
-			for dst in edgeModel.keys():
-				modelKeys.add(dst)
-		#get the keys of the current graph
-		vertexNames = self._getGraphVertexNames()
+		if diff is None:
+			diff = self.DiffEdgeModel(edgeModel)
 		
-		missingNames = sorted([name for name in modelKeys if name not in vertexNames])
-		if any(missingNames):
-			print("ERROR edgeModel keys {}\n ...not in network graph vertices: {}".format(missingNames, vertexNames))
+		if any(diff["missing_vertices"]):
+			print("ERROR edgeModel keys {}\n ...not in network graph vertices".format(diff["missing_vertices"]))
+			isValid = False
+			
+		if any(diff["extra_edges"]):
+			print("ERROR {} edges in edgeModel not in graph: {}".format(len(diff["extra_edges"]), diff["extra_edges"]))
 			isValid = False
 
-		for src in edgeModel.keys():
-			for dst in edgeModel[src].keys():
-				try:
-					edge = self._getEdge(src, dst)
-				except:
-					print("ERROR no edge ({},{}) in graph".format(src,dst))
-					traceback.print_exc()
-					isValid = False
-
-		if modelName in self._graph.es.attribute_names():
+		if modelName in self._getModelNames("es"):
 			print("ERROR edge model name {} already exists".format(modelName))
 			isValid = False
 
@@ -499,7 +723,7 @@ class NetFlowModel(object):
 			print("ERROR edgeModel keys {}\n ...not in network graph vertices: {}".format(missingNames, vertexNames))
 			isValid = False
 		
-		if modelName in self._graph.vs.attribute_names():
+		if modelName in self._getModelNames("vs"):
 			print("ERROR vertex model name {} already exists".format(modelName))
 			isValid = False
 	
@@ -518,6 +742,7 @@ class NetFlowModel(object):
 		"""
 		succeeded = False
 
+		self._loadModel(modelName)
 		if not self._isValidVertexModel(vertexModel, modelName):
 			print("ERROR attempted to add invalid vertex model")
 		else:
@@ -529,7 +754,7 @@ class NetFlowModel(object):
 			
 		return succeeded
 		
-	def MergeEdgeModel(self, edgeModel, modelName):
+	def MergeEdgeModel(self, edgeModel, modelName, returnDiff=False):
 		"""
 		Stores models on the edges of the current network graph, using igraph's ability
 		to store attributes in edges, vertices, and the graph itself. This exemplifies
@@ -544,28 +769,137 @@ class NetFlowModel(object):
 		the name @modelName. The stored values can be arbitrary data structures known to the
 		user: integers, floats, or complex objects like lists, histograms, etc.
 		
+		The merge is done in bulk: all (src,dst) pairs are resolved to edge ids through a single hash
+		index, and the whole attribute column is then assigned at once, rather than looking up and
+		setting each edge individually.
+		
 		@edgeModel: A nested dict of dicts, whose outer keys are src-ip's and inner keys are
 					dst-ip's, like: [src-ip][dst-ip] -> value.
 		@modelName: The name under which to store the model(s) as an edge attribute of each
 		igraph edge.
+		@returnDiff: If true, return (succeeded, diff), where diff is the structural diff returned by DiffEdgeModel().
 		"""
 		succeeded = True
 		
+		self._loadModel(modelName)
 		#verify every outer/inner key in @edgeModel matches a vertex in the traffic graph, and has an edge
-		if not self._isValidEdgeModel(edgeModel, modelName):
+		diff = self.DiffEdgeModel(edgeModel)
+		if not self._isValidEdgeModel(edgeModel, modelName, diff):
 			print("WARNING attempting to add invalid edge model {}, safety not guaranteed...".format(modelName))
+			succeeded = len(diff["extra_edges"]) == 0
+		if any(diff["missing_edges"]):
+			print("WARNING {} graph edges have no {} model".format(len(diff["missing_edges"]), modelName))
 		
-		for src in edgeModel.keys():
-			for dst in edgeModel[src].keys():
-				model = edgeModel[src][dst]
-				if not self._addEdgeAttribute(src, dst, modelName, model):
-					print("Adding edge attribute {} failed in MergeEdgeModel() for ({},{})".format(modelName, src, dst))
-					succeeded = False
-				else:
-					self._graph["edgeModels"].append(modelName)
-					
+		#start from the existing column, so values already set are never overwritten
+		if modelName in self._graph.es.attribute_names():
+			column = self._graph.es[modelName]
+		else:
+			column = [None] * self._graph.ecount()
+		
+		for (src, dst), eId in diff["matched"].items():
+			if column[eId] is None:
+				column[eId] = edgeModel[src][dst]
+			else:
+				print("ERROR attempted to add attrib >{}< to edge ({}, {}), but attribute already initialized: {}".format(modelName, src, dst, column[eId]))
+				succeeded = False
+		
+		self._graph.es[modelName] = column
+		if modelName not in self._graph["edgeModels"]:
+			self._graph["edgeModels"].append(modelName)
+		
+		if returnDiff:
+			return succeeded, diff
 		return succeeded
 
+	def _flattenHistogram(self, value, modelName):
+		"""
+		Returns the flat key -> frequency histogram stored in an edge model value. The port/protocol models are stored
+		as {modelName: histogram}; nested models such as in_bytes ({port: {"netflow.in_bytes": histogram}}) are flattened
+		to (port, size) -> frequency, so every flow is counted once.
+		"""
+		if modelName in value:
+			return value[modelName]
+		flat = dict()
+		for outerKey, inner in value.items():
+			for hist in inner.values():
+				for key, freq in hist.items():
+					flat[(outerKey, key)] = freq
+		return flat
+
+	def CheckEdgeModelIntegrity(self, modelName, tolerance=0.01, repair=None, edgeModel=None):
+		"""
+		Implements the numerical and structural checks described in the file header for the histogram-based edge model
+		@modelName ("port", "protocol", "in_bytes", ...). The histogram totals of all edges are computed at once as the row
+		sums of the sparse edge x category matrix, and compared against each edge's flow count 'k' (its weight).
+		
+		@tolerance: Edges whose relative error |total - k| / k exceeds this value are flagged.
+		@repair: None to only report; "rescale" to scale each flagged histogram so it sums to k; or "drop" to remove the
+				model from flagged edges (set it to None), so they are treated as having no model.
+		@edgeModel: Optionally, the raw nested dict that was merged under @modelName. If passed, edges it contains that
+				are not in the graph are reported as phantom edges. These were never merged, so repair leaves them out.
+		
+		Returns: A report dict with keys:
+			"model", "checked" (#edges with a model), "passed" (bool),
+			"flagged": list of (src, dst, histogram-total, weight) tuples for flagged edges, largest relative error first,
+			"missing_edges": (src, dst) graph edges with no model,
+			"phantom_edges": (src, dst) pairs in @edgeModel but not in the graph (empty if @edgeModel is None),
+			"max_relative_error", and "repaired" (#edges repaired)
+		"""
+		if repair not in [None, "rescale", "drop"]:
+			raise Exception("ERROR repair must be one of None, 'rescale', or 'drop', got {}".format(repair))
+		
+		report = {"model" : modelName, "checked" : 0, "passed" : False, "flagged" : [], "missing_edges" : [], "phantom_edges" : [], "max_relative_error" : 0.0, "repaired" : 0}
+		self._loadModel(modelName)
+		if modelName not in self._graph.es.attribute_names():
+			print("ERROR no edge model {} to check".format(modelName))
+			return report
+		
+		names = self._graph.vs["name"]
+		edgeList = self._graph.get_edgelist()
+		column = self._graph.es[modelName]
+		hasModel = np.array([value is not None for value in column], dtype=bool)
+		modelIds = np.flatnonzero(hasModel)
+		report["missing_edges"] = sorted((names[edgeList[eId][0]], names[edgeList[eId][1]]) for eId in np.flatnonzero(~hasModel))
+		if edgeModel is not None:
+			report["phantom_edges"] = self.DiffEdgeModel(edgeModel)["extra_edges"]
+		
+		#histogram totals for every modelled edge, in one sparse row-sum
+		hists = [self._flattenHistogram(column[eId], modelName) for eId in modelIds]
+		matrix, colIndex = self.GetCategoricalDistributionsAsSparseMatrix(hists, dtype=np.float64)
+		totals = np.asarray(matrix.sum(axis=1)).ravel()
+		weights = np.asarray(self._graph.es["weight"], dtype=np.float64)[modelIds]
+		relError = np.abs(totals - weights) / np.maximum(weights, 1.0)
+		flaggedMask = relError > tolerance
+		order = np.argsort(-relError[flaggedMask], kind="stable")
+		flaggedIds = modelIds[flaggedMask][order]
+		
+		report["checked"] = len(modelIds)
+		report["max_relative_error"] = float(relError.max()) if len(relError) > 0 else 0.0
+		report["flagged"] = [(names[edgeList[eId][0]], names[edgeList[eId][1]], t, w) for eId, t, w in zip(flaggedIds.tolist(), totals[flaggedMask][order].tolist(), weights[flaggedMask][order].tolist())]
+		report["passed"] = len(flaggedIds) == 0 and len(report["phantom_edges"]) == 0
+		
+		if repair is not None and len(flaggedIds) > 0:
+			scales = (weights / np.where(totals > 0, totals, 1.0))[flaggedMask][order]
+			for eId, scale in zip(flaggedIds.tolist(), scales.tolist()):
+				if repair == "drop":
+					column[eId] = None
+				else:
+					column[eId] = self._rescaleEdgeModel(column[eId], modelName, scale)
+			self._graph.es[modelName] = column
+			report["repaired"] = len(flaggedIds)
+		
+		print("Edge model {} integrity: checked={} flagged={} missing={} phantom={} max-rel-error={:.4f} repaired={} -> {}".format(
+			modelName, report["checked"], len(report["flagged"]), len(report["missing_edges"]), len(report["phantom_edges"]),
+			report["max_relative_error"], report["repaired"], "PASS" if report["passed"] else "FAIL"))
+		
+		return report
+
+	def _rescaleEdgeModel(self, value, modelName, scale):
+		#Returns a copy of edge model @value with every frequency multiplied by @scale; the inverse of _flattenHistogram's layout
+		if modelName in value:
+			return {modelName : dict((key, freq * scale) for key, freq in value[modelName].items())}
+		return dict((outerKey, dict((attrib, dict((key, freq * scale) for key, freq in hist.items())) for attrib, hist in inner.items())) for outerKey, inner in value.items())
+
 	def _getHostVertexIndex(self, vname):
 		#Given a hostname (vertex name) return its vertex index in the igraph object, or throw if not found.
 		vId = -1
@@ -727,6 +1061,9 @@ class NetFlowModel(object):
 			edges = self._graph.es
 			
 		#Drill into the histograms on all selected edges...
+		for modelName in ["protocol", "port"]:
+			if modelName in query.keys():
+				self._loadModel(modelName)
 		#for now, treat @protocol and @port as separate variables, though port has a logical dependence on network layer protocol (tcp, udp, etc)
 		#if "in_bytes" in query.keys():  #IGNORE FLOW CHARACTERISTIC MODELS, THEY ARE NOT SUPPORTED YET
 		if "protocol" in query.keys():
@@ -767,6 +1104,7 @@ class NetFlowModel(object):
 			return -1.0
 			
 		print("REMINDER: port model returned by GetNetworkPortModel() not yet conditioned on network layer protocol (udp, tcp, etc)")
+		self._loadModel("port")
 
 		portModel = dict()
 		for edge in self._graph.es:
@@ -872,13 +1210,96 @@ class NetFlowModel(object):
 		#under construction
 		pass
 	
-	def Save(self, fpath):
-		if ".pickle" not in fpath:
+	def _getSeq(self, seqName):
+		#Returns the igraph vertex or edge sequence for @seqName, one of "vs" or "es"
+		if seqName == "vs":
+			return self._graph.vs
+		return self._graph.es
+
+	def _getModelNames(self, seqName):
+		"""
+		Returns the names of all models on the vertices ("vs") or edges ("es") for @seqName, including
+		those deferred by Read(lazy=True) which have not been loaded yet.
+		"""
+		names = self._getSeq(seqName).attribute_names()
+		names += [name for name, (seq, path) in self._lazyModels.items() if seq == seqName and name not in names]
+		return names
+
+	def _loadModel(self, modelName):
+		"""
+		Loads the vertex or edge model @modelName from disk if it was deferred by Read(lazy=True). This is a no-op
+		for models already in memory, so it is cheap to call before every access to a model's attributes.
+		Returns True if the model was loaded by this call.
+		"""
+		if modelName not in self._lazyModels:
+			return False
+
+		seqName, modelPath = self._lazyModels.pop(modelName)
+		with open(modelPath, "rb") as ifile:
+			values = pickle.load(ifile)
+		#assigning the whole attribute column at once is far cheaper than setting it per vertex/edge
+		self._getSeq(seqName)[modelName] = values
+		return True
+
+	def LoadAllModels(self):
+		#Forces any models deferred by Read(lazy=True) into memory
+		for modelName in list(self._lazyModels.keys()):
+			self._loadModel(modelName)
+
+	def _getModelPath(self, basePath, modelName):
+		#Each split model is stored beside the base graph as <basePath minus .pickle>.<modelName>.pickle
+		safeName = "".join(c if c.isalnum() or c in "-_" else "_" for c in modelName)
+		root, ext = os.path.splitext(basePath)
+		return (root if ext == ".pickle" else basePath) + "." + safeName + ".pickle"
+
+	def Save(self, fpath, splitModels=False):
+		"""
+		Pickles the model to @fpath.
+		
+		@splitModels: If true, only the base graph (topology and weights) is stored at @fpath, and every vertex
+					and edge model (port, protocol, in_bytes, event_id, ATT&CK_Model, etc) is stored in its own
+					pickle alongside it. Such a model can then be opened with Read(lazy=True), which only loads
+					each model on its first access.
+		"""
+		if not fpath.endswith(".pickle"):
 			savePath = fpath+".pickle"
 		else:
 			savePath = fpath
-		self._graph.write_pickle(fpath)
 
-	
-	def Read(self, fpath):
+		if not splitModels:
+			self._graph.write_pickle(savePath)
+			return
+
+		#any deferred models must be in memory before they can be re-written
+		self.LoadAllModels()
+		g = self._graph.copy()
+		modelIndex = dict()
+		for seqName, seq in [("vs", g.vs), ("es", g.es)]:
+			for modelName in seq.attribute_names():
+				if modelName in self._baseAttributes:
+					continue
+				modelPath = self._getModelPath(savePath, modelName)
+				with open(modelPath, "wb") as ofile:
+					pickle.dump(seq[modelName], ofile, pickle.HIGHEST_PROTOCOL)
+				del seq[modelName]
+				#store paths relative to the base graph, so the files can be moved together
+				modelIndex[modelName] = (seqName, os.path.basename(modelPath))
+
+		g["modelIndex"] = modelIndex
+		g.write_pickle(savePath)
+		
+	def Read(self, fpath, lazy=False):
+		"""
+		Reads a model written by Save(). If the model was saved with splitModels=True and @lazy is true, only the
+		base graph is read here, and each vertex/edge model is read from disk on its first access. Otherwise all
+		models are read immediately.
+		"""
 		self._graph = igraph.Graph.Read_Pickle(fpath)
+		self._lazyModels = dict()
+		if "modelIndex" in self._graph.attributes():
+			modelDir = os.path.dirname(fpath)
+			for modelName, (seqName, modelFile) in self._graph["modelIndex"].items():
+				self._lazyModels[modelName] = (seqName, os.path.join(modelDir, modelFile))
+			del self._graph["modelIndex"]
+			if not lazy:
+				self.LoadAllModels()
@@ -11,62 +11,107 @@ a pretty rigorous justification for analyzing PC's for a matrix with many fewer
 columns.
 """
 
-from sklearn.decomposition import PCA
+from sklearn.decomposition import TruncatedSVD, IncrementalPCA
 from netflow_model import NetFlowModel
+import os
 import sys
 import numpy as np
+import scipy.sparse as sp
 import igraph
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg") #projections are written to disk, not shown interactively
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
 def matrixLog(A, zeroValue=0.0):
 	"""
-	Takes the natural-log of a matrix, setting any 0 values to @zeroValue
+	Takes the natural-log of a matrix, setting any 0 values to @zeroValue. @A may be a dense numpy array
+	or a scipy sparse matrix; for sparse matrices only the stored entries are transformed, so @zeroValue
+	must be 0.0 to preserve sparsity.
 	"""
-	for row in range(A.shape[0]):
-		for col in range(A.shape[1]):
-			if A[row,col] > 0:
-				A[row,col] = np.log(A[row,col])
-			else:
-				A[row,col] = zeroValue
-				
-	return A
+	if sp.issparse(A):
+		if zeroValue != 0.0:
+			print("WARNING non-zero @zeroValue ignored for sparse matrix in matrixLog()")
+		A = A.tocsr(copy=True)
+		A.eliminate_zeros()
+		A.data = np.log(A.data)
+		return A
 
-def main():
-	netflowModel = NetFlowModel()
-	netflowModel.Read("netflowModel.pickle")
-	#Get the port model as a dictionary of (src-host,dst-host) -> port_histogram
-	X, colIndex = netflowModel.GetEdgeDistributionMatrix("port")
-	#OPTIONAL: convert matrix to log(matrix) form to attempt to linearize the irregular distributions
-	#matrix = matrixLog(matrix)
-	print("Matrix shape: {}".format(X.shape))
-	num_components = 16
-	pca = PCA(n_components=num_components)
-	pca.fit(X)
-	Z = pca.transform(X)
+	positive = A > 0
+	A = np.where(positive, np.log(np.where(positive, A, 1.0)), zeroValue).astype(A.dtype)
+	return A
 
-	print("Components' explained variance ratios:\n\t{}".format(pca.explained_variance_ratio_))
-	print("Singular values:\n\t".format(pca.singular_values_))
+def reduceDimensions(X, numComponents, method="svd", chunkSize=4096):
+	"""
+	Projects the rows of @X onto their first @numComponents components without ever densifying all of @X.
+	
+	@X: An n x k matrix, dense or scipy sparse (as returned by GetEdgeDistributionMatrix("port", sparse=True))
+	@method: "svd" for randomized truncated SVD, which works directly on sparse input but does not mean-center
+			the data; or "incremental" for incremental PCA, which mean-centers and fits over row chunks of
+			@chunkSize rows, densifying only one chunk at a time.
+	
+	Returns: @Z, the n x @numComponents projection, and the fitted sklearn model.
+	"""
+	if method == "svd":
+		model = TruncatedSVD(n_components=numComponents, algorithm="randomized")
+		Z = model.fit_transform(X)
+	elif method == "incremental":
+		#every partial_fit chunk must have at least @numComponents rows
+		chunkSize = max(chunkSize, numComponents)
+		model = IncrementalPCA(n_components=numComponents)
+		n = X.shape[0]
+		starts = list(range(0, n, chunkSize))
+		#fold a short trailing chunk into the previous one, so partial_fit never sees too few rows
+		if len(starts) > 1 and n - starts[-1] < numComponents:
+			starts.pop()
+		bounds = list(zip(starts, starts[1:] + [n]))
+		for start, stop in bounds:
+			chunk = X[start:stop]
+			model.partial_fit(chunk.toarray() if sp.issparse(chunk) else chunk)
+		Z = np.vstack([model.transform(X[start:stop].toarray() if sp.issparse(X) else X[start:stop]) for start, stop in bounds])
+	else:
+		raise Exception("Unknown method {} passed to reduceDimensions(); use 'svd' or 'incremental'".format(method))
 		
-	for i in range(num_components-3):
-		x2 = Z[:,i]
-		y2 = Z[:,i+1]
-		print("{}".format(y2))
-		plt.scatter(x2,y2)
-		plt.show()
-		plt.clf()
+	return Z, model
+
+def saveProjections(Z, outDir, plotComponents=True):
+	"""
+	Writes the projection @Z to @outDir as projections.npy, and optionally saves 2d and 3d scatter plots
+	of consecutive components as png files, in place of showing them interactively.
+	"""
+	if not os.path.isdir(outDir):
+		os.makedirs(outDir)
+	np.save(os.path.join(outDir, "projections.npy"), Z)
+	if not plotComponents:
+		return
 	
-		x3 = Z[:,i]
-		y3 = Z[:,i+1]
-		z3 = Z[:,i+2]
-		fig = plt.figure(1, figsize=(4,3))
-		ax = Axes3D(fig)
-		print("{}".format(y3))
-		ax.scatter(x3,y3,z3)
-		plt.show()
+	for i in range(Z.shape[1]-2):
+		plt.scatter(Z[:,i], Z[:,i+1], s=4)
+		plt.savefig(os.path.join(outDir, "components_{}_{}.png".format(i, i+1)))
 		plt.clf()
 	
+		fig = plt.figure(figsize=(4,3))
+		ax = fig.add_subplot(111, projection="3d")
+		ax.scatter(Z[:,i], Z[:,i+1], Z[:,i+2], s=4)
+		fig.savefig(os.path.join(outDir, "components_{}_{}_{}.png".format(i, i+1, i+2)))
+		plt.close(fig)
+
+def main():
+	netflowModel = NetFlowModel()
+	#only the port model is needed here, so leave the other vertex/edge models on disk
+	netflowModel.Read("netflowModel.pickle", lazy=True)
+	#Get the port model as a sparse (src-host,dst-host) x port matrix; the dense one does not fit in memory for large networks
+	X, colIndex = netflowModel.GetEdgeDistributionMatrix("port", sparse=True)
+	#OPTIONAL: convert matrix to log(1 + matrix) form to attempt to linearize the irregular distributions
+	#X, colIndex = netflowModel.GetEdgeDistributionMatrix("port", sparse=True, logTransform=True)
+	print("Matrix shape: {}  non-zeros: {}".format(X.shape, X.nnz))
+	num_components = 16
+	Z, model = reduceDimensions(X, num_components, method="svd")
+
+	print("Components' explained variance ratios:\n\t{}".format(model.explained_variance_ratio_))
+	print("Singular values:\n\t{}".format(model.singular_values_))
+	saveProjections(Z, "pca_output")
 	
 	#Run k-means on transformed data after PCA.
 	#kmeans = KMeans(n_clusters=2, random_state=0).fit(Z)
@@ -76,5 +121,4 @@ def main():
 	
 	
 if __name__ == "__main__":
-	main()
-
+	main()
\ No newline at end of file
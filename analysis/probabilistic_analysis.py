@@ -1,11 +1,20 @@
 from __future__ import print_function
 
+import os
 import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
 
 from random_walk import *
 from model_builder import ModelBuilder
 from elastic_client import ElasticClient
 from attack_features import *
+from host_tensor import HostTensor
+from technique_cache import TechniqueCache
+from logon_detector import FailedLogonDetector
 
 class ModelAnalyzer(object):
 	def __init__(self, netflowModel, winlogModel):
@@ -13,6 +22,9 @@ class ModelAnalyzer(object):
 		self._winlogModel = winlogModel
 		#self._attackFeatureModel = attack_features.AttackFeaturemodel()
 		self._hasMitreTacticModel = False
+		self._featureModel = None
+		#the aligned matrices and solution of the last stationary analysis, kept so RecomputeRisk() can update them incrementally
+		self._riskState = None
 		
 	def _lateralMovementAnalysis_Old(self):
 		"""
@@ -101,6 +113,7 @@ class ModelAnalyzer(object):
 		"""
 		
 		featureModel = AttackFeatureModel()
+		self._featureModel = featureModel
 		self._netflowModel.InitializeMitreHostTacticModel(featureModel)
 		self._hasMitreTacticModel = True #This flag is just so I don't screw up the order of model construciton and analyses
 		
@@ -125,9 +138,18 @@ class ModelAnalyzer(object):
 			success = False
 		return success
 			
-	def AnalyzeStationaryAttackDistribution(self):
+	def AnalyzeStationaryAttackDistribution(self, walkTolerance=None, piTolerance=None, netflowTopology=False, maxDenseHosts=5000):
 		"""
 		Implements the algorithm for estimating the steady state distribution of attacks per hosts on the network.
+		
+		@walkTolerance: If None, the walk matrix is built from the stored walks. Else walks are sampled until both the normalized
+						walk matrix and the stationary distribution it yields are estimated to within +/- @walkTolerance
+						(or @piTolerance, for the latter), per RandomWalkGenerator.SampleRandomWalkMatrixUntilConverged().
+		@netflowTopology: If true, walks run on the netflow model's own host graph (see NetFlowModel.GetWalkTopology()) instead
+						of the testbed graph, so every host in the model is analyzed. Hosts no walk reaches get zero walk counts.
+						Only the walks scale to large graphs: the analysis after them keeps D_attack, D_system and E_risk as dense
+						n x n x #tactics matrices (32 n^2 bytes each, plus temporaries), so this path is limited to a few thousand hosts.
+		@maxDenseHosts: A warning is printed if the analyzed hosts exceed this count; at 5000 hosts each matrix is already 0.8GB.
 		"""
 		if not self._hasMitreTacticModel:
 			print("ERROR mitre tactic models not yet initialized, stationary analysis aborted")
@@ -135,26 +157,36 @@ class ModelAnalyzer(object):
 		
 		np.set_printoptions(precision=4, suppress=True)
 		
-		#The random walk script manually defines hosts by name; to relate these with the network model we need a map.
-		#The nulls are in progress and will just be omitted from out mathematical models; we just need to formalize the who's-who in our data.
-		hostMap = {
-				"scada"  : "192.168.0.11",
-				"hmi"    : "NULL",
-				"sw1"    : "NULL",
-				"fw1"    : "NULL",
-				"fw2"    : "NULL",
-				"sw2"    : "NULL",
-				"gw"     : "192.168.2.10",
-				"eng"    : "NULL",
-				"relay1" : "192.168.2.101",
-				"relay2" : "192.168.2.102",
-				"relay3" : "192.168.2.103",
-				"relay4" : "192.168.2.104",
-				"relay5" : "192.168.2.105",
-				"relay6" : "192.168.2.106",
-				"relay7" : "192.168.2.107",
-				"relay8" : "192.168.2.108"
-			}
+		#sampled walks draw their techniques offline, so relational discovery steps are counted as in the stored walks
+		techniqueCache = None if walkTolerance is None else TechniqueCache()
+		if netflowTopology:
+			#walk hosts are the model's vertices, so each maps to itself
+			generator = RandomWalkGenerator(show=False, techniqueCache=techniqueCache, netflowModel=self._netflowModel)
+			hostMap = dict((host, host) for host in generator.GetHosts())
+			if len(hostMap) > maxDenseHosts:
+				print("WARNING {} hosts exceeds maxDenseHosts={}: each dense n x n x #tactics matrix of the analysis takes {:.1f}GB".format(len(hostMap), maxDenseHosts, 32.0 * len(hostMap) ** 2 / 1e9))
+		else:
+			generator = RandomWalkGenerator(show=False, techniqueCache=techniqueCache)
+			#The random walk script manually defines hosts by name; to relate these with the network model we need a map.
+			#The nulls are in progress and will just be omitted from out mathematical models; we just need to formalize the who's-who in our data.
+			hostMap = {
+					"scada"  : "192.168.0.11",
+					"hmi"    : "NULL",
+					"sw1"    : "NULL",
+					"fw1"    : "NULL",
+					"fw2"    : "NULL",
+					"sw2"    : "NULL",
+					"gw"     : "192.168.2.10",
+					"eng"    : "NULL",
+					"relay1" : "192.168.2.101",
+					"relay2" : "192.168.2.102",
+					"relay3" : "192.168.2.103",
+					"relay4" : "192.168.2.104",
+					"relay5" : "192.168.2.105",
+					"relay6" : "192.168.2.106",
+					"relay7" : "192.168.2.107",
+					"relay8" : "192.168.2.108"
+				}
 		
 		"""
 		First, generate a ton of walks on the host graph, under the distribution dictated in random_walk.py.
@@ -163,12 +195,19 @@ class ModelAnalyzer(object):
 		are tactics representing a transition from one host to another. Here, the matrix is simply built
 		and returned from some previously stored walks; this separates the walk process and the matrix-construction.
 		"""
-		generator = RandomWalkGenerator(show=False)
 		#Get a whitelist of systems of interest to include in walk matrix
 		whitelist = [key for key in hostMap.keys() if hostMap[key] != "NULL"] #only analyze hosts we can bind to an address in the data
 		print("Whitelist: "+str(whitelist))
 		#remember @D_attack is an (n x n x #tactics) matrix, so a stack of n x n matrices, each of which is for some tactic
-		D_attack, attackHostIndex, tacticIndex = generator.BuildRandomWalkMatrix(whitelist)
+		#on the netflow topology, hosts unreachable from the entry points are in no walk, so the matrix is padded rather than filtered
+		walkWhitelist = None if netflowTopology else whitelist
+		if walkTolerance is None:
+			D_attack, attackHostIndex, tacticIndex = generator.BuildRandomWalkMatrix(walkWhitelist)
+		else:
+			piFunction = self._getWalkPiFunction(hostMap, whitelist, generator.GetTacticIndex())
+			D_attack, attackHostIndex, tacticIndex = generator.BuildRandomWalkMatrix(walkWhitelist, tolerance=walkTolerance, piFunction=piFunction, piTolerance=piTolerance)
+		if netflowTopology:
+			D_attack, attackHostIndex = self._padMatrix(D_attack, attackHostIndex, whitelist)
 		self.PrintHostTacticMatrix(D_attack, attackHostIndex)
 		
 		#Error check the @hostMap host keys and those stored in @attackHostIndex, the host-index returned by BuildRandomWalkMatrix().
@@ -202,13 +241,197 @@ class ModelAnalyzer(object):
 		#element-wise multiply the two matrices, aka hadamard product. Be careful with numpy: np.matrix '*' operator is inner-product; ndarray '*' operator means hadamard/elementwise
 		D_transition = D_attack * D_system
 		print("Stochasticize: "+str(D_transition))
+		Pi_tactics, piColumnIndex = self.SolveTacticStationaryDistributions(D_transition, tacticIndex)
+		print("Per-tactic stationary distributions (columns: {}):\n{}".format(sorted(piColumnIndex.items(), key = lambda t: t[1]), Pi_tactics))
+		E_risk = D_transition
 		D_transition = self._stochasticizeTacticMatrix(D_transition, aggregateThirdAxis=True)
 		
-		print("TODO: fill hostMap, and also makes sure the graph topology in random_walk matches the netflow model (can these manual connections be factored out?)")
+		if not netflowTopology:
+			print("TODO: fill hostMap, and also makes sure the graph topology in random_walk matches the netflow model (can these manual connections be factored out?)")
+		
+		pi, stats = self.SolveStationaryDistribution(D_transition)
+		self._riskState = {
+				"D_attack" : D_attack,
+				"D_system" : D_system,
+				"E_risk" : E_risk,
+				"M_risk" : D_transition,
+				"pi" : pi,
+				"hostIndex" : systemHostIndex,
+				"tacticIndex" : tacticIndex
+			}
+		print("Stationary distribution ({} iterations, residual={:.3e}, {:.4f}s via {}):".format(stats["iterations"], stats["residual"], stats["time"], stats["method"]))
+		for host, i in sorted(attackHostIndex.items(), key = lambda t: t[1]):
+			print("  {}: {:.6f}".format(host, pi[i]))
+			
+		return pi, attackHostIndex
+		
+	def _getWalkPiFunction(self, hostMap, whitelist, tacticIndex):
+		"""
+		Returns a function of a walk count matrix and its host index (as from TacticMatrixAccumulator.Snapshot()) that runs the
+		same alignment and solve as AnalyzeStationaryAttackDistribution() on it, returning the stationary distribution ordered
+		by the system host index. Whitelisted hosts missing from the walk matrix have zero counts.
+		"""
+		D_system, systemHostIndex, systemTacticIndex = self._netflowModel.GetSystemMitreAttackDistribution(tacticIndex)
+		D_system, systemHostIndex = self._filterMatrix(D_system, systemHostIndex, [hostMap[host] for host in whitelist])
+		aliasedIndex = dict((hostMap[host], k) for k, host in enumerate(whitelist))
+		
+		def walkPi(M, hostIndex):
+			pairs = [(k, hostIndex[host]) for k, host in enumerate(whitelist) if host in hostIndex]
+			D_attack = np.zeros((len(whitelist), len(whitelist), M.shape[2]))
+			if len(pairs) > 0:
+				ks, rows = zip(*pairs)
+				D_attack[np.ix_(ks, ks)] = M[np.ix_(rows, rows)]
+			D_attack, index = self._reorderMatrix(D_attack, aliasedIndex, systemHostIndex)
+			pi, stats = self.SolveStationaryDistribution(self._stochasticizeTacticMatrix(D_attack * D_system, aggregateThirdAxis=True))
+			return pi
+		
+		return walkPi
+		
+	def GetRiskState(self):
+		"""
+		Returns the state of the last stationary analysis as a dict: the aligned "D_attack", "D_system", "E_risk" (n x n x #tactics),
+		the aggregated stochastic "M_risk" (n x n), its stationary distribution "pi", and the "hostIndex" and "tacticIndex" of
+		those matrices. Returns None if no analysis has been run.
+		"""
+		return self._riskState
+	
+	def GetFeatureModel(self):
+		#The AttackFeatureModel used by AssignMitreTacticProbabilities(), or None if not yet assigned
+		return self._featureModel
+		
+	def RecomputeRisk(self, changedHosts, tol=1e-10, maxIter=10000):
+		"""
+		Refreshes the stationary attack distribution after a small change to D_system, such as new edges or updated port/event
+		histograms for a few hosts, without recomputing it from scratch. The netflow model must already contain the new data.
+		
+		Only the ATT&CK tables of the changed hosts and their neighbors are rebuilt, only those hosts' rows of E_risk and M_risk are
+		recomputed (row-stochastic normalization is per-row, so no other rows change), and power iteration is warm-started from
+		the previous pi, which for a small change is already close to the new solution.
+		
+		@changedHosts: Names (ips) of hosts whose data changed; pass both endpoints of any new or updated edge.
+		
+		Returns: The updated @pi and its solver @stats, as from SolveStationaryDistribution(); @pi is ordered per the analyzed host index.
+		"""
+		if self._riskState is None:
+			print("ERROR RecomputeRisk called before AnalyzeStationaryAttackDistribution")
+			raise Exception("No previous risk analysis to update; run AnalyzeStationaryAttackDistribution first")
+		
+		state = self._riskState
+		hostIndex = state["hostIndex"]
+		recomputed = self._netflowModel.UpdateMitreHostTacticModel(self._featureModel, changedHosts)
+		#hosts outside the analyzed host set have no rows to update
+		hosts = [host for host in recomputed if host in hostIndex]
+		if len(hosts) == 0:
+			return state["pi"], {"method" : "none", "iterations" : 0, "residual" : 0.0, "converged" : True, "time" : 0.0}
+		
+		rows = np.array([hostIndex[host] for host in hosts], dtype=np.int64)
+		state["D_system"][rows] = self._netflowModel.GetSystemMitreAttackRows(hosts, hostIndex, state["tacticIndex"])
+		state["E_risk"][rows] = state["D_attack"][rows] * state["D_system"][rows]
+		state["M_risk"][rows] = self.StochasticizeRows(np.sum(state["E_risk"][rows], axis=2), rows)
+		
+		pi, stats = self.SolveStationaryDistribution(state["M_risk"], method="power", tol=tol, maxIter=maxIter, pi0=state["pi"])
+		state["pi"] = pi
+		
+		return pi, stats
+		
+	def StochasticizeRows(self, rowBlock, rowIds, uniformizeZeroRows=True, allowAbsorption=False):
+		"""
+		Stochasticizes @rowBlock, the rows @rowIds of some n x n matrix, with the semantics of _stochasticizeTwoDimMatrix.
+		The absorbing-state check needs each row's diagonal entry, which is at column @rowIds[r] of row r. Public, since
+		risk_sensitivity.RiskSensitivityAnalyzer rebuilds rows of M_risk the same way.
+		"""
+		n = rowBlock.shape[1]
+		rowSums = np.sum(rowBlock, axis=1, keepdims=True)
+		zeroRows = rowSums <= 0
+		model = rowBlock / np.where(zeroRows, 1.0, rowSums)
+		if uniformizeZeroRows:
+			model = np.where(zeroRows, 1.0 / float(n), model)
+		if not allowAbsorption:
+			absorbing = model[np.arange(len(rowIds)), rowIds] == 1.0
+			model[absorbing,:] = 1.0 / float(n)
+		
+		return model
+		
+	def SolveStationaryDistribution(self, P, method="auto", tol=1e-10, maxIter=10000, pi0=None):
+		"""
+		Returns the stationary distribution pi of the row-stochastic n x n transition matrix @P (e.g. M_risk), such that pi = pi * P
+		and sum(pi) = 1. This replaces repeatedly squaring P, which costs O(n^3) per step and never extracts pi.
+		
+		@P: A dense numpy array or scipy sparse matrix, as returned by the _stochasticize* methods
+		@method: One of:
+			"direct": solve the linear system (P^T - I) pi = 0 with one equation replaced by sum(pi) = 1. Exact; O(n^3), for small n only.
+			"power": power iteration on the vector pi, stopping when ||pi_k+1 - pi_k||_1 < @tol. O(nnz) per iteration. Periodic
+					chains do not converge; the stochasticized models here include self-loops, which avoids that in practice.
+			"arnoldi": the leading left eigenvector of P via ARPACK's implicitly restarted Arnoldi method, for large sparse P.
+			"auto": "direct" for n <= 1000, else "power", falling back to "arnoldi" if power iteration does not converge.
+			The direct method falls back to "power" if the system is singular, as for a reducible chain, or its residual is too large.
+		@tol: Convergence tolerance (L1) for the iterative methods.
+		@maxIter: Iteration limit for the iterative methods.
+		@pi0: Optional starting vector for power iteration, e.g. a previous solution; defaults to uniform.
+		
+		Returns: @pi, a length-n vector, and @stats, a dict of "method", "iterations", "residual" (||pi*P - pi||_1), "converged", and "time" (seconds).
+		"""
+		if P.shape[0] != P.shape[1]:
+			print("ERROR matrix not square in SolveStationaryDistribution")
+			raise Exception("Non-square matrix passed to SolveStationaryDistribution")
+		
+		n = P.shape[0]
+		if method == "auto":
+			method = "direct" if n <= 1000 else "power"
+		
+		start = time.time()
+		iterations = 0
+		if method == "direct":
+			A = P.toarray().T if sp.issparse(P) else np.array(P, dtype=np.float64).T
+			A = A - np.eye(n)
+			A[-1,:] = 1.0
+			b = np.zeros(n)
+			b[-1] = 1.0
+			try:
+				pi = np.linalg.solve(A, b)
+			except np.linalg.LinAlgError:
+				#singular for reducible chains, e.g. with several absorbing hosts, whose stationary distribution is not unique
+				print("WARNING direct solve failed on a singular system (reducible chain?); falling back to power iteration")
+				pi, stats = self.SolveStationaryDistribution(P, "power", tol, maxIter, pi0)
+				stats["time"] = time.time() - start
+				return pi, stats
+		elif method == "power":
+			#iterate on pi^T = P^T pi^T, so sparse P only needs one mat-vec per step
+			PT = P.T.tocsr() if sp.issparse(P) else np.asarray(P, dtype=np.float64).T
+			pi = np.full(n, 1.0 / n) if pi0 is None else np.asarray(pi0, dtype=np.float64) / np.sum(pi0)
+			delta = np.inf
+			while iterations < maxIter and delta >= tol:
+				nextPi = PT.dot(pi)
+				nextPi /= nextPi.sum()
+				delta = np.abs(nextPi - pi).sum()
+				pi = nextPi
+				iterations += 1
+			if delta >= tol:
+				print("WARNING power iteration did not converge after {} iterations (delta={:.3e}); falling back to arnoldi".format(iterations, delta))
+				pi, stats = self.SolveStationaryDistribution(P, "arnoldi", tol, maxIter)
+				stats["iterations"] += iterations
+				stats["time"] = time.time() - start
+				return pi, stats
+		elif method == "arnoldi":
+			PT = sp.csr_matrix(P).T.tocsr().astype(np.float64)
+			vals, vecs = spla.eigs(PT, k=1, which="LM", tol=tol, maxiter=maxIter, v0=np.full(n, 1.0 / n))
+			pi = np.real(vecs[:,0])
+			iterations = 1
+		else:
+			raise Exception("Unknown method {} passed to SolveStationaryDistribution".format(method))
+		
+		#clean up sign/round-off from the eigen- and linear solvers
+		pi = np.abs(pi)
+		pi /= pi.sum()
+		residual = float(np.abs(P.T.dot(pi) - pi).sum())
+		stats = {"method" : method, "iterations" : iterations, "residual" : residual, "converged" : residual < max(tol, 1e-8) * max(n, 1), "time" : time.time() - start}
+		if method == "direct" and not stats["converged"]:
+			#a nearly singular system may solve without error, but to a poor pi
+			print("WARNING direct solve residual ||pi*P - pi||_1 = {:.3e}; falling back to power iteration".format(residual))
+			pi, stats = self.SolveStationaryDistribution(P, "power", tol, maxIter, pi0)
+			stats["time"] = time.time() - start
 		
-		for i in range(20):
-			print("Model power {}: {}".format(i,str(D_transition)))
-			D_transition = np.dot(D_transition, D_transition)
+		return pi, stats
 		
 	def PrintHostTacticMatrix(self, matrix, hostIndex):
 		print("MATRIX {} x {} x {}".format(matrix.shape[0], matrix.shape[1], matrix.shape[2]))
@@ -227,18 +450,13 @@ class ModelAnalyzer(object):
 		@keyAliasMap: A map from key strings to alias strings. Every key in @originalIndex
 		will be replaced by the values in this map.
 		"""
-		newIndex = dict()
-		for key, val in originalIndex.items():
-			newIndex[ keyAliasMap[key] ] = val
-		return newIndex
+		return dict((keyAliasMap[key], val) for key, val in originalIndex.items())
 		
 	def _filterMatrix(self, M, hostIndex, hostWhitelist):	
 		"""
-		NOTE: This is a duplicate of random_walk.py's _filterWalkMatrix.
-		
 		From @M, return a matrix consisting only of the subset of rows/cols included in @hostWhitelist.
 		
-		@M: An n x n x k matrix, where k > 1.
+		@M: An n x n or n x n x k matrix.
 		@hostIndex: A map of host names to their corresponding row/col indices in @MITRE
 		@hostWhitelist: A list of hosts; only these will be included in the returned items
 
@@ -246,26 +464,19 @@ class ModelAnalyzer(object):
 				@hostIndex_filtered: The same as @hostIndex, but with only the hosts in @hostWhitelist
 		"""
 		
-		if len(M.shape) < 3:
-			print("ERROR _filterMatrix called for matrix with fewer than three axes")
-			return M, hostIndex
-		
-		n = len(hostWhitelist)
-		numTactics = M.shape[2]
-		M_filtered = np.zeros(shape=(n,n,numTactics))
-		#build the filtered hostIndex
-		filteredIndex = dict((host, i) for i, host in enumerate(hostWhitelist))
-		
-		for host in hostWhitelist:
-			h_i = hostIndex[host]
-			h_f_i = filteredIndex[host]
-			for neighbor in hostWhitelist:
-				n_i = hostIndex[neighbor]
-				n_f_i = filteredIndex[neighbor]
-				M_filtered[h_f_i, n_f_i, :] = M[h_i, n_i, :]
-		
-		return M_filtered, filteredIndex
+		filtered = HostTensor(M, hostIndex).Filter(hostWhitelist)
+		return filtered.Matrix, filtered.HostIndex
 
+	def _padMatrix(self, M, hostIndex, hosts):
+		#Returns @M with zero rows/cols appended for the @hosts missing from @hostIndex, and the extended index
+		missing = [host for host in hosts if host not in hostIndex]
+		n = M.shape[0]
+		padded = np.zeros((n + len(missing), n + len(missing)) + M.shape[2:], dtype=M.dtype)
+		padded[:n, :n] = M
+		paddedIndex = dict(hostIndex)
+		paddedIndex.update((host, n + k) for k, host in enumerate(missing))
+		return padded, paddedIndex
+	
 	def _reorderMatrix(self, M, currentIndex, targetIndex):
 		"""
 		Frequently we are building matrices whose rows/cols represent certain hosts,
@@ -281,19 +492,8 @@ class ModelAnalyzer(object):
 		@targetIndex: The target mapping. Note that @currentIndex and @targetIndex must have all the same
 			keys, and the same values, but a different mapping from keys to values.
 		"""
-		M_new = np.zeros(shape=M.shape)
-		isThreeAxis = len(M.shape) == 3
-		
-		for name, index in currentIndex.items():
-			newIndex = targetIndex[name]
-			if isThreeAxis:
-				for peer, peerIndex in currentIndex.items():
-					newPeerIndex = targetIndex[peer]
-					M_new[newIndex, newPeerIndex, :] = M[index, peerIndex, :]
-			else:
-				M_new[newIndex, newIndex] = M[index,index]
-				
-		return M_new, targetIndex
+		reordered = HostTensor(M, currentIndex).Reorder(targetIndex)
+		return reordered.Matrix, reordered.HostIndex
 
 	"""
 	def _getSystemMitreAttackDistribution(self):
@@ -312,10 +512,14 @@ class ModelAnalyzer(object):
 		pass
 	"""
 				
-	def _stochasticizeTacticMatrix(self, matrix, aggregateThirdAxis=True):
+	def _stochasticizeTacticMatrix(self, matrix, aggregateThirdAxis=True, uniformizeZeroRows=True, allowAbsorption=False):
 		"""
 		*This is only for 3-axis matrices currently: axes 1/2 are hosts, 3rd axis are tactics.
 		@matrix: An n x n x #tactics matrix
+		@aggregateThirdAxis: If true, sum the matrix over its tactic axis and return a single n x n stochastic matrix.
+							If false, stochasticize every tactic slice independently, and return an n x n x #tactics matrix
+							whose slices [:,:,k] are each stochastic.
+		@uniformizeZeroRows, @allowAbsorption: See _stochasticizeTwoDimMatrix; applied to every slice.
 		
 		Utility for converting any real-valued, positive, square matrix to a stochastic matrix suitable as a transition model,
 		which permits it to be analyzed using markovian approaches and other good stuff.
@@ -336,32 +540,100 @@ class ModelAnalyzer(object):
 			print("ERROR matrix not positive in _stochasticizeTacticMatrix")
 			raise Exception("Non-positive matrix passed to _stochasticizeTacticMatrix")
 		
-		if aggregateThirdAxis and len(matrix.shape) < 3:
-			print("ERROR passed aggregateThirdAxis=True to _stochasticizeTacticMatrix, but matrix of shape "+str(matrix.shape))
-			raise Exception("Passed aggregateThirdAxis=True to _stochasticizeTacticMatrix, but matrix of shape "+str(matrix.shape))
+		if len(matrix.shape) < 3:
+			print("ERROR _stochasticizeTacticMatrix requires a three-axis matrix, but got matrix of shape "+str(matrix.shape))
+			raise Exception("_stochasticizeTacticMatrix requires a three-axis matrix, but got matrix of shape "+str(matrix.shape))
 		
-		if not aggregateThirdAxis:
-			print("ERROR aggregateThirdAxis=False, but not implemented yet")
-			raise Exception("aggregateThirdAxis=False not implemented")
-		else:
+		if aggregateThirdAxis:
 			#just sum the matrix over its third axis, and then pass to the 2d stochasticize function
-			#model = np.sum(matrix, axis=2)
-			model = matrix[:,:,1]
-			model = self._stochasticizeTwoDimMatrix(model)
-			"""
-			model = np.zeros(shape=(matrix.shape[0],matrix.shape[1]), dtype=np.float)
-			for row in range(matrix.shape[0]):
-				#aggregate the row along the third/tactic axis
-				aggRow = np.sum(matrix[row,:,:], axis=1) #gets the 2d row of 3d data, aggregated over all tactics (the third axis)
-				rowSum = np.sum(aggRow)
-				if rowSum <= 0:
-					print("WARNING rowSum="+str(rowSum))
-					model[row,:] = 0.0
-				else:
-					model[row,:] = aggRow / rowSum
-			"""
+			model = np.sum(matrix, axis=2)
+			return self._stochasticizeTwoDimMatrix(model, uniformizeZeroRows, allowAbsorption)
+		
+		#move the tactic axis to the front, normalize all slices at once, then restore the n x n x #tactics layout
+		stack = np.transpose(matrix, (2,0,1))
+		model = self._stochasticizeMatrixStack(stack, uniformizeZeroRows, allowAbsorption)
+		return np.transpose(model, (1,2,0))
 
+	def _stochasticizeMatrixStack(self, stack, uniformizeZeroRows=True, allowAbsorption=False):
+		"""
+		Stochasticizes every n x n matrix in the k x n x n @stack in one batched operation, with the same zero-row and absorbing-row
+		semantics as _stochasticizeTwoDimMatrix.
+		"""
+		n = stack.shape[-1]
+		rowSums = np.sum(stack, axis=-1, keepdims=True)
+		zeroRows = rowSums <= 0
+		model = stack / np.where(zeroRows, 1.0, rowSums)
+		if uniformizeZeroRows:
+			model = np.where(zeroRows, 1.0 / float(n), model)
+		if not allowAbsorption:
+			absorbing = np.diagonal(model, axis1=-2, axis2=-1) == 1.0
+			model = np.where(absorbing[...,np.newaxis], 1.0 / float(n), model)
+		
 		return model
+
+	def SolveTacticStationaryDistributions(self, D_transition, tacticIndex, tol=1e-10, maxIter=10000):
+		"""
+		Computes the stationary distribution for every tactic slice of the n x n x #tactics matrix @D_transition, and for
+		the aggregate over all tactics, in one batched solve over the stacked (#tactics + 1) x n x n tensor. Every slice is
+		stochasticized together, then solved directly for small n, or by batched power iteration on all pi vectors at once.
+		Any slice the batched solve fails on (a singular, reducible slice makes the whole direct solve raise), or whose residual
+		is too large, is re-solved on its own by SolveStationaryDistribution(): by "power" after the direct solve, by "arnoldi"
+		after batched power iteration.
+		
+		@D_transition: An n x n x #tactics positive matrix, e.g. the hadamard product of D_attack and D_system
+		@tacticIndex: Maps tactic names to their indices along the third axis of @D_transition
+		
+		Returns: @Pi, an n x (#tactics + 1) array whose column k is pi for tactic k (per @tacticIndex), and whose last column
+				is pi for the aggregate matrix; and @columnIndex, mapping tactic names and "aggregate" to the columns of @Pi.
+		"""
+		n, t = D_transition.shape[0], D_transition.shape[2]
+		stack = np.concatenate([np.transpose(D_transition, (2,0,1)), np.sum(D_transition, axis=2)[np.newaxis,:,:]], axis=0)
+		P = self._stochasticizeMatrixStack(stack)
+		
+		#slices the batched solve fails on are re-solved one at a time by SolveStationaryDistribution() with @fallback
+		failed = np.zeros(t+1, dtype=bool)
+		if n <= 1000:
+			fallback = "power"
+			#solve (P_k^T - I) pi_k = 0 with the last equation replaced by sum(pi_k) = 1, for all k at once
+			A = np.transpose(P, (0,2,1)) - np.eye(n)[np.newaxis,:,:]
+			A[:,-1,:] = 1.0
+			b = np.zeros((t+1, n, 1))
+			b[:,-1,0] = 1.0
+			try:
+				Pi = np.linalg.solve(A, b)[:,:,0]
+			except np.linalg.LinAlgError:
+				#a single singular (reducible) slice fails the whole batch
+				print("WARNING batched direct solve failed on a singular system (reducible slice?); re-solving every slice by power iteration")
+				Pi = np.full((t+1, n), 1.0 / n)
+				failed[:] = True
+		else:
+			fallback = "arnoldi"
+			Pi = np.full((t+1, n), 1.0 / n)
+			iterations = 0
+			deltas = np.full(t+1, np.inf)
+			while iterations < maxIter and deltas.max() >= tol:
+				nextPi = np.einsum("kn,knm->km", Pi, P)
+				nextPi /= nextPi.sum(axis=1, keepdims=True)
+				deltas = np.abs(nextPi - Pi).sum(axis=1)
+				Pi = nextPi
+				iterations += 1
+			failed = deltas >= tol
+			if failed.any():
+				print("WARNING batched power iteration did not converge after {} iterations (delta={:.3e}); falling back to arnoldi".format(iterations, deltas.max()))
+		
+		Pi = np.abs(Pi)
+		Pi /= Pi.sum(axis=1, keepdims=True)
+		#check every slice's residual ||pi_k P_k - pi_k||_1, as SolveStationaryDistribution() does; NaNs fail too
+		residuals = np.abs(np.einsum("kn,knm->km", Pi, P) - Pi).sum(axis=1)
+		failed |= ~(residuals < max(tol, 1e-8) * max(n, 1))
+		for k in np.flatnonzero(failed):
+			Pi[k], stats = self.SolveStationaryDistribution(P[k], fallback, tol, maxIter)
+			print("Re-solved tactic slice {} via {}: residual={:.3e}".format(k, stats["method"], stats["residual"]))
+		
+		columnIndex = dict(tacticIndex)
+		columnIndex["aggregate"] = t
+		
+		return Pi.T, columnIndex
 		
 	def _stochasticizeTwoDimMatrix(self, matrix, uniformizeZeroRows=True, allowAbsorption=False):
 		"""
@@ -374,29 +646,49 @@ class ModelAnalyzer(object):
 						of transitioning to all other states, basically restarting the stochastic process from a random state.
 		"""
 		if matrix.shape[0] != matrix.shape[1]:
-			print("ERROR matrix not square in _stochasticizeTacticMatrix")
-			raise Exception("Non-square matrix passed to _stochasticizeTacticMatrix")
+			print("ERROR matrix not square in _stochasticizeTwoDimMatrix")
+			raise Exception("Non-square matrix passed to _stochasticizeTwoDimMatrix")
 
-		hasNegativeEntries = len(matrix[matrix < 0]) > 0
-		if hasNegativeEntries:
+		entries = matrix.data if sp.issparse(matrix) else matrix
+		if np.any(entries < 0):
 			print("ERROR matrix not positive in _stochasticizeTwoDimMatrix")
 			raise Exception("Non-positive matrix passed to _stochasticizeTwoDimMatrix")
-			
-		model = np.zeros(shape=matrix.shape, dtype=np.float)
-		for i in range(matrix.shape[0]):
-			row = matrix[i,:]
-			rowSum = np.sum(row)
-			if rowSum <= 0:
-				print("WARNING rowSum="+str(rowSum))
-				if uniformizeZeroRows:
-					model[i,:] = 1.0 / float(matrix.shape[1])
-				else:
-					model[i,:] = 0.0
-			else:
-				model[i,:] = row / rowSum
-				
-			if not allowAbsorption and model[i,i] == 1.0:
-				model[i,:] = 1.0 / float(matrix.shape[1])
+		
+		if sp.issparse(matrix):
+			return self._stochasticizeSparseMatrix(matrix, uniformizeZeroRows, allowAbsorption)
+		
+		numZeroRows = int(np.sum(np.sum(matrix, axis=1) <= 0))
+		if numZeroRows > 0:
+			print("WARNING {} rows with rowSum <= 0".format(numZeroRows))
+		return self._stochasticizeMatrixStack(np.asarray(matrix, dtype=np.float64), uniformizeZeroRows, allowAbsorption)
+		
+	def _stochasticizeSparseMatrix(self, matrix, uniformizeZeroRows=True, allowAbsorption=False):
+		"""
+		The scipy.sparse version of _stochasticizeTwoDimMatrix, with the same semantics. Row sums are computed once and the
+		stored entries scaled in place; zero and absorbing rows are then replaced, using masks, by explicit uniform rows.
+		Note each uniform row stores n entries, so matrices with many such rows lose much of their sparsity.
+		
+		Returns: A CSR copy of @matrix stochasticized
+		"""
+		n = matrix.shape[1]
+		model = sp.csr_matrix(matrix, dtype=np.float64, copy=True)
+		model.sum_duplicates()
+		rowSums = np.asarray(model.sum(axis=1)).ravel()
+		zeroRows = rowSums <= 0
+		if np.any(zeroRows):
+			print("WARNING {} rows with rowSum <= 0".format(int(zeroRows.sum())))
+		model.data /= np.repeat(np.where(zeroRows, 1.0, rowSums), np.diff(model.indptr))
+		
+		replaceRows = zeroRows if uniformizeZeroRows else np.zeros(model.shape[0], dtype=bool)
+		if not allowAbsorption:
+			replaceRows = replaceRows | (model.diagonal() == 1.0)
+		if np.any(replaceRows):
+			#zero out the rows to replace, then add in a uniform block for exactly those rows
+			keep = sp.diags((~replaceRows).astype(np.float64))
+			rows = np.flatnonzero(replaceRows)
+			uniform = sp.csr_matrix((np.full(len(rows) * n, 1.0 / float(n)), (np.repeat(rows, n), np.tile(np.arange(n), len(rows)))), shape=model.shape)
+			model = (keep.dot(model) + uniform).tocsr()
+			model.eliminate_zeros()
 		
 		return model
 		
@@ -437,12 +729,19 @@ def main():
 	winlogModel = builder.BuildWinlogEventIdModel("winlogbeat*")
 	#just resolves the keys of the winlogmodel (hostnames) to their ip addresses
 	convertedModel = dict([(hostnameConversionTable[host], model) for host, model in winlogModel.items()])
+	#replace the raw failed logon (4625) counts with those within bursts, querying only the winlog indices new since the last run
+	logonDetector = FailedLogonDetector(client)
+	if os.path.isfile("logon_detector.pickle"):
+		logonDetector.Read("logon_detector.pickle")
+	logonDetector.Update()
+	logonDetector.Save("logon_detector.pickle")
+	logonDetector.UpdateEventModel(convertedModel, hostMap=hostnameConversionTable)
 	netflowModel.MergeVertexModel(convertedModel, "event_id") #store the event model in the nodes; this is redundant, but fine for now
 	#Build the analyzer
 	analyzer = ModelAnalyzer(netflowModel, winlogModel)
 	#analyzer.Analyze()
 	analyzer.AssignMitreTacticProbabilities()
-	netflowModel.Save("netflowModel.pickle")
+	netflowModel.Save("netflowModel.pickle", splitModels=True)
 	netflowModel.PrintAttackModels()
 	analyzer.AnalyzeStationaryAttackDistribution()
 	
@@ -1,4 +1,5 @@
 from __future__ import print_function
+import ast
 import networkx as nx
 import numpy as np
 import random as rd
@@ -7,17 +8,43 @@ from stix2 import TAXIICollectionSource, Filter
 from taxii2client import Collection
 import matplotlib.pyplot as plt
 import traceback
+import os
+import time
+import scipy.stats
+from host_tensor import HostTensor
+from technique_cache import TechniqueCache
+from walk_simulator import BatchWalkSimulator
+from walk_corpus import WalkCorpusReader, WalkCorpusWriter
+from tactic_accumulator import TacticMatrixAccumulator
 
 class RandomWalkGenerator(object):
-	def __init__(self, show=True):
+	def __init__(self, show=True, techniqueCache=None, netflowModel=None):
 		"""
 		@show: Whether or not to show the networkx plot of the network 
+		@techniqueCache: Optional TechniqueCache from which techniques are drawn offline. If None, every step queries the MITRE TAXII server.
+		@netflowModel: Optional NetFlowModel whose host graph is walked instead of the testbed graph of _build_cyber_graph(), with
+					execution-capable hosts and entry points read from its vertex flags, per NetFlowModel.GetWalkTopology()
 		"""
-		self._collection = Collection("https://cti-taxii.mitre.org/stix/collections/95ecc380-afe9-11e4-9b6c-751b66dd541e/")
-		self._tc_source = TAXIICollectionSource(self._collection)
+		self._techniqueCache = techniqueCache
+		if techniqueCache is None:
+			self._collection = Collection("https://cti-taxii.mitre.org/stix/collections/95ecc380-afe9-11e4-9b6c-751b66dd541e/")
+			self._tc_source = TAXIICollectionSource(self._collection)
 		self._stepLimit = 50 #max steps to walk on each walk
 		self._show = show
 		self._walkFile = "walks.py"
+		self._startHost = "fw1"
+		self._execNodes = set(["hmi", "scada", "gw", "relay1", "relay2", "relay3", "relay4", "relay5", "relay6", "relay7", "relay8", "relay9"])
+		self._entryHosts = [self._startHost]
+		#the (hosts, indptr, indices) CSR adjacency of the netflow host graph, if walking it rather than the testbed
+		self._topology = None
+		self._cyberGraph = None
+		if netflowModel is not None:
+			self._topology, execHosts, entryHosts = netflowModel.GetWalkTopology()
+			self._execNodes = set(execHosts)
+			self._entryHosts = list(entryHosts)
+		#only four are of interest currently: discovery, lateral movement, execution, and privilege escalation. These must match the spelling of these tactics as received from MITRE
+		self._tacticIndex = {"discovery" : 0, "lateral-movement" : 1 , "privilege-escalation" : 2, "execution" : 3}
+		self._relationalDiscoveryTechniques = ["Network Service Scanning", "Network Share Discovery", "System Network Connections Discovery", "Remote System Discovery"]
 
 	def _print_stage(self, n, state, curr, attack_path, tactic, techStr, techId, techName):
 		print("#" + str(n))
@@ -32,8 +59,11 @@ class RandomWalkGenerator(object):
 			print("	  Data Source: None")
 		print("")
 
-	#Query MITRE ATT&CK API
-	def _get_technique(self, tactic):
+	#Query MITRE ATT&CK API, or the local technique cache
+	def _get_techniques(self, tactic):
+		if self._techniqueCache is not None:
+			return self._techniqueCache.GetTechniques(tactic)
+
 		techs = self._tc_source.query([
 			Filter('type', '=', 'attack-pattern'),
 			Filter('kill_chain_phases.phase_name', '=', tactic)
@@ -43,20 +73,26 @@ class RandomWalkGenerator(object):
 			'kill_chain_name' : 'mitre-attack',
 			'phase_name' : tactic,
 		} in t.kill_chain_phases]
-		
+
+		return techs_list
+
+	def _get_technique(self, tactic):
+		techs_list = self._get_techniques(tactic)
 		randnum = rd.randint(0, len(techs_list)-1)
 		return techs_list[randnum]
 
-	def _markov_analysis(self, state):
-
+	def _getTacticTransitionMatrix(self):
 		#			   D,  PE,  LM,  E
 		#v = np.matrix([[1,  0,   0,   0]])
 
-		P = np.matrix([ [.33, .33, .33, 0.0],
+		return np.matrix([ [.33, .33, .33, 0.0],
 						[.33, 0.0, .33, .33],
 						[.33, .33, 0.0, .33],
 						[0.0, 0.0, 0.0, 0.0]])
 
+	def _markov_analysis(self, state):
+		P = self._getTacticTransitionMatrix()
+
 		base=0
 		rand=rd.random()
 		for j in range(4):
@@ -68,6 +104,9 @@ class RandomWalkGenerator(object):
 		return state
 
 	def _build_cyber_graph(self):
+		if self._topology is not None:
+			return self._build_netflow_graph()
+
 		C = nx.Graph()
 		#Control Center
 		C.add_node("scada")
@@ -103,6 +142,16 @@ class RandomWalkGenerator(object):
 			plt.show()
 		
 		return C
+
+	def _build_netflow_graph(self):
+		#The netflow host graph, as a networkx graph for the per-walk script; built once, since it may have thousands of hosts
+		if self._cyberGraph is None:
+			hosts, indptr, indices = self._topology
+			C = nx.DiGraph()
+			C.add_nodes_from(hosts)
+			C.add_edges_from((hosts[i], hosts[j]) for i in range(len(hosts)) for j in indices[indptr[i]:indptr[i+1]])
+			self._cyberGraph = C
+		return self._cyberGraph
 		
 	def _build_step(self, n, state, curr, attack_path, tactic, techStr, techId, techName):
 		#Just build a representation containing all data for one attack step
@@ -128,8 +177,9 @@ class RandomWalkGenerator(object):
 		"""
 		### Init Graph ####
 		C = self._build_cyber_graph()
-		curr = "fw1"
-		exec_nodes = set(["hmi", "scada", "gw", "relay1", "relay2", "relay3", "relay4", "relay5", "relay6", "relay7", "relay8", "relay9"])
+		#a single entry host takes no random draw, so seeded walks match those from before multiple entry hosts were supported
+		curr = rd.choice(self._entryHosts) if len(self._entryHosts) > 1 else self._entryHosts[0]
+		exec_nodes = self._execNodes
 		attack_path = set([curr])
 
 		### Init Markov Model ####
@@ -208,7 +258,7 @@ class RandomWalkGenerator(object):
 				state = self._markov_analysis(prv_state)
 		return path
 		
-	def BuildRandomWalkMatrix(self, hostWhitelist=None):
+	def BuildRandomWalkMatrix(self, hostWhitelist=None, analytic=False, tolerance=None, piFunction=None, piTolerance=None):
 		"""
 		This class models a distribution over behavior over tactics, given the host model we have provided.
 		We can generate a single walk with GenerateWalk(), but also want to simulate many walks, to evaluate
@@ -217,9 +267,20 @@ class RandomWalkGenerator(object):
 		defined by the distribution fixed by this class. 
 		
 		@hostWhitelist: A list of hosts (by name) to include. Any missing hosts are simply removed from the matrix.
+		@analytic: If true, compute the expected matrix of a single walk exactly with _buildMatrixAnalytically(), instead of
+					counting over the sampled walks in the walk file. Since the matrix is only used up to row normalization,
+					the two agree up to sampling noise and a factor of the number of walks.
+		@tolerance: If given, sample walks until the matrix has converged to this precision, per SampleRandomWalkMatrixUntilConverged(),
+					instead of reading the walk file. @piFunction and @piTolerance are passed along.
 		"""
-		
-		matrix, hostIndex, tacticIndex = self._buildMatrixFromWalks()
+
+		if analytic:
+			matrix, hostIndex, tacticIndex = self._buildMatrixAnalytically()
+		elif tolerance is not None:
+			accumulator, stats = self.SampleRandomWalkMatrixUntilConverged(tolerance, piFunction=piFunction, piTolerance=piTolerance)
+			matrix, hostIndex, tacticIndex = accumulator.Snapshot()
+		else:
+			matrix, hostIndex, tacticIndex = self._buildMatrixFromWalks()
 		if hostWhitelist is not None:
 			print("Filtering walk matrix with whitelist: {}".format(hostWhitelist))
 			matrix, hostIndex = self._filterWalkMatrix(matrix, hostIndex, hostWhitelist)
@@ -241,22 +302,8 @@ class RandomWalkGenerator(object):
 		Returns: @M_filtered, a matrix consisting only of the host rows/cols included in hostWhitelist,
 				@hostIndex_filtered: The same as @hostIndex, but with only the hosts in @hostWhitelist
 		"""
-		n = len(hostWhitelist)
-		numTactics = M.shape[2]
-		M_filtered = np.zeros(shape=(n,n,numTactics))
-		#build the filtered hostIndex
-		filteredIndex = dict((host, i) for i, host in enumerate(hostWhitelist))
-		
-		for host in hostWhitelist:
-			h_i = hostIndex[host]
-			h_f_i = filteredIndex[host]
-			
-			for neighbor in hostWhitelist:
-				n_i = hostIndex[neighbor]
-				n_f_i = filteredIndex[neighbor]
-				M_filtered[h_f_i, n_f_i, :] = M[h_i, n_i, :]
-		
-		return M_filtered, filteredIndex
+		filtered = HostTensor(M, hostIndex).Filter(hostWhitelist)
+		return filtered.Matrix, filtered.HostIndex
 
 	def _buildMatrixFromWalks(self):
 		"""
@@ -278,83 +325,248 @@ class RandomWalkGenerator(object):
 		[{'technique_id': 'attack-pattern--15dbf668-795c-41e6-8219-f0447c0e64ce', 'host': 'fw1', 'technique_name': 'Permission Groups Discovery', 'tactic': 'discovery', 'attack_path': "set(['fw1'])", 'technique_data_source': "[u'API monitoring', u'Process command-line parameters', u'Process monitoring']"}, {'technique_id': 'attack-pattern--9b99b83a-1aac-4e29-b975-b374950551a3', 'host': 'fw1', 'technique_name': 'Accessibility Features', 'tactic': 'privilege-escalation', 'attack_path': "set(['fw1'])", 'technique_data_source': "[u'Windows Registry', u'File monitoring', u'Process monitoring']"}, {'technique_id': 'attack-pattern--a257ed11-ff3b-4216-8c9d-3938ef57064c', 'host': 'sw1', 'technique_name': 'Pass the Ticket', 'tactic': 'lateral-movement', 'attack_path': "set(['sw1', 'fw1'])", 'technique_data_source': "[u'Authentication logs']"}, {'technique_id': 'attack-pattern--b17a1a56-e99c-403c-8948-561df0cffe81', 'host': 'sw1', 'technique_name': 'Valid Accounts', 'tactic': 'privilege-escalation', 'attack_path': "set(['sw1', 'fw1'])", 'technique_data_source': "[u'Authentication logs', u'Process monitoring']"}, {'technique_id': 'attack-pattern--241814ae-de3f-4656-b49e-f9a80764d4b7', 'host': 'sw1', 'technique_name': 'Security Software Discovery', 'tactic': 'discovery', 'attack_path': "set(['sw1', 'fw1'])", 'technique_data_source': "[u'File monitoring', u'Process command-line parameters', u'Process monitoring']"}, {'technique_id': 'attack-pattern--ffe742ed-9100-4686-9e00-c331da544787', 'host': 'eng', 'technique_name': 'Windows Admin Shares', 'tactic': 'lateral-movement', 'attack_path': "set(['sw1', 'fw1', 'eng'])", 'technique_data_source': "[u'Process use of network', u'Authentication logs', u'Process command-line parameters', u'Process monitoring']"}, {'technique_id': 'attack-pattern--3489cfc5-640f-4bb3-a103-9137b97de79f', 'host': 'eng', 'technique_name': 'Network Share Discovery', 'tactic': 'discovery', 'attack_path': "set(['sw1', 'fw1', 'eng'])", 'technique_data_source': "[u'Process Monitoring', u'Process command-line parameters', u'Network protocol analysis', u'Process use of network']"}, {'technique_id': 'attack-pattern--c3bce4f4-9795-46c6-976e-8676300bbc39', 'host': 'hmi', 'technique_name': 'Windows Remote Management', 'tactic': 'lateral-movement', 'attack_path': "set(['sw1', 'fw1', 'hmi', 'eng'])", 'technique_data_source': "[u'File monitoring', u'Authentication logs', u'Netflow/Enclave netflow', u'Process command-line parameters', u'Process monitoring']"}, {'technique_id': 'attack-pattern--4ae4f953-fe58-4cc8-a327-33257e30a830', 'host': 'hmi', 'technique_name': 'Application Window Discovery', 'tactic': 'discovery', 'attack_path': "set(['sw1', 'fw1', 'hmi', 'eng'])", 'technique_data_source': "[u'API monitoring', u'Process command-line parameters', u'Process monitoring']"}, {'technique_id': 'attack-pattern--8f4a33ec-8b1f-4b80-a2f6-642b2e479580', 'host': 'hmi', 'technique_name': 'Process Discovery', 'tactic': 'discovery', 'attack_path': "set(['sw1', 'fw1', 'hmi', 'eng'])", 'technique_data_source': "[u'Process command-line parameters', u'Process monitoring']"}, {'technique_id': 'attack-pattern--7c93aa74-4bc0-4a9e-90ea-f25f86301566', 'host': 'hmi', 'technique_name': 'Application Shimming', 'tactic': 'privilege-escalation', 'attack_path': "set(['sw1', 'fw1', 'hmi', 'eng'])", 'technique_data_source': "[u'Loaded DLLs', u'System calls', u'Windows Registry', u'Process Monitoring', u'Process command-line parameters']"}, {'technique_id': 'attack-pattern--62b8c999-dcc0-4755-bd69-09442d9359f5', 'host': 'hmi', 'technique_name': 'Rundll32', 'tactic': 'execution', 'attack_path': "set(['sw1', 'fw1', 'hmi', 'eng'])", 'technique_data_source': "[u'File monitoring', u'Binary file metadata', u'Process command-line parameters', u'Process monitoring']"}]
 		"""
 		
-		#only four are of interest currently: discovery, lateral movement, execution, and privilege escalation. These must match the spelling of these tactics as received from MITRE
-		tacticIndex = {"discovery" : 0, "lateral-movement" : 1 , "privilege-escalation" : 2, "execution" : 3}
-		relational_discovery_techniques = ["Network Service Scanning", "Network Share Discovery", "System Network Connections Discovery", "Remote System Discovery"]
-		
-		walks = self._getWalks(self._walkFile)
-		#build the host index, mapping host names to their row/col index in the matrix
-		rowIndex = 0
-		hostIndex = dict()
-		for walk in walks:
-			for step in walk:
-				host = step["host"]
-				if host not in hostIndex.keys():
-					hostIndex[host] = rowIndex
-					rowIndex += 1
-
-		#print("HOST INDEX: {}".format(hostIndex))
-		#build the matrix itself
-		n = len(hostIndex.keys())
-		numTactics = len(tacticIndex.keys())
-		M = np.zeros(shape=(n,n,numTactics), dtype=np.float)
-		
-		for walk in walks:
-			for i in range(len(walk)):
-				step = walk[i]
-				host = step["host"]
-				tactic = step["tactic"]
-				if tactic in tacticIndex:
-					tactic_i = tacticIndex[tactic]
-					host_i = hostIndex[host]
-					#these two tactics are currently treated as intra-host/non-relational, although instances of Discovery can clearly be both: querying a host's registry, or scanning for neighbor systems, and so forth.
-					if tactic in ["discovery", "privilege-escalation", "execution"]:
-						#intra host, so this is a diagonal element in the event matrix
-						M[host_i, host_i, tactic_i] += 1.0
-					if tactic in ["lateral-movement", "discovery"]:
-						if i > 0: #make sure we're not at start of walk, and have a previous step; for l.m. the walks were recorded as 'lateral-movement' via the previous host/step in the walk
-							#lateral movement is a straightfoward case of counting transitions from last host to current host
-							if tactic == "lateral-movement":
-								prevStep = walk[i-1]
-								src_i = hostIndex[ prevStep["host"] ]
-								M[src_i, host_i, tactic_i] += 1.0
-								M[src_i, src_i, tactic_i] += 1.0
-							#only a subset of Discovery techniques are relational/transitional in nature (e.g. network scanning activity, service discovery, etc)
-							elif tactic == "discovery" and step["technique_name"] in relational_discovery_techniques:
-								prevStep = walk[i-1]
-								src_i = hostIndex[ prevStep["host"] ]
-								M[src_i, host_i, tactic_i] += 1.0
-						#else:
-						#	print("Discarding lateral movement tactic step at begining of walk... not an error, just making it known.")
-					#else:
-					#	print("Tactic >{}< not found in _buildMatrixFromWalks".format(tactic))
+		accumulator = self.GetTacticAccumulator()
+		if os.path.isdir(self._walkFile):
+			accumulator.AddCorpusReader(WalkCorpusReader(self._walkFile))
+		else:
+			for walk in self._getWalks(self._walkFile):
+				accumulator.AddWalk(walk)
+
+		return accumulator.Snapshot()
+
+	def GetHosts(self):
+		#Returns the names of the hosts walks move on
+		if self._topology is not None:
+			return list(self._topology[0])
+		return list(self._build_cyber_graph().nodes())
+
+	def GetTacticIndex(self):
+		return dict(self._tacticIndex)
+
+	def GetTacticAccumulator(self):
+		#Returns an empty TacticMatrixAccumulator counting this generator's tactics, to which walks can be added as they are generated
+		return TacticMatrixAccumulator(self._tacticIndex, self._relationalDiscoveryTechniques)
+
+	def _localStateIndex(self, state, prvState, disc, privEsc):
+		return ((state * 4 + prvState) * 4 + disc) * 2 + privEsc
+
+	def _buildLocalWalkChain(self, hasAvail, hasExec):
+		"""
+		Between lateral movements, a walk in _generateWalk() evolves by a small Markov chain over its local state: the current
+		and previous tactic states (0-3 for D, PE, LM, E), the discovery counter (capped at 3, where it always fails) and the
+		privilege-escalation flag. The host's position only enters through whether lateral movement can succeed (@hasAvail:
+		an unvisited neighbor exists) and whether execution can (@hasExec: the attack path contains an exec node).
+
+		Returns, for one loop iteration from each of the 128 local states:
+			@Q: 128 x 128 probabilities of staying on the host in each next local state
+			@exits: probabilities of a successful lateral movement, which moves the walk to a new host
+			@successes: 128 x numTactics probabilities of recording a discovery, privilege-escalation or execution step on the host
+		Whatever probability mass is left (successful execution) ends the walk.
+		"""
+		#the sampler falls through to the last tactic when its uniform draw exceeds a row's (rounded) sum
+		P = np.asarray(self._getTacticTransitionMatrix(), dtype=np.float64)
+		P[:,3] = 1.0 - P[:,:3].sum(axis=1)
+		tacticOf = ["discovery", "privilege-escalation", "lateral-movement", "execution"]
+
+		Q = np.zeros((128, 128))
+		exits = np.zeros(128)
+		successes = np.zeros((128, len(self._tacticIndex)))
+		for state in range(4):
+			for prvState in range(4):
+				for disc in range(4):
+					for privEsc in range(2):
+						i = self._localStateIndex(state, prvState, disc, privEsc)
+						nextDisc, nextPrivEsc = disc, privEsc
+						if state == 0:
+							nextDisc = min(disc + 1, 3)
+							success = disc + 1 < 3
+						elif state == 1:
+							success = privEsc == 0
+							nextPrivEsc = 1
+						elif state == 2:
+							exits[i] = 1.0 if hasAvail else 0.0
+							success = hasAvail
+						else:
+							success = hasExec
+
+						if success:
+							if state != 2:
+								successes[i, self._tacticIndex[tacticOf[state]]] = 1.0
+							if state in [0, 1]:
+								for nextState in range(4):
+									Q[i, self._localStateIndex(nextState, state, nextDisc, nextPrivEsc)] += P[state, nextState]
+						else:
+							#failed steps resample from the last successful step's state, and keep the previous counters
+							for nextState in range(4):
+								Q[i, self._localStateIndex(nextState, prvState, nextDisc, privEsc)] += P[prvState, nextState]
+
+		return Q, exits, successes
+
+	def _getRelationalDiscoveryRate(self):
+		#The probability that a sampled discovery technique is relational, per the MITRE discovery techniques _get_technique() draws from
+		names = [str(tech['name']) for tech in self._get_techniques("discovery")]
+		return float(sum(1 for name in names if name in self._relationalDiscoveryTechniques)) / len(names)
+
+	def _buildMatrixAnalytically(self, stepLimit=-1, relationalDiscoveryRate=None):
+		"""
+		Computes the expectation, over a single walk of _generateWalk(), of the matrix _buildMatrixFromWalks() counts, exactly.
+
+		A walk is a Markov chain over (attack path, current host, local state), and it factors into two parts. On each host it
+		runs the small local chain of _buildLocalWalkChain(), which depends on the attack path only via two flags, until it
+		either moves laterally or ends by execution. Each lateral move enters a uniformly chosen unvisited neighbor with a fixed
+		local state distribution. The attack path only grows, so the (path, host) states form a DAG, and the probability of
+		arriving at each of them is propagated level by level; each host's expected step counts are then its arrival
+		probability times the local chain's expected successes.
+
+		With no step limit, the local chain's expected successes and exits come from its fundamental matrix (I - Q)^-1, one
+		128 x 128 solve per flag combination. With a step limit, arrivals are tracked per loop iteration, and the local chain's
+		per-iteration successes and exits are convolved with them, such that the step limit is respected exactly.
+
+		The DAG has a state per reachable attack path, so this is only tractable for small host graphs like the testbed; walks
+		on the netflow topology should be sampled with SampleRandomWalkMatrixUntilConverged() instead.
+
+		@stepLimit: The number of loop iterations per walk; -1 for self._stepLimit, None for unlimited walks.
+		@relationalDiscoveryRate: The probability a discovery step is one of the relational techniques. Defaults to the
+					fraction of MITRE discovery techniques that are, per _getRelationalDiscoveryRate().
+
+		Returns: @M, @hostIndex, and @tacticIndex as in _buildMatrixFromWalks(), but with expected counts per walk.
+		"""
+		if stepLimit == -1:
+			stepLimit = self._stepLimit
+		if relationalDiscoveryRate is None:
+			relationalDiscoveryRate = self._getRelationalDiscoveryRate()
+		tacticIndex = dict(self._tacticIndex)
+		C = self._build_cyber_graph()
+		hosts = list(C.nodes())
+		bits = dict((host, i) for i, host in enumerate(hosts))
+		neighborMasks = [sum(1 << bits[v] for v in C.adj[host]) for host in hosts]
+		execMask = sum(1 << bits[host] for host in self._execNodes if host in bits)
+		n = len(hosts)
+
+		#local chain responses per (arrival distribution, flags): expected successes per tactic and expected exits, per iteration if limited
+		start = np.zeros(128)
+		start[self._localStateIndex(0, 0, 0, 0)] = 1.0
+		P = np.asarray(self._getTacticTransitionMatrix(), dtype=np.float64)
+		arrival = np.zeros(128)
+		for nextState in range(4):
+			arrival[self._localStateIndex(nextState, 2, 0, 0)] = P[2, nextState] if nextState < 3 else 1.0 - P[2,:3].sum()
+		responses = dict()
+		def respond(dist, isStart, hasAvail, hasExec):
+			key = (isStart, hasAvail, hasExec)
+			if key not in responses:
+				Q, exits, successes = self._buildLocalWalkChain(hasAvail, hasExec)
+				if stepLimit is None:
+					#solve only over the local states reachable from @dist; some unreachable ones (e.g. a previous state of E) never leave
+					reachable = dist > 0
+					while True:
+						grown = reachable | (Q[reachable] > 0).any(axis=0)
+						if (grown == reachable).all():
+							break
+						reachable = grown
+					ids = np.flatnonzero(reachable)
+					visits = np.zeros(128)
+					try:
+						visits[ids] = np.linalg.solve((np.eye(len(ids)) - Q[np.ix_(ids, ids)]).T, dist[ids])
+					except np.linalg.LinAlgError:
+						print("ERROR walk can loop forever on a host without moving or executing; a step limit is required")
+						raise Exception("Unbounded walk in _buildMatrixAnalytically")
+					responses[key] = (visits.dot(successes), visits.dot(exits))
 				else:
-					print("WARNING tactic >{}< not in tacticIndex. Likely not supported.".format(tactic))
+					succSeq = np.zeros((stepLimit, successes.shape[1]))
+					exitSeq = np.zeros(stepLimit)
+					x = dist
+					for k in range(stepLimit):
+						succSeq[k] = x.dot(successes)
+						exitSeq[k] = x.dot(exits)
+						x = x.dot(Q)
+					#expected successes given arrival at iteration t are the cumulative successes over the remaining iterations
+					responses[key] = (np.cumsum(succSeq, axis=0)[::-1], exitSeq)
+			return responses[key]
+
+		M = np.zeros(shape=(n, n, len(tacticIndex)), dtype=np.float64)
+		#walks start at a uniformly chosen entry host
+		starts = sorted(set(bits[host] for host in self._entryHosts))
+		startMass = 1.0 / len(starts)
+		if stepLimit is None:
+			level = dict(((1 << s, s), startMass) for s in starts)
+		else:
+			level = dict(((1 << s, s), startMass * np.eye(1, max(stepLimit, 1)).ravel()) for s in starts)
+		isStart = True
+		while len(level) > 0:
+			nextLevel = dict()
+			reachCache = dict()
+			for (path, curr), mass in level.items():
+				if path not in reachCache:
+					reach = 0
+					for i in range(n):
+						if path >> i & 1:
+							reach |= neighborMasks[i]
+					reachCache[path] = reach & ~path
+				avail = reachCache[path]
+				succ, exitResponse = respond(start if isStart else arrival, isStart, avail != 0, (path & execMask) != 0)
+				if stepLimit is None:
+					expected = mass * succ
+					moves = mass * exitResponse
+					childMass = moves
+				else:
+					expected = mass.dot(succ)
+					moveSeq = np.convolve(mass, exitResponse)[:stepLimit]
+					moves = moveSeq.sum()
+					#a move at iteration t arrives for iteration t+1
+					childMass = np.concatenate(([0.0], moveSeq[:-1]))
+				M[curr, curr, tacticIndex["discovery"]] += expected[tacticIndex["discovery"]] * (1.0 + relationalDiscoveryRate)
+				M[curr, curr, tacticIndex["privilege-escalation"]] += expected[tacticIndex["privilege-escalation"]]
+				M[curr, curr, tacticIndex["execution"]] += expected[tacticIndex["execution"]]
+				if moves > 0:
+					children = [i for i in range(n) if avail >> i & 1]
+					M[curr, curr, tacticIndex["lateral-movement"]] += moves
+					for child in children:
+						M[curr, child, tacticIndex["lateral-movement"]] += moves / len(children)
+						key = (path | (1 << child), child)
+						if stepLimit is None or childMass.any():
+							nextLevel[key] = nextLevel.get(key, 0.0) + childMass / len(children)
+			level = nextLevel
+			isStart = False
+
+		#the first step of every walk is a discovery, which is never counted as relational since it has no previous step
+		if stepLimit is None or stepLimit > 0:
+			for s in starts:
+				M[s, s, tacticIndex["discovery"]] -= relationalDiscoveryRate * startMass
+
+		visited = [i for i in range(n) if M[i].any() or M[:,i].any()]
+		hostIndex = dict((hosts[i], k) for k, i in enumerate(visited))
+		M = M[np.ix_(visited, visited)]
 
 		return M, hostIndex, tacticIndex
 
 	def _getWalks(self, walkPath):
+		#@walkPath may also be a walk corpus directory, per walk_corpus.py
+		if os.path.isdir(walkPath):
+			return list(WalkCorpusReader(walkPath).GetWalks())
+
 		walks = []
 		
 		with open(walkPath, "r") as ifile:
 			for line in ifile:
 				if len(line.strip()) > 0:
 					try:
-						walk = eval(line.strip())
+						walk = ast.literal_eval(line.strip())
 						walks.append(walk)
-					except:
+					except (ValueError, SyntaxError):
 						print("WARNING there was an issue evaluating walk in _buildMatrixFromWalks: "+line)
 		
 		return walks
 		
-	def GenerateKWalks(self, k, outPath=None, newWalks=True):
+	def GenerateKWalks(self, k, outPath=None, newWalks=True, accumulator=None, writeWalks=True):
 		"""
 		Generates k walks, each a list as returned by GenerateWalk, then stores these at @outPath.
 		Storage allows separating the construction of walks (which can take considerably time) from
 		the construction of a frequency matrix per those walks. The walks are just serialized in python
-		form, and can be re-read in with eval(line) for each line in the file.
+		form, and can be re-read in with ast.literal_eval(line) for each line in the file.
 		
 		@newWalks: If true, open the output file for write, effectively blowing away old walks. Else, append to current file.
+		@accumulator: Optional TacticMatrixAccumulator (see GetTacticAccumulator()) to which each walk is added as it is generated
+		@writeWalks: If false, walks are only added to @accumulator and no walk file is written
 		"""
 		if outPath is None:
 			outPath = self._walkFile
@@ -364,10 +576,141 @@ class RandomWalkGenerator(object):
 		else:
 			mode = "a+"
 		
-		with open(outPath, mode) as ofile:
-			for i in range(k):
-				walk = self.GenerateWalk()
+		ofile = open(outPath, mode) if writeWalks else None
+		for i in range(k):
+			walk = self.GenerateWalk()
+			if accumulator is not None:
+				accumulator.AddWalk(walk)
+			if ofile is not None:
 				ofile.write(str(walk)+"\n")
+		if ofile is not None:
+			ofile.close()
+
+	def SampleRandomWalkMatrix(self, k, seed=None, batchSize=10000, accumulator=None):
+		"""
+		Estimates the tactic frequency matrix from @k walks simulated in batches of @batchSize by a BatchWalkSimulator and
+		counted as they are generated, without writing a walk file.
+
+		@accumulator: Optional TacticMatrixAccumulator to continue counting into; a new one is created if None
+
+		Returns: The TacticMatrixAccumulator, whose Snapshot() is the matrix, host index and tactic index.
+		"""
+		if accumulator is None:
+			accumulator = self.GetTacticAccumulator()
+		simulator = self.GetBatchSimulator()
+		rng = np.random.RandomState(seed)
+		for first in range(0, k, batchSize):
+			#each batch gets its own seed drawn from @seed, so the result does not depend on how batches are split internally
+			accumulator.AddWalkCorpus(simulator.Simulate(min(batchSize, k - first), seed=rng.randint(2**31 - 1)))
+
+		return accumulator
+
+	def _halfWidth(self, sums, sumSquares, numBatches, confidence):
+		#Batch-means confidence interval half-widths of the means of @numBatches batch estimates, from their running sums and sums of squares
+		mean = sums / numBatches
+		variance = np.maximum(sumSquares - numBatches * mean * mean, 0.0) / (numBatches - 1)
+		return scipy.stats.t.ppf(0.5 + confidence / 2.0, numBatches - 1) * np.sqrt(variance / numBatches)
+
+	def SampleRandomWalkMatrixUntilConverged(self, tolerance=0.01, piFunction=None, piTolerance=None, batchSize=1000, minBatches=10, maxWalks=1000000, confidence=0.95, seed=None):
+		"""
+		Samples walks in batches until the tactic frequency matrix is estimated to a target precision, by the method of batch
+		means: each batch of @batchSize walks gives an independent estimate, and the spread of the batch estimates gives a
+		confidence interval for their mean.
+
+		The estimate tracked is the normalized tactic tensor, each host's row of counts divided by its total over destinations
+		and tactics, i.e. the probability that a step from that host is a given (destination, tactic). Sampling stops once the
+		confidence interval of every entry is within +/- @tolerance.
+
+		@piFunction: Optional function of (M, hostIndex), a tactic count matrix and its host index as from Snapshot(), returning a
+					fixed-length vector, such as the stationary attack distribution built from that matrix. If given, its
+					batch estimates must also be within +/- @piTolerance.
+		@piTolerance: Precision for @piFunction's output; defaults to @tolerance
+		@minBatches: Batches sampled before testing convergence, so the interval estimates are meaningful
+		@maxWalks: Sampling stops at this many walks, converged or not
+		@confidence: Confidence level of the intervals
+
+		Returns: The TacticMatrixAccumulator of all sampled walks, and @stats, a dict of "walks", "batches", "converged",
+				"tensorHalfWidth" and "piHalfWidth" (the largest interval half-widths, the latter None without @piFunction), and "time".
+		"""
+		start = time.time()
+		if piTolerance is None:
+			piTolerance = tolerance
+		simulator = self.GetBatchSimulator()
+		rng = np.random.RandomState(seed)
+		accumulator = self.GetTacticAccumulator()
+		#running sums (and sums of squares) of the batch estimates; tensor entries keyed by (src, dst, tactic) per @accumulator's host ids
+		tensorSums, tensorSquares = dict(), dict()
+		piSums, piSquares = 0.0, 0.0
+		tensorHalfWidth, piHalfWidth = np.inf, None
+		numBatches = 0
+		converged = False
+		while not converged and accumulator.NumWalks < maxWalks:
+			batch = self.GetTacticAccumulator()
+			batch.AddWalkCorpus(simulator.Simulate(min(batchSize, maxWalks - accumulator.NumWalks), seed=rng.randint(2**31 - 1)))
+			hostMap = accumulator.AddAccumulator(batch)
+			numBatches += 1
+
+			src, dst, tactic, counts = batch.GetSparseCounts()
+			rowTotals = np.bincount(src, weights=counts, minlength=len(hostMap))
+			estimates = counts / rowTotals[src]
+			for key, estimate in zip(zip(hostMap[src].tolist(), hostMap[dst].tolist(), tactic.tolist()), estimates.tolist()):
+				tensorSums[key] = tensorSums.get(key, 0.0) + estimate
+				tensorSquares[key] = tensorSquares.get(key, 0.0) + estimate * estimate
+			if piFunction is not None:
+				M, hostIndex, tacticIndex = batch.Snapshot()
+				pi = np.asarray(piFunction(M, hostIndex), dtype=np.float64)
+				piSums, piSquares = piSums + pi, piSquares + pi * pi
+
+			if numBatches >= max(minBatches, 2):
+				#entries missing from a batch are zero estimates, which add nothing to the sums
+				tensorHalfWidth = np.max(self._halfWidth(np.array(list(tensorSums.values())), np.array(list(tensorSquares.values())), numBatches, confidence))
+				converged = bool(tensorHalfWidth <= tolerance)
+				if piFunction is not None:
+					piHalfWidth = np.max(self._halfWidth(piSums, piSquares, numBatches, confidence))
+					converged = converged and bool(piHalfWidth <= piTolerance)
+
+		stats = {"walks" : accumulator.NumWalks, "batches" : numBatches, "converged" : converged, "tensorHalfWidth" : float(tensorHalfWidth),
+				"piHalfWidth" : None if piHalfWidth is None else float(piHalfWidth), "time" : time.time() - start}
+		print("Walk sampling {} after {} walks ({} batches): tensor +/-{:.4f}, pi +/-{}, {:.3f}s".format("converged" if converged else "did NOT converge",
+			stats["walks"], numBatches, stats["tensorHalfWidth"], "n/a" if piHalfWidth is None else "{:.4f}".format(piHalfWidth), stats["time"]))
+
+		return accumulator, stats
+
+	def GetBatchSimulator(self):
+		#Returns a BatchWalkSimulator running the same walk script as _generateWalk(), drawing techniques from the technique cache if any
+		graph = self._topology if self._topology is not None else self._build_cyber_graph()
+		return BatchWalkSimulator(graph, self._entryHosts, self._execNodes, self._getTacticTransitionMatrix(),
+								self._tacticIndex, stepLimit=self._stepLimit, techniqueCache=self._techniqueCache)
+
+	def GenerateKWalksBatch(self, k, outPath=None, newWalks=True, seed=None, corpus=False):
+		"""
+		The same as GenerateKWalks(), but all @k walks are simulated together by a BatchWalkSimulator. Techniques are
+		drawn only if this generator has a technique cache; otherwise the technique fields of each step are empty.
+
+		@seed: Optional seed, for reproducible walks
+		@corpus: If true, @outPath is written as a binary walk corpus directory (see walk_corpus.py) instead of a walk file
+		"""
+		if outPath is None:
+			outPath = self._walkFile
+
+		walks = self.GetBatchSimulator().Simulate(k, seed=seed)
+		if corpus:
+			writer = WalkCorpusWriter(outPath, append=not newWalks)
+			writer.WriteWalkCorpus(walks)
+			writer.Close()
+		else:
+			walks.WriteWalkFile(outPath, mode = "w+" if newWalks else "a+")
+
+	def GenerateKWalksParallel(self, k, outPath=None, newWalks=True, seed=0, shardSize=10000, numWorkers=None, corpus=False):
+		"""
+		The same as GenerateKWalksBatch(), but the walks are generated in shards over a process pool, per
+		BatchWalkSimulator.SimulateParallel(). The output depends only on @k, @seed and @shardSize, so runs are reproducible
+		regardless of @numWorkers.
+		"""
+		if outPath is None:
+			outPath = self._walkFile
+
+		self.GetBatchSimulator().SimulateParallel(k, outPath, seed=seed, shardSize=shardSize, numWorkers=numWorkers, mode = "w+" if newWalks else "a+", corpus=corpus)
 
 	def GenerateWalk(self):
 		success = False
@@ -388,7 +731,7 @@ class RandomWalkGenerator(object):
 		
 def main():
 	#whitelist = ["relay6", "relay1", "relay2", "gw", "fw1"]
-	generator = RandomWalkGenerator(show=False)
+	generator = RandomWalkGenerator(show=False, techniqueCache=TechniqueCache("enterprise-attack.json"))
 	generator.GenerateKWalks(1000, newWalks=True)
 	
 	"""
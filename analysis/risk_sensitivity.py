@@ -0,0 +1,194 @@
+"""
+What-if analysis over the risk model built by ModelAnalyzer.AnalyzeStationaryAttackDistribution(). Given the aligned
+tactic matrix E_risk = D_attack * D_system and its stochastic aggregate M_risk with stationary distribution pi, this
+answers questions like "how does risk change if a sensor is added to host h, or port p is blocked on edge (i,j)?"
+for many candidate changes at once.
+
+Every candidate is expressed as a set of scalings of E_risk entries (i, j, tactic) -> factor. Rather than rebuilding
+M_risk and re-solving for pi per candidate, the change in risk is estimated to first order with the fundamental matrix
+of the chain (see Meyer, "The role of the group generalized inverse in the theory of finite Markov chains"):
+
+	pi' - pi ~= pi * dM * Z,		where Z = (I - M + 1 pi)^-1
+
+The risk of a distribution is r = pi * w for some per-host weights w, so the change in risk is dr ~= (pi * dM) * (Z w).
+Z w is a single linear solve shared by all candidates, after which each candidate only costs the E_risk entries it
+changes: row i of M_risk is E_agg[i] / s_i, with s_i the row sum, so for changes delta_ij to the entries of row i,
+
+	dM[i] * Zw = (E_agg[i] * Zw + sum_j delta_ij Zw[j]) / (s_i + sum_j delta_ij) - M[i] * Zw
+
+where E_agg * Zw and M * Zw are computed once. The top-ranked candidates can then be verified by an exact, warm-started re-solve.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+class Candidate(object):
+	def __init__(self, name, rows, cols, tactics, factors):
+		"""
+		A hypothetical change to the risk model, as scalings of E_risk entries: E_risk[rows[k], cols[k], tactics[k]] *= factors[k].
+
+		@name: A description of the change, e.g. "sensor@192.168.2.10"
+		@rows, @cols, @tactics: Equal-length integer sequences indexing E_risk
+		@factors: Equal-length float sequence of scale factors, in [0, 1] for changes that reduce attack likelihood
+		"""
+		self.Name = name
+		self.Rows = np.asarray(rows, dtype=np.int64)
+		self.Cols = np.asarray(cols, dtype=np.int64)
+		self.Tactics = np.asarray(tactics, dtype=np.int64)
+		self.Factors = np.asarray(factors, dtype=np.float64)
+
+class RiskSensitivityAnalyzer(object):
+	def __init__(self, modelAnalyzer, targetWeights=None):
+		"""
+		@modelAnalyzer: A ModelAnalyzer on which AnalyzeStationaryAttackDistribution() has already been run.
+		@targetWeights: A dict of host -> weight defining risk as sum(pi[host] * weight). Hosts not listed weigh 0.
+					Defaults to each host's on-host tactic mass (the E_risk diagonal summed over tactics), i.e. how much attack
+					activity lands on the host itself. Note that uniform weights make risk constant, since pi always sums to 1.
+		"""
+		self._analyzer = modelAnalyzer
+		state = modelAnalyzer.GetRiskState()
+		if state is None:
+			raise Exception("RiskSensitivityAnalyzer requires a ModelAnalyzer with a completed stationary analysis")
+
+		self._E = state["E_risk"]
+		self._M = np.asarray(state["M_risk"], dtype=np.float64)
+		self._pi = state["pi"]
+		self._hostIndex = state["hostIndex"]
+		self._tacticIndex = state["tacticIndex"]
+		self._n = self._M.shape[0]
+		#the tactic-aggregated E_risk, whose rows are normalized into M_risk
+		self._E_agg = np.sum(self._E, axis=2)
+
+		if targetWeights is None:
+			w = np.diagonal(self._E_agg).astype(np.float64)
+		else:
+			w = np.zeros(self._n)
+			for host, weight in targetWeights.items():
+				w[self._hostIndex[host]] = weight
+		if np.ptp(w) == 0:
+			print("WARNING risk target weights are constant; every candidate will have zero effect")
+		self._w = w
+
+		#Z w, solved once: (I - M + 1 pi) x = w
+		A = np.eye(self._n) - self._M + np.outer(np.ones(self._n), self._pi)
+		self._Zw = np.linalg.solve(A, w)
+		#the per-row terms of the closed-form dM[i] * Zw; see header
+		self._rowSums = np.sum(self._E_agg, axis=1)
+		self._EZw = self._E_agg.dot(self._Zw)
+		self._MZw = self._M.dot(self._Zw)
+
+	def GetRisk(self, pi=None):
+		#Returns the risk pi * w, for the current pi if @pi is None
+		pi = self._pi if pi is None else pi
+		return float(np.dot(pi, self._w))
+
+	def SensorCandidate(self, host, tactics=None, detectionRate=0.9):
+		"""
+		Models adding a sensor to @host that detects the given @tactics (names per the tactic index; default all) with probability
+		@detectionRate. Undetected attack activity into or on @host is what remains, so every E_risk entry (i, host, tactic) for
+		the covered tactics is scaled by (1 - @detectionRate).
+		"""
+		h = self._hostIndex[host]
+		if tactics is None:
+			tactics = list(self._tacticIndex.keys())
+		ks = np.array([self._tacticIndex[tactic] for tactic in tactics], dtype=np.int64)
+		rows = np.repeat(np.arange(self._n), len(ks))
+		cols = np.full(len(rows), h)
+		tacs = np.tile(ks, self._n)
+		return Candidate("sensor@{}".format(host), rows, cols, tacs, np.full(len(rows), 1.0 - detectionRate))
+
+	def BlockPortCandidate(self, netflowModel, src, dst, port, featureModel):
+		"""
+		Models blocking @port on the edge @src -> @dst. The lateral-movement entry E_risk[src, dst] is scaled down by the share
+		of that port among the edge's flows over lateral-movement ports (per @featureModel, an AttackFeatureModel). This is an
+		approximation: the relational probability in the netflow model is the max of port and event probabilities, and only the
+		port term is reduced here.
+		"""
+		lmPorts = featureModel.GetTacticPorts("lateral_movement")
+		hist = netflowModel.GetEdgeHistogram(src, dst, "port")
+		factor = 1.0
+		if hist is not None and port in lmPorts:
+			z = float(sum(freq for p, freq in hist.items() if p in lmPorts))
+			if z > 0:
+				factor = 1.0 - hist.get(port, 0) / z
+		return Candidate("block:{}->{}:{}".format(src, dst, port), [self._hostIndex[src]], [self._hostIndex[dst]], [self._tacticIndex["lateral-movement"]], [factor])
+
+	def EvaluateCandidates(self, candidates, batchSize=256):
+		"""
+		Returns the first-order estimate of the change in risk for every candidate in @candidates, as an array aligned with it;
+		negative values are risk reductions. Candidates are evaluated in batches of @batchSize, in closed form from their
+		changed entries alone (see header), so the cost is proportional to the number of entries the candidates scale.
+		"""
+		deltas = np.zeros(len(candidates))
+		for start in range(0, len(candidates), batchSize):
+			batch = candidates[start:start+batchSize]
+			deltas[start:start+len(batch)] = self._evaluateBatch(batch)
+		return deltas
+
+	def _evaluateBatch(self, batch):
+		n = self._n
+		#flatten all scalings of the batch, tagged by candidate number
+		candIds = np.concatenate([np.full(len(c.Rows), k, dtype=np.int64) for k, c in enumerate(batch)])
+		rows = np.concatenate([c.Rows for c in batch])
+		cols = np.concatenate([c.Cols for c in batch])
+		tacs = np.concatenate([c.Tactics for c in batch])
+		factors = np.concatenate([c.Factors for c in batch])
+
+		#sum the changes per distinct (candidate, row, col) entry of E_agg, clamping the new entry at 0 as in ApplyCandidate()
+		entryKeys, entryPos = np.unique((candIds * n + rows) * n + cols, return_inverse=True)
+		delta = np.bincount(entryPos.ravel(), weights=(factors - 1.0) * self._E[rows, cols, tacs], minlength=len(entryKeys))
+		entryCols = entryKeys % n
+		pairKeys = entryKeys // n
+		entryRows = pairKeys % n
+		old = self._E_agg[entryRows, entryCols]
+		delta = np.maximum(old + delta, 0.0) - old
+
+		#then per distinct (candidate, row) pair: its new row sum, new E_agg[i] * Zw, and new diagonal entry
+		pairKeys, pairPos = np.unique(pairKeys, return_inverse=True)
+		pairPos = pairPos.ravel()
+		pairCands = pairKeys // n
+		pairRows = pairKeys % n
+		rowSums = self._rowSums[pairRows] + np.bincount(pairPos, weights=delta, minlength=len(pairKeys))
+		EZw = self._EZw[pairRows] + np.bincount(pairPos, weights=delta * self._Zw[entryCols], minlength=len(pairKeys))
+		diag = self._E_agg[pairRows, pairRows] + np.bincount(pairPos, weights=np.where(entryRows == entryCols, delta, 0.0), minlength=len(pairKeys))
+
+		#rows left empty or absorbing are replaced by uniform rows, per StochasticizeRows()
+		positive = rowSums > 0
+		safeSums = np.where(positive, rowSums, 1.0)
+		uniform = ~positive | (diag / safeSums == 1.0)
+		MZw = np.where(uniform, np.mean(self._Zw), EZw / safeSums)
+
+		#dr = sum over changed rows of pi[row] * (dM[row] . Zw)
+		contributions = self._pi[pairRows] * (MZw - self._MZw[pairRows])
+		return np.bincount(pairCands, weights=contributions, minlength=len(batch))
+
+	def ApplyCandidate(self, candidate, tol=1e-10):
+		"""
+		Exactly evaluates @candidate: rebuilds the changed rows of M_risk and re-solves for pi, warm-started from the current pi.
+		Returns the new @pi and the exact change in risk.
+		"""
+		E_agg = self._E_agg.copy()
+		np.add.at(E_agg, (candidate.Rows, candidate.Cols), (candidate.Factors - 1.0) * self._E[candidate.Rows, candidate.Cols, candidate.Tactics])
+		rows = np.unique(candidate.Rows)
+		M = self._M.copy()
+		M[rows] = self._analyzer.StochasticizeRows(np.maximum(E_agg[rows], 0.0), rows)
+		pi, stats = self._analyzer.SolveStationaryDistribution(M, method="power", tol=tol, pi0=self._pi)
+		return pi, self.GetRisk(pi) - self.GetRisk()
+
+	def RankCandidates(self, candidates, verifyTop=0):
+		"""
+		Ranks @candidates by estimated risk reduction, largest first.
+
+		@verifyTop: The number of top-ranked candidates to also evaluate exactly with ApplyCandidate()
+
+		Returns: A list of (candidate name, estimated risk change, exact risk change or None) tuples, best first.
+		"""
+		deltas = self.EvaluateCandidates(candidates)
+		order = np.argsort(deltas, kind="stable")
+		ranking = []
+		for rank, k in enumerate(order):
+			exact = self.ApplyCandidate(candidates[k])[1] if rank < verifyTop else None
+			ranking.append((candidates[k].Name, float(deltas[k]), exact))
+
+		return ranking
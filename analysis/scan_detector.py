@@ -0,0 +1,188 @@
+"""
+Network scan detection over the netflow indices, per QueryBuilder.BuildNetworkScanDetectionQuery().
+
+Elastic does the heavy lifting: per src ip and time bucket, it counts the distinct dst ports and hosts contacted and returns
+only the buckets that could be part of a scan. The detector then slides a time window over each src's candidate buckets
+and flags the src once the ports (or hosts) it contacted within the window cross a threshold. This catches:
+	*contiguous scans: a long run of sequential ports
+	*sparse scans: many ports, but not sequential (eg only even ports, or a list of well-known ports)
+	*disjoint-time scans: no single bucket crosses the threshold, but the buckets of one window together do
+	*sweeps: a few ports across many hosts
+
+Consecutive flagged windows of a src are merged into a single detection, spanning the whole scan.
+
+Each index is queried once. The per-src windows carry over from one index to the next (a scan may cross midnight), and
+the detector state can be saved and re-read, so each run only queries the indices created since the previous one.
+"""
+
+from __future__ import print_function
+
+import collections
+import datetime
+import os
+import pickle
+import re
+
+from elastic_client import ElasticClient
+from elastic_query_builder import QueryBuilder
+
+class NetworkScanDetector(object):
+	def __init__(self, client, indexRegex="netflow-", interval="1m", windowMinutes=60, minPorts=100, minHosts=50, minRun=20, minBucketPorts=5, minBucketHosts=5):
+		"""
+		@client: An ElasticClient
+		@indexRegex: Regex matching (via re.match) the indices to query. Index names must sort in time order, as daily indices do.
+		@interval: The date_histogram interval, eg "1m"
+		@windowMinutes: The length of the sliding window
+		@minPorts: Number of distinct dst ports contacted by a src within a window flagging a scan
+		@minHosts: Number of distinct dst hosts contacted by a src within one bucket flagging a sweep. Only the host cardinality
+					is returned per bucket, so unlike ports, hosts can't be counted across the buckets of a window.
+		@minRun: Length of the longest run of sequential ports for a scan to be labelled contiguous; otherwise it is sparse
+		@minBucketPorts/@minBucketHosts: The server-side candidate thresholds; see BuildNetworkScanDetectionQuery()
+		"""
+		self._client = client
+		self._indexRegex = re.compile(indexRegex)
+		self._windowMs = int(windowMinutes) * 60 * 1000
+		self._minPorts = minPorts
+		self._minHosts = minHosts
+		self._minRun = minRun
+		self._qDict = QueryBuilder.BuildNetworkScanDetectionQuery(interval=interval, minBucketPorts=minBucketPorts, minBucketHosts=minBucketHosts)
+		#the indices queried so far
+		self._processed = set()
+		#per src, the deque of candidate buckets (time, ports, numPorts, numHosts) within the window of its latest bucket
+		self._windows = dict()
+		#per src, its latest detection, which is extended while its windows stay flagged
+		self._open = dict()
+		self._detections = []
+
+	def Update(self):
+		"""
+		Queries every matching index not queried before, in time order, and returns their names. The newest index is
+		skipped, since it is likely still being written to; it is queried by the first Update() after its successor appears.
+		"""
+		indices = self._client.listIndices(filterRegex=self._indexRegex)[:-1]
+		newIndices = [index for index in indices if index not in self._processed]
+		for index in newIndices:
+			if len(self._processed) > 0 and index < max(self._processed):
+				print("WARNING index {} is older than those already processed; scans across its boundaries may be missed".format(index))
+			self._processIndex(index)
+
+		return newIndices
+
+	def _processIndex(self, index):
+		response = self._client.aggregate(index, self._qDict)
+		if "statusCode" in response.keys() and response["statusCode"] in [502,"502"]:
+			raise Exception("Bad gateway 502 error, elastic server likely down. Returned json: "+str(response))
+		if "error" in response.keys():
+			print("ERROR scan query failed on index "+index)
+			raise Exception("Scan query failed on index {}: {}".format(index, response["error"]))
+		if response["_shards"]["failed"] > 0:
+			print("WARNING {} shards failed for index {}".format(response["_shards"]["failed"], index))
+
+		for srcBucket in response["aggregations"]["src_addr"]["buckets"]:
+			src = srcBucket["key"]
+			for timeBucket in srcBucket["time"]["buckets"]:
+				ports = frozenset(int(pair["key"]) for pair in timeBucket["ports"]["buckets"])
+				self._addBucket(src, int(timeBucket["key"]), ports, timeBucket["num_ports"]["value"], timeBucket["num_hosts"]["value"])
+
+		self._processed.add(index)
+
+	def _addBucket(self, src, t, ports, numPorts, numHosts):
+		"""
+		Slides @src's window forward to the bucket at time @t (ms since epoch), then checks the window's port and host counts.
+		@numPorts may exceed len(@ports), which is capped server-side; the window's port count is then only a lower bound.
+		"""
+		window = self._windows.setdefault(src, collections.deque())
+		while len(window) > 0 and window[0][0] <= t - self._windowMs:
+			window.popleft()
+		window.append((t, ports, numPorts, numHosts))
+
+		windowPorts = frozenset().union(*[bucket[1] for bucket in window])
+		maxBucketPorts = max(bucket[2] for bucket in window)
+		if max(len(windowPorts), maxBucketPorts) < self._minPorts and numHosts < self._minHosts:
+			return
+
+		detection = self._open.get(src, None)
+		if detection is None or t - detection["end"] >= self._windowMs:
+			detection = {"src" : src, "start" : window[0][0], "end" : t, "ports" : set(), "maxBucketPorts" : 0, "maxBucketHosts" : 0}
+			self._open[src] = detection
+			self._detections.append(detection)
+		detection["end"] = t
+		detection["ports"].update(windowPorts)
+		detection["maxBucketPorts"] = max(detection["maxBucketPorts"], maxBucketPorts)
+		detection["maxBucketHosts"] = max(detection["maxBucketHosts"], numHosts)
+
+	def _longestRun(self, ports):
+		#Length of the longest run of sequential ports in @ports
+		longest, run, prev = 0, 0, None
+		for port in sorted(ports):
+			run = run + 1 if prev is not None and port == prev + 1 else 1
+			longest = max(longest, run)
+			prev = port
+
+		return longest
+
+	def _getLabels(self, detection):
+		labels = []
+		numPorts = max(len(detection["ports"]), detection["maxBucketPorts"])
+		if numPorts >= self._minPorts:
+			labels.append("contiguous" if self._longestRun(detection["ports"]) >= self._minRun else "sparse")
+		if detection["maxBucketHosts"] >= self._minHosts:
+			labels.append("sweep")
+		if detection["maxBucketPorts"] < self._minPorts and detection["maxBucketHosts"] < self._minHosts:
+			labels.append("disjoint")
+
+		return labels
+
+	def GetDetections(self):
+		"""
+		Returns the detections so far, in order of their first flagged window, as dicts of:
+			"src": the scanning ip
+			"start"/"end": the times (ms since epoch) of the scan's first and last candidate buckets
+			"numPorts": the number of distinct dst ports scanned
+			"maxBucketHosts": the most distinct dst hosts contacted within one bucket
+			"longestRun": the longest run of sequential ports scanned
+			"labels": any of "contiguous", "sparse", "sweep" and "disjoint"; see header
+		"""
+		return [{
+					"src" : d["src"],
+					"start" : d["start"],
+					"end" : d["end"],
+					"numPorts" : max(len(d["ports"]), d["maxBucketPorts"]),
+					"maxBucketHosts" : d["maxBucketHosts"],
+					"longestRun" : self._longestRun(d["ports"]),
+					"labels" : self._getLabels(d)
+				} for d in self._detections]
+
+	def GetScanningHosts(self):
+		return sorted(set(d["src"] for d in self._detections))
+
+	def Print(self):
+		toStr = lambda ms: datetime.datetime.utcfromtimestamp(ms / 1000.0).strftime("%Y-%m-%d %H:%M")
+		print("{} indices processed, {} scans detected".format(len(self._processed), len(self._detections)))
+		for d in self.GetDetections():
+			print("  {}  {} -> {}  ports={}  longest run={}  max hosts/bucket={}  {}".format(d["src"], toStr(d["start"]), toStr(d["end"]), d["numPorts"], d["longestRun"], d["maxBucketHosts"], ",".join(d["labels"])))
+
+	def Save(self, fpath):
+		#Pickles the detector state, including its parameters, but not its client
+		state = dict((k, v) for k, v in self.__dict__.items() if k != "_client")
+		with open(fpath, "wb") as ofile:
+			pickle.dump(state, ofile, pickle.HIGHEST_PROTOCOL)
+
+	def Read(self, fpath):
+		#Restores the state written by Save(); the detector's own parameters are replaced by the saved ones
+		with open(fpath, "rb") as ifile:
+			self.__dict__.update(pickle.load(ifile))
+
+def main():
+	servAddr = "http://192.168.0.91:80/elasticsearch"
+	statePath = "scan_detector.pickle"
+	detector = NetworkScanDetector(ElasticClient(servAddr), indexRegex="netflow-v9-")
+	if os.path.isfile(statePath):
+		detector.Read(statePath)
+	newIndices = detector.Update()
+	print("Processed {} new indices".format(len(newIndices)))
+	detector.Save(statePath)
+	detector.Print()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,197 @@
+"""
+Sensor allocation on the risk model. The stationary attack distribution pi computed by ModelAnalyzer is informative for
+"optimizing sensor allocation"; this module actually computes an allocation.
+
+The stationary chain defines how often attack activity takes each host-to-host tactic step: in the long run, a fraction
+pi[i] * M_risk[i,j] of all steps go from host i to host j, split over tactics in proportion to E_risk[i,j,:]. Each such
+(i, j, tactic) step is an attack event with that weight. A sensor covers a set of events and detects each one with some
+probability, so the detection coverage of a placement S is the expected fraction of attack steps detected:
+
+	coverage(S) = sum_e w_e * (1 - prod_{s in S covering e} (1 - r_s))
+
+This is monotone submodular, so it is maximized under a budget by (cost-benefit) greedy selection. The lazy-greedy variant
+used here keeps every candidate's last computed marginal gain in a max-heap; since gains only shrink as sensors are added,
+a candidate whose refreshed gain still tops the heap is the true best, and most candidates are never re-evaluated.
+
+With non-uniform costs, cost-benefit greedy alone has no approximation guarantee: a cheap sensor of small gain can crowd
+out a costly one covering far more. Returning the better of the greedy placement and the best single affordable sensor
+restores a (1 - 1/e) / 2 guarantee (Leskovec et al., "Cost-effective outbreak detection in networks", 2007).
+"""
+
+from __future__ import print_function
+
+import heapq
+import time
+
+import numpy as np
+
+class SensorCandidate(object):
+	def __init__(self, name, kind, eventIds, detectionRate, cost):
+		"""
+		@name: Unique description, e.g. "host:192.168.2.10"
+		@kind: The sensor type, one of "host", "network", "edge", or any user-defined type
+		@eventIds: Integer array of the attack events (see SensorPlacementOptimizer) this sensor observes
+		@detectionRate: Probability of detecting each observed event
+		@cost: Cost against the placement budget
+		"""
+		self.Name = name
+		self.Kind = kind
+		self.EventIds = np.asarray(eventIds, dtype=np.int64)
+		self.DetectionRate = detectionRate
+		self.Cost = cost
+
+class SensorPlacementOptimizer(object):
+	#on-host tactics are visible to host agents (e.g. winlogbeat); inter-host tactics are visible on the wire
+	HostTactics = ["discovery", "privilege-escalation", "execution"]
+	NetworkTactics = ["lateral-movement", "discovery"]
+
+	def __init__(self, netflowModel, modelAnalyzer, detectionRates=None, costs=None):
+		"""
+		@netflowModel: The NetFlowModel whose host graph defines where edge taps can be placed
+		@modelAnalyzer: A ModelAnalyzer on which AnalyzeStationaryAttackDistribution() has already been run
+		@detectionRates: Optional dict of sensor kind -> detection probability; defaults below
+		@costs: Optional dict of sensor kind -> cost; defaults below
+		"""
+		state = modelAnalyzer.GetRiskState()
+		if state is None:
+			raise Exception("SensorPlacementOptimizer requires a ModelAnalyzer with a completed stationary analysis")
+
+		self._netflowModel = netflowModel
+		self._hostIndex = state["hostIndex"]
+		self._tacticIndex = state["tacticIndex"]
+		self._detectionRates = {"host" : 0.9, "network" : 0.6, "edge" : 0.8}
+		self._costs = {"host" : 1.0, "network" : 2.0, "edge" : 0.5}
+		if detectionRates is not None:
+			self._detectionRates.update(detectionRates)
+		if costs is not None:
+			self._costs.update(costs)
+		self._buildEvents(state["E_risk"], state["M_risk"], state["pi"])
+
+	def _buildEvents(self, E, M, pi):
+		#weight of step (i,j,t) = pi[i] * M[i,j] * E[i,j,t] / sum_t E[i,j,t], computed only at the nonzeros of E
+		src, dst, tac = np.nonzero(E)
+		values = E[src, dst, tac]
+		#per (i,j) pair, sum_t E[i,j,t]; nonzero() returns the entries in row-major order, so each pair's entries are adjacent
+		pairs, pairPos = np.unique(src * E.shape[1] + dst, return_inverse=True)
+		pairPos = pairPos.ravel()
+		E_agg = np.bincount(pairPos, weights=values, minlength=len(pairs))
+		weights = pi[src] * np.asarray(M)[src, dst] * values / E_agg[pairPos]
+		keep = weights > 0
+		self._src, self._dst, self._tac = src[keep], dst[keep], tac[keep]
+		self._weights = weights[keep]
+		print("Sensor placement: {} attack events over {} hosts, total weight {:.4f}".format(len(self._weights), len(self._hostIndex), self._weights.sum()))
+
+	def _groupBy(self, keys, mask, numKeys):
+		#Returns a list, for every key in 0..numKeys-1, of the ids of the masked events with that key
+		ids = np.flatnonzero(mask)
+		order = np.argsort(keys[ids], kind="stable")
+		ids = ids[order]
+		bounds = np.searchsorted(keys[ids], np.arange(numKeys + 1))
+		return [ids[bounds[k]:bounds[k+1]] for k in range(numKeys)]
+
+	def BuildCandidates(self):
+		"""
+		Builds the default candidate sensors:
+			"host" agents on every host, observing its on-host tactic events (the E_risk diagonal)
+			"network" sensors on every host, observing all inter-host tactic events into or out of it
+			"edge" taps on every edge of the netflow host graph between analyzed hosts, observing inter-host events along that edge
+		"""
+		n = len(self._hostIndex)
+		hosts = [host for host, i in sorted(self._hostIndex.items(), key = lambda t: t[1])]
+		hostTactics = [self._tacticIndex[t] for t in self.HostTactics if t in self._tacticIndex]
+		netTactics = [self._tacticIndex[t] for t in self.NetworkTactics if t in self._tacticIndex]
+		onHost = (self._src == self._dst) & np.isin(self._tac, hostTactics)
+		onWire = (self._src != self._dst) & np.isin(self._tac, netTactics)
+
+		candidates = []
+		for h, ids in enumerate(self._groupBy(self._src, onHost, n)):
+			candidates.append(SensorCandidate("host:"+hosts[h], "host", ids, self._detectionRates["host"], self._costs["host"]))
+		bySrc = self._groupBy(self._src, onWire, n)
+		byDst = self._groupBy(self._dst, onWire, n)
+		for h in range(n):
+			ids = np.union1d(bySrc[h], byDst[h])
+			candidates.append(SensorCandidate("network:"+hosts[h], "network", ids, self._detectionRates["network"], self._costs["network"]))
+
+		#edge taps, only for edges that exist in the netflow graph
+		edgeKeys = self._src * n + self._dst
+		byEdge = dict()
+		wireIds = np.flatnonzero(onWire)
+		order = np.argsort(edgeKeys[wireIds], kind="stable")
+		wireIds = wireIds[order]
+		uniqueKeys, starts = np.unique(edgeKeys[wireIds], return_index=True)
+		for key, ids in zip(uniqueKeys.tolist(), np.split(wireIds, starts[1:])):
+			byEdge[key] = ids
+		for (src, dst) in self._netflowModel.GetEdgeNames():
+			if src in self._hostIndex and dst in self._hostIndex:
+				key = self._hostIndex[src] * n + self._hostIndex[dst]
+				if key in byEdge:
+					candidates.append(SensorCandidate("edge:{}->{}".format(src, dst), "edge", byEdge[key], self._detectionRates["edge"], self._costs["edge"]))
+
+		return candidates
+
+	def GetCoverage(self, placement):
+		#Returns the detection coverage of @placement, a list of SensorCandidates
+		missProb = np.ones(len(self._weights))
+		for sensor in placement:
+			missProb[sensor.EventIds] *= (1.0 - sensor.DetectionRate)
+		return float(np.dot(self._weights, 1.0 - missProb))
+
+	def Optimize(self, budget, candidates=None):
+		"""
+		Selects sensors maximizing detection coverage with total cost at most @budget, by lazy cost-benefit greedy selection,
+		unless a single affordable sensor covers more on its own; see header.
+
+		@budget: The total cost allowed
+		@candidates: A list of SensorCandidates; defaults to BuildCandidates()
+
+		Returns: @placement, the selected SensorCandidates in selection order, and @stats, a dict with the final "coverage",
+				the "gains" of each selection, "cost", the number of gain "evaluations", "rule" ("greedy" or "single"), and "time" (seconds).
+		"""
+		start = time.time()
+		if candidates is None:
+			candidates = self.BuildCandidates()
+
+		#probability each event is still undetected by the placement so far
+		missProb = np.ones(len(self._weights))
+		def gain(c):
+			ids = candidates[c].EventIds
+			return candidates[c].DetectionRate * float(np.dot(self._weights[ids], missProb[ids]))
+
+		#max-heap of (-gain/cost, candidate, round in which the gain was computed)
+		heap = [(-gain(c) / candidates[c].Cost, c, 0) for c in range(len(candidates)) if candidates[c].Cost <= budget]
+		heapq.heapify(heap)
+		evaluations = len(heap)
+		placement, gains = [], []
+		spent = 0.0
+		while heap:
+			negRatio, c, computedAt = heapq.heappop(heap)
+			if spent + candidates[c].Cost > budget:
+				continue
+			if computedAt == len(placement):
+				#cached gain is current, and no other candidate can beat it since gains only shrink
+				if negRatio >= 0:
+					break
+				sensor = candidates[c]
+				gains.append(gain(c))
+				missProb[sensor.EventIds] *= (1.0 - sensor.DetectionRate)
+				placement.append(sensor)
+				spent += sensor.Cost
+			else:
+				heapq.heappush(heap, (-gain(c) / candidates[c].Cost, c, len(placement)))
+				evaluations += 1
+
+		coverage = float(np.dot(self._weights, 1.0 - missProb))
+		rule = "greedy"
+		#the best single affordable sensor; its gain on an empty placement is its coverage
+		missProb[:] = 1.0
+		singles = [(gain(c), c) for c in range(len(candidates)) if candidates[c].Cost <= budget]
+		if len(singles) > 0:
+			bestGain, best = max(singles)
+			if bestGain > coverage:
+				placement, gains, spent, coverage, rule = [candidates[best]], [bestGain], candidates[best].Cost, bestGain, "single"
+
+		stats = {"coverage" : coverage, "gains" : gains, "cost" : spent, "evaluations" : evaluations, "rule" : rule, "time" : time.time() - start}
+		print("Placed {} sensors (cost {} of {}, {}): coverage={:.4f}, {} gain evaluations for {} candidates, {:.3f}s".format(
+			len(placement), spent, budget, rule, stats["coverage"], evaluations, len(candidates), stats["time"]))
+
+		return placement, stats
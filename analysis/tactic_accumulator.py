@@ -0,0 +1,168 @@
+"""
+Incremental construction of the tactic frequency matrix F_tactic (see RandomWalkGenerator._buildMatrixFromWalks()).
+
+The accumulator keeps sparse (src, dst, tactic) counts and a host index that grows as new hosts are seen, so walks can be
+counted as they are generated, one at a time or a whole simulated batch at a time, without writing or re-reading a walk
+file. A dense snapshot of the matrix can be taken at any point, e.g. to test whether it has converged.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+class TacticMatrixAccumulator(object):
+	def __init__(self, tacticIndex, relationalDiscoveryTechniques):
+		"""
+		@tacticIndex: Map of the tactics counted to their index along the matrix' third axis
+		@relationalDiscoveryTechniques: Names of discovery techniques counted as transitions from the previous host
+		"""
+		self._tacticIndex = dict(tacticIndex)
+		self._relational = set(relationalDiscoveryTechniques)
+		self._hostIndex = dict()
+		self._counts = dict()
+		self.NumWalks = 0
+		self.NumSteps = 0
+
+	def _internHost(self, host):
+		if host not in self._hostIndex:
+			self._hostIndex[host] = len(self._hostIndex)
+		return self._hostIndex[host]
+
+	def _add(self, key, count=1.0):
+		self._counts[key] = self._counts.get(key, 0.0) + count
+
+	def AddWalk(self, walk):
+		"""
+		Counts one walk, a list of step dicts as returned by RandomWalkGenerator._generateWalk().
+
+		1) Intra-host tactics (discovery, privilege-escalation, execution) count on the diagonal: (host, host, tactic)
+		2) Lateral movement counts as a transition from the previous step's host, and on that host's diagonal
+		3) Relational discovery techniques also count as a transition from the previous step's host
+		"""
+		hostIds = [self._internHost(step["host"]) for step in walk]
+		for i in range(len(walk)):
+			step = walk[i]
+			tactic = step["tactic"]
+			if tactic not in self._tacticIndex:
+				print("WARNING tactic >{}< not in tacticIndex. Likely not supported.".format(tactic))
+				continue
+			t = self._tacticIndex[tactic]
+			host_i = hostIds[i]
+			if tactic in ["discovery", "privilege-escalation", "execution"]:
+				self._add((host_i, host_i, t))
+			if i > 0:
+				src_i = hostIds[i-1]
+				if tactic == "lateral-movement":
+					self._add((src_i, host_i, t))
+					self._add((src_i, src_i, t))
+				elif tactic == "discovery" and step["technique_name"] in self._relational:
+					self._add((src_i, host_i, t))
+
+		self.NumWalks += 1
+		self.NumSteps += len(walk)
+
+	def _addSteps(self, hosts, tactics, hostIds, tacticIds, relational, offsets):
+		"""
+		Vectorized AddWalk() over many walks in columnar form: step k is at host @hosts[@hostIds[k]] with tactic
+		@tactics[@tacticIds[k]], and is a relational technique if @relational[k]. Walk i is steps [@offsets[i], @offsets[i+1]).
+		"""
+		hostIds = np.asarray(hostIds, dtype=np.int64)
+		tacticIds = np.asarray(tacticIds, dtype=np.int64)
+		offsets = np.asarray(offsets, dtype=np.int64)
+		numSteps = len(hostIds)
+		self.NumWalks += len(offsets) - 1
+		self.NumSteps += numSteps
+		if numSteps == 0:
+			return
+
+		#intern hosts in order of first appearance, as AddWalk() would
+		localHosts, firstSeen = np.unique(hostIds, return_index=True)
+		hostMap = np.zeros(len(hosts), dtype=np.int64)
+		for k in np.argsort(firstSeen):
+			hostMap[localHosts[k]] = self._internHost(hosts[localHosts[k]])
+		tacticMap = np.array([self._tacticIndex.get(tactic, -1) for tactic in tactics], dtype=np.int64)
+
+		h = hostMap[hostIds]
+		t = tacticMap[tacticIds]
+		unsupported = t < 0
+		if unsupported.any():
+			print("WARNING {} steps with tactics not in tacticIndex were skipped: {}".format(unsupported.sum(), sorted(set(tactics[k] for k in np.unique(tacticIds[unsupported])))))
+		hasPrev = np.ones(numSteps, dtype=bool)
+		hasPrev[offsets[:-1][offsets[:-1] < numSteps]] = False
+		prev = np.roll(h, 1)
+
+		isTactic = lambda name: (t == self._tacticIndex[name]) if name in self._tacticIndex else np.zeros(numSteps, dtype=bool)
+		intra = isTactic("discovery") | isTactic("privilege-escalation") | isTactic("execution")
+		lateral = isTactic("lateral-movement") & hasPrev
+		relationalDisc = isTactic("discovery") & hasPrev & np.asarray(relational, dtype=bool)
+
+		src = np.concatenate((h[intra], prev[lateral], prev[lateral], prev[relationalDisc]))
+		dst = np.concatenate((h[intra], h[lateral], prev[lateral], h[relationalDisc]))
+		tac = np.concatenate((t[intra], t[lateral], t[lateral], t[relationalDisc]))
+		#count over flat (src, dst, tactic) keys, then fold the distinct ones into the sparse counts
+		n, T = len(self._hostIndex), len(self._tacticIndex)
+		keys, counts = np.unique((src * n + dst) * T + tac, return_counts=True)
+		for key, count in zip(keys.tolist(), counts.tolist()):
+			self._add((key // (n * T), key // T % n, key % T), float(count))
+
+	def AddWalkCorpus(self, corpus):
+		#Counts all walks of @corpus, a WalkCorpus as returned by BatchWalkSimulator.Simulate()
+		tactics = [tactic for tactic, i in sorted(corpus.TacticIndex.items(), key = lambda t: t[1])]
+		relational = np.zeros(len(corpus.TacticIds), dtype=bool)
+		if corpus.Techniques is not None:
+			#per tactic, whether each of its techniques is relational; looked up by (tactic, technique) through a flattened table
+			starts = np.concatenate(([0], np.cumsum([len(techs) for techs in corpus.Techniques])))
+			table = np.array([str(tech["name"]) in self._relational for techs in corpus.Techniques for tech in techs], dtype=bool)
+			hasTechnique = corpus.TechniqueIds >= 0
+			relational[hasTechnique] = table[starts[corpus.TacticIds[hasTechnique]] + corpus.TechniqueIds[hasTechnique]]
+		self._addSteps(corpus.Hosts, tactics, corpus.HostIds, corpus.TacticIds, relational, corpus.GetWalkOffsets())
+
+	def AddCorpusReader(self, reader, chunkWalks=100000):
+		"""
+		Counts all walks of the on-disk corpus opened by @reader, a WalkCorpusReader, @chunkWalks walks at a time, so only one
+		chunk of its memory-mapped step arrays is ever in memory.
+		"""
+		table = np.array([name in self._relational for techId, name, techStr in reader.Techniques] + [False], dtype=bool)
+		for first in range(0, reader.NumWalks, chunkWalks):
+			last = min(first + chunkWalks, reader.NumWalks)
+			offsets = np.asarray(reader.Offsets[first:last+1], dtype=np.int64)
+			steps = slice(offsets[0], offsets[-1])
+			#technique id -1 indexes the trailing False
+			relational = table[np.asarray(reader.TechniqueIds[steps])]
+			self._addSteps(reader.Hosts, reader.Tactics, reader.HostIds[steps], reader.TacticIds[steps], relational, offsets - offsets[0])
+
+	def AddAccumulator(self, other):
+		"""
+		Adds all counts of @other, another TacticMatrixAccumulator over the same tactics, e.g. one holding a single batch of walks.
+
+		Returns: An array mapping @other's host ids to this accumulator's host ids.
+		"""
+		hosts = [host for host, i in sorted(other._hostIndex.items(), key = lambda t: t[1])]
+		hostMap = np.array([self._internHost(host) for host in hosts], dtype=np.int64)
+		for (s, d, t), count in other._counts.items():
+			self._add((int(hostMap[s]), int(hostMap[d]), t), count)
+		self.NumWalks += other.NumWalks
+		self.NumSteps += other.NumSteps
+
+		return hostMap
+
+	def GetSparseCounts(self):
+		#Returns the nonzero counts as arrays @src, @dst, @tactic and @counts
+		keys = np.array(list(self._counts.keys()), dtype=np.int64).reshape(-1, 3)
+		return keys[:,0], keys[:,1], keys[:,2], np.array(list(self._counts.values()), dtype=np.float64)
+
+	def GetHostIndex(self):
+		return dict(self._hostIndex)
+
+	def Snapshot(self):
+		"""
+		Returns the counts so far as @M, a dense n x n x numTactics matrix, with @hostIndex and @tacticIndex, as returned by
+		RandomWalkGenerator._buildMatrixFromWalks(). Hosts are indexed in order of first appearance.
+		"""
+		n = len(self._hostIndex)
+		M = np.zeros(shape=(n, n, len(self._tacticIndex)), dtype=np.float64)
+		if len(self._counts) > 0:
+			keys = np.array(list(self._counts.keys()), dtype=np.int64)
+			M[keys[:,0], keys[:,1], keys[:,2]] = np.array(list(self._counts.values()))
+
+		return M, dict(self._hostIndex), dict(self._tacticIndex)
@@ -0,0 +1,85 @@
+"""
+A local store of MITRE ATT&CK techniques, so walk generation need not query the MITRE TAXII server on every step.
+
+Techniques are read from a STIX bundle file (such as enterprise-attack.json from the mitre/cti repository), indexed by
+kill-chain phase (i.e. tactic), and pickled alongside the bundle so later runs load the index directly. If the bundle
+file does not exist, it is first downloaded from the TAXII server; Refresh() re-downloads it on demand.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import pickle
+
+from stix2 import TAXIICollectionSource, Filter
+from taxii2client import Collection
+
+class TechniqueCache(object):
+	def __init__(self, bundlePath="enterprise-attack.json", cachePath=None, collectionUrl="https://cti-taxii.mitre.org/stix/collections/95ecc380-afe9-11e4-9b6c-751b66dd541e/"):
+		"""
+		@bundlePath: Path to the STIX bundle of ATT&CK objects; downloaded from @collectionUrl if it does not exist
+		@cachePath: Path of the pickled index; defaults to @bundlePath + ".pickle"
+		@collectionUrl: The TAXII collection to download from
+		"""
+		self._bundlePath = bundlePath
+		self._cachePath = cachePath if cachePath is not None else bundlePath + ".pickle"
+		self._collectionUrl = collectionUrl
+		self._phaseIndex = None
+
+	def Load(self):
+		"""
+		Loads the technique index: from the pickle if it is newer than the bundle, else by parsing the bundle (downloading it first
+		if missing), after which the pickle is rewritten. Called implicitly by GetTechniques().
+		"""
+		if os.path.isfile(self._cachePath) and (not os.path.isfile(self._bundlePath) or os.path.getmtime(self._cachePath) >= os.path.getmtime(self._bundlePath)):
+			with open(self._cachePath, "rb") as ifile:
+				self._phaseIndex = pickle.load(ifile)
+			return
+
+		if not os.path.isfile(self._bundlePath):
+			self._download()
+		self._buildIndex()
+
+	def Refresh(self):
+		#Re-downloads the bundle from the TAXII server and rebuilds the index
+		self._download()
+		self._buildIndex()
+
+	def _download(self):
+		print("Downloading ATT&CK techniques from {} to {}".format(self._collectionUrl, self._bundlePath))
+		source = TAXIICollectionSource(Collection(self._collectionUrl))
+		techs = source.query([Filter('type', '=', 'attack-pattern')])
+		bundle = {"type" : "bundle", "objects" : [json.loads(tech.serialize()) for tech in techs]}
+		with open(self._bundlePath, "w") as ofile:
+			json.dump(bundle, ofile)
+
+	def _buildIndex(self):
+		with open(self._bundlePath, "r") as ifile:
+			bundle = json.load(ifile)
+
+		index = dict()
+		for obj in bundle["objects"]:
+			if obj.get("type") != "attack-pattern":
+				continue
+			#keep only the fields walks use, so the pickle stays small and each entry can be indexed like a stix2 object
+			tech = {"id" : obj["id"], "name" : obj["name"], "x_mitre_data_sources" : obj.get("x_mitre_data_sources", [])}
+			for phase in obj.get("kill_chain_phases", []):
+				if phase["kill_chain_name"] == "mitre-attack":
+					index.setdefault(phase["phase_name"], []).append(tech)
+
+		self._phaseIndex = index
+		with open(self._cachePath, "wb") as ofile:
+			pickle.dump(index, ofile, protocol=pickle.HIGHEST_PROTOCOL)
+		print("Indexed {} technique entries over {} tactics from {}".format(sum(len(techs) for techs in index.values()), len(index), self._bundlePath))
+
+	def GetTactics(self):
+		if self._phaseIndex is None:
+			self.Load()
+		return sorted(self._phaseIndex.keys())
+
+	def GetTechniques(self, tactic):
+		#Returns the list of techniques for @tactic (a kill-chain phase name, e.g. "lateral-movement"), each a dict with "id", "name" and "x_mitre_data_sources"
+		if self._phaseIndex is None:
+			self.Load()
+		return self._phaseIndex.get(tactic, [])
@@ -1,33 +1,20 @@
 """
 Just a short single-purpose script for analyzing the distribution of walks in walks.py,
 for documentation purposes.
+
+The statistics are computed in one streaming pass by walk_statistics.py. If a binary walk corpus walks.corpus exists
+(see walk_corpus.py), it is analyzed instead of walks.py; any walk files or corpus directories passed on the command
+line, such as the shards of a parallel run, are analyzed together instead of either.
 """
 
-ifile = open("walks.py","r")
-walks = []
-for line in ifile:
-	try:
-		walk = eval(line.strip())
-		walks.append(walk)
-	except:
-		pass
+import os
+import sys
 
-numWalks = len(walks)
-#get the average walk length
-avgLen = float(sum(len(walk) for walk in walks)) / float(numWalks)
-print("average walk length: {}".format(avgLen))
-		
-#count tactics
-tacticHistogram = dict()
-for walk in walks:
-	for step in walk:
-		tactic = step["tactic"]
-		if tactic in tacticHistogram:
-			tacticHistogram[tactic] += 1
-		else:
-			tacticHistogram[tactic] = 1
+from walk_statistics import ComputeWalkStatistics
 
-numTechniques = sum( item[1] for item in tacticHistogram.items() )
-print("Tactic histogram: {}".format(tacticHistogram))
-print("Total techniques: {}".format(numTechniques))
-ifile.close()
\ No newline at end of file
+if __name__ == "__main__":
+	walkPaths = sys.argv[1:]
+	if len(walkPaths) == 0:
+		walkPaths = ["walks.corpus"] if os.path.isdir("walks.corpus") else ["walks.py"]
+	stats = ComputeWalkStatistics(walkPaths)
+	stats.Print()
@@ -0,0 +1,192 @@
+"""
+A compact, columnar on-disk format for walk corpora, replacing the one-python-repr-per-line walk files.
+
+A corpus is a directory of flat binary arrays with one entry per step, in walk order, plus the walk offsets:
+
+	hosts.i32		host id of each step
+	tactics.u8		tactic id of each step
+	techniques.i32	technique id of each step, or -1 if none was recorded
+	offsets.i64		numWalks+1 step offsets, such that walk i is steps [offsets[i], offsets[i+1])
+	dictionary.json	the tables mapping ids back to host names, tactic names and techniques (id, name, data sources)
+
+Every string is stored once in the dictionary, so a step costs 9 bytes. The arrays are appended to as walks are
+written, and are read back with np.memmap, so a corpus can be scanned without loading it, and without eval().
+"""
+
+from __future__ import print_function
+
+import ast
+import json
+import os
+
+import numpy as np
+
+class WalkCorpusWriter(object):
+	def __init__(self, corpusPath, append=False):
+		"""
+		@corpusPath: The corpus directory; created if it does not exist
+		@append: If true, walks are appended to an existing corpus at @corpusPath; else any existing corpus is overwritten
+		"""
+		self._path = corpusPath
+		if not os.path.isdir(corpusPath):
+			os.makedirs(corpusPath)
+			append = False
+
+		self._hosts, self._tactics, self._techniques = [], [], []
+		self._offset = 0
+		if append:
+			with open(os.path.join(corpusPath, "dictionary.json"), "r") as ifile:
+				dictionary = json.load(ifile)
+			self._hosts, self._tactics = dictionary["hosts"], dictionary["tactics"]
+			self._techniques = [tuple(tech) for tech in dictionary["techniques"]]
+			self._offset = int(np.fromfile(os.path.join(corpusPath, "offsets.i64"), dtype=np.int64)[-1])
+		self._hostIds = dict((host, i) for i, host in enumerate(self._hosts))
+		self._tacticIds = dict((tactic, i) for i, tactic in enumerate(self._tactics))
+		self._techniqueIds = dict((tech, i) for i, tech in enumerate(self._techniques))
+
+		mode = "ab" if append else "wb"
+		self._hostFile = open(os.path.join(corpusPath, "hosts.i32"), mode)
+		self._tacticFile = open(os.path.join(corpusPath, "tactics.u8"), mode)
+		self._techniqueFile = open(os.path.join(corpusPath, "techniques.i32"), mode)
+		self._offsetFile = open(os.path.join(corpusPath, "offsets.i64"), mode)
+		if not append:
+			np.array([0], dtype=np.int64).tofile(self._offsetFile)
+
+	def _intern(self, key, table, ids):
+		if key not in ids:
+			ids[key] = len(table)
+			table.append(key)
+		return ids[key]
+
+	def _internAll(self, keys, table, ids):
+		#Returns the array of ids of @keys, interning new ones
+		return np.array([self._intern(key, table, ids) for key in keys], dtype=np.int64)
+
+	def _writeSteps(self, hostIds, tacticIds, techniqueIds, walkLengths):
+		np.asarray(hostIds, dtype=np.int32).tofile(self._hostFile)
+		np.asarray(tacticIds, dtype=np.uint8).tofile(self._tacticFile)
+		np.asarray(techniqueIds, dtype=np.int32).tofile(self._techniqueFile)
+		offsets = self._offset + np.cumsum(np.asarray(walkLengths, dtype=np.int64))
+		offsets.tofile(self._offsetFile)
+		if len(offsets) > 0:
+			self._offset = int(offsets[-1])
+
+	def WriteWalk(self, walk):
+		#Writes one walk in the list-of-step-dicts format of RandomWalkGenerator._generateWalk()
+		hostIds = [self._intern(step["host"], self._hosts, self._hostIds) for step in walk]
+		tacticIds = [self._intern(step["tactic"], self._tactics, self._tacticIds) for step in walk]
+		techniqueIds = [-1 if len(step["technique_id"]) == 0 else
+						self._intern((step["technique_id"], step["technique_name"], step["technique_data_source"]), self._techniques, self._techniqueIds)
+						for step in walk]
+		self._writeSteps(hostIds, tacticIds, techniqueIds, [len(walk)])
+
+	def WriteWalkCorpus(self, corpus):
+		"""
+		Writes all walks of @corpus, a WalkCorpus as returned by BatchWalkSimulator.Simulate(). Only the corpus' own tables
+		are interned; its step columns are remapped with array lookups.
+		"""
+		tactics = [tactic for tactic, i in sorted(corpus.TacticIndex.items(), key = lambda t: t[1])]
+		hostMap = self._internAll(corpus.Hosts, self._hosts, self._hostIds)
+		tacticMap = self._internAll(tactics, self._tactics, self._tacticIds)
+		techniqueIds = np.full(len(corpus.TechniqueIds), -1, dtype=np.int64)
+		if corpus.Techniques is not None:
+			#per-tactic technique ids -> global ids, through the flattened table of all tactics' techniques
+			starts = np.concatenate(([0], np.cumsum([len(techs) for techs in corpus.Techniques])))
+			flat = [(str(tech["id"]), str(tech["name"]), str(tech["x_mitre_data_sources"])) for techs in corpus.Techniques for tech in techs]
+			techniqueMap = self._internAll(flat, self._techniques, self._techniqueIds)
+			hasTechnique = corpus.TechniqueIds >= 0
+			techniqueIds[hasTechnique] = techniqueMap[starts[corpus.TacticIds[hasTechnique]] + corpus.TechniqueIds[hasTechnique]]
+		walkLengths = np.diff(corpus.GetWalkOffsets())
+		self._writeSteps(hostMap[corpus.HostIds], tacticMap[corpus.TacticIds], techniqueIds, walkLengths)
+
+	def WriteCorpusFile(self, corpusPath):
+		#Appends all walks of the on-disk corpus at @corpusPath, e.g. to merge shards
+		reader = WalkCorpusReader(corpusPath)
+		hostMap = self._internAll(reader.Hosts, self._hosts, self._hostIds)
+		tacticMap = self._internAll(reader.Tactics, self._tactics, self._tacticIds)
+		techniqueMap = self._internAll(reader.Techniques, self._techniques, self._techniqueIds)
+		techniqueIds = np.where(reader.TechniqueIds >= 0, techniqueMap[np.maximum(reader.TechniqueIds, 0)] if len(techniqueMap) > 0 else -1, -1)
+		self._writeSteps(hostMap[reader.HostIds], tacticMap[reader.TacticIds], techniqueIds, np.diff(reader.Offsets))
+
+	def Close(self):
+		#Flushes the step arrays and writes the dictionary table; the corpus is only readable after this
+		for f in [self._hostFile, self._tacticFile, self._techniqueFile, self._offsetFile]:
+			f.close()
+		dictionary = {"hosts" : self._hosts, "tactics" : self._tactics, "techniques" : [list(tech) for tech in self._techniques]}
+		with open(os.path.join(self._path, "dictionary.json"), "w") as ofile:
+			json.dump(dictionary, ofile)
+
+class WalkCorpusReader(object):
+	def __init__(self, corpusPath, mmap=True):
+		"""
+		@corpusPath: A corpus directory written by WalkCorpusWriter
+		@mmap: If true, the step arrays are memory-mapped rather than read into memory
+		"""
+		with open(os.path.join(corpusPath, "dictionary.json"), "r") as ifile:
+			dictionary = json.load(ifile)
+		self.Hosts = dictionary["hosts"]
+		self.Tactics = dictionary["tactics"]
+		self.Techniques = [tuple(tech) for tech in dictionary["techniques"]]
+
+		self.Offsets = self._load(os.path.join(corpusPath, "offsets.i64"), np.int64, mmap)
+		self.HostIds = self._load(os.path.join(corpusPath, "hosts.i32"), np.int32, mmap)
+		self.TacticIds = self._load(os.path.join(corpusPath, "tactics.u8"), np.uint8, mmap)
+		self.TechniqueIds = self._load(os.path.join(corpusPath, "techniques.i32"), np.int32, mmap)
+		self.NumWalks = len(self.Offsets) - 1
+		if not (len(self.HostIds) == len(self.TacticIds) == len(self.TechniqueIds) == self.Offsets[-1]):
+			print("ERROR corpus arrays in {} have inconsistent lengths".format(corpusPath))
+			raise Exception("Corrupt walk corpus: "+corpusPath)
+
+	def _load(self, fpath, dtype, mmap):
+		if mmap and os.path.getsize(fpath) > 0:
+			return np.memmap(fpath, dtype=dtype, mode="r")
+		return np.fromfile(fpath, dtype=dtype)
+
+	def GetWalkOffsets(self):
+		return self.Offsets
+
+	def GetWalk(self, i):
+		#Returns walk @i in the list-of-step-dicts format of RandomWalkGenerator._generateWalk()
+		walk = []
+		attack_path = set()
+		for k in range(self.Offsets[i], self.Offsets[i+1]):
+			host = self.Hosts[self.HostIds[k]]
+			attack_path.add(host)
+			techId, techName, techStr = ("", "", "") if self.TechniqueIds[k] < 0 else self.Techniques[self.TechniqueIds[k]]
+			walk.append({
+				"host" : host,
+				"attack_path" : str(attack_path),
+				"tactic" : self.Tactics[self.TacticIds[k]],
+				"technique_id" : techId,
+				"technique_name" : techName,
+				"technique_data_source" : techStr
+			})
+		return walk
+
+	def GetWalks(self):
+		for i in range(self.NumWalks):
+			yield self.GetWalk(i)
+
+def ConvertWalkFile(walkPath, corpusPath):
+	"""
+	Converts the walk file at @walkPath, one python-literal walk per line as written by RandomWalkGenerator.GenerateKWalks(),
+	into a corpus at @corpusPath. Lines are parsed with ast.literal_eval rather than eval.
+	"""
+	writer = WalkCorpusWriter(corpusPath)
+	numWalks = 0
+	with open(walkPath, "r") as ifile:
+		for line in ifile:
+			if len(line.strip()) > 0:
+				try:
+					writer.WriteWalk(ast.literal_eval(line.strip()))
+					numWalks += 1
+				except (ValueError, SyntaxError):
+					print("WARNING could not parse walk in ConvertWalkFile: "+line)
+	writer.Close()
+	print("Converted {} walks from {} to {}".format(numWalks, walkPath, corpusPath))
+
+def main():
+	ConvertWalkFile("walks.py", "walks.corpus")
+
+if __name__ == "__main__":
+	main()
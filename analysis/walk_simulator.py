@@ -0,0 +1,351 @@
+"""
+A batch version of the walk script in RandomWalkGenerator._generateWalk(). Rather than simulating one walk at a time,
+thousands of walks are advanced in lockstep, one loop iteration at a time, with each walk's state held in numpy arrays:
+its tactic state, previous tactic state, discovery counter, privilege-escalation flag, current host, and its visited and
+available host sets as bitset rows, one bit per host. Tactic transitions are drawn for all walks at once by comparing one
+uniform draw per walk against the cumulative rows of the tactic transition matrix, and lateral moves pick a uniform
+available host per walk from its row of the available set, which is grown through a CSR table of host neighbors.
+
+The host graph is either the networkx testbed graph of RandomWalkGenerator, or a CSR adjacency such as the netflow
+topology from NetFlowModel.GetWalkTopology(); walks may start at a single host or at a uniformly chosen entry point.
+
+The simulator follows _generateWalk() exactly, so the resulting walks are distributed identically; the recorded steps
+are returned as a columnar WalkCorpus rather than a list of dicts per walk.
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+from walk_corpus import WalkCorpusWriter
+
+#host h of a bitset row is bit h&7 of byte h>>3; per byte value, its number of set bits and the position of each of its set bits
+_BIT = (1 << np.arange(8)).astype(np.uint8)
+_POPCOUNT = np.array([bin(b).count("1") for b in range(256)], dtype=np.uint8)
+_SELECT = np.array([[i for i in range(8) if b >> i & 1] + [0] * (8 - bin(b).count("1")) for b in range(256)], dtype=np.int64)
+
+class WalkCorpus(object):
+	def __init__(self, hosts, tacticIndex, techniques, walkIds, hostIds, tacticIds, techniqueIds, numWalks):
+		"""
+		A set of walks stored column-wise: step k of the corpus was taken by walk @walkIds[k] at host @hosts[@hostIds[k]], with
+		tactic @tacticIds[k] (per @tacticIndex) and technique @techniqueIds[k]. Steps are sorted by walk, and in walk order within each walk.
+
+		@techniques: A list, per tactic id, of the technique dicts (with "id", "name", and "x_mitre_data_sources") that
+					@techniqueIds index; None if techniques were not drawn, in which case @techniqueIds are all -1.
+		@numWalks: The number of walks, since a walk may have no steps
+		"""
+		self.Hosts = hosts
+		self.TacticIndex = tacticIndex
+		self.Techniques = techniques
+		self.WalkIds = walkIds
+		self.HostIds = hostIds
+		self.TacticIds = tacticIds
+		self.TechniqueIds = techniqueIds
+		self.NumWalks = numWalks
+
+	def GetWalkOffsets(self):
+		#Returns the array of numWalks+1 offsets, such that walk i's steps are [offsets[i], offsets[i+1])
+		return np.searchsorted(self.WalkIds, np.arange(self.NumWalks + 1))
+
+	def GetWalks(self):
+		"""
+		Generates each walk in the list-of-step-dicts format of RandomWalkGenerator._generateWalk(), for compatibility with
+		existing walk files.
+		"""
+		tactics = [tactic for tactic, i in sorted(self.TacticIndex.items(), key = lambda t: t[1])]
+		offsets = self.GetWalkOffsets()
+		for i in range(self.NumWalks):
+			walk = []
+			attack_path = set()
+			for k in range(offsets[i], offsets[i+1]):
+				host = self.Hosts[self.HostIds[k]]
+				attack_path.add(host)
+				tactic = tactics[self.TacticIds[k]]
+				tech = {"id" : "", "name" : "", "x_mitre_data_sources" : ""}
+				if self.Techniques is not None and self.TechniqueIds[k] >= 0:
+					tech = self.Techniques[self.TacticIds[k]][self.TechniqueIds[k]]
+				walk.append({
+					"host" : str(host),
+					"attack_path" : str(attack_path),
+					"tactic" : str(tactic),
+					"technique_id" : str(tech["id"]),
+					"technique_name" : str(tech["name"]),
+					"technique_data_source" : str(tech["x_mitre_data_sources"])
+				})
+			yield walk
+
+	def WriteWalkFile(self, outPath, mode="w+"):
+		#Writes the walks to @outPath in the one-walk-per-line format of RandomWalkGenerator.GenerateKWalks()
+		with open(outPath, mode) as ofile:
+			for walk in self.GetWalks():
+				ofile.write(str(walk)+"\n")
+
+class BatchWalkSimulator(object):
+	def __init__(self, graph, startHost, execNodes, transitionMatrix, tacticIndex, stepLimit=50, techniqueCache=None, batchSize=65536):
+		"""
+		@graph: The host graph walks move on; a networkx graph, or a (hosts, indptr, indices) CSR adjacency listing the
+				neighbors of hosts[i] as hosts[indices[indptr[i]:indptr[i+1]]], as from NetFlowModel.GetWalkTopology()
+		@startHost: The host every walk starts at, or a list of entry hosts, one of which is drawn uniformly per walk
+		@execNodes: Hosts on which execution succeeds, once any is on the attack path
+		@transitionMatrix: The 4 x 4 tactic transition matrix over D, PE, LM, E, per RandomWalkGenerator._getTacticTransitionMatrix()
+		@tacticIndex: Map of the four tactic names to their ids in the corpus
+		@stepLimit: Max loop iterations per walk
+		@techniqueCache: Optional TechniqueCache from which each step's technique is drawn
+		@batchSize: Max walks simulated in lockstep; the visited and available bitsets take about @batchSize * numHosts / 4 bytes
+		"""
+		if isinstance(graph, tuple):
+			hosts, indptr, indices = graph
+		else:
+			hosts, indptr, indices = self._getAdjacency(graph)
+		self._hosts = list(hosts)
+		self._indptr = np.asarray(indptr, dtype=np.int64)
+		self._indices = np.asarray(indices, dtype=np.int64)
+		hostIds = dict((host, i) for i, host in enumerate(self._hosts))
+		entryHosts = list(startHost) if isinstance(startHost, (list, tuple, set)) else [startHost]
+		if len(entryHosts) == 0:
+			print("ERROR no entry hosts passed to BatchWalkSimulator")
+			raise Exception("BatchWalkSimulator requires at least one start host")
+		self._starts = np.array([hostIds[host] for host in entryHosts], dtype=np.int64)
+		self._isExec = np.zeros(len(self._hosts), dtype=bool)
+		self._isExec[[hostIds[host] for host in execNodes if host in hostIds]] = True
+
+		#cumulative thresholds of the first three tactics; a draw beyond all of them falls through to E, as in _markov_analysis()
+		P = np.asarray(transitionMatrix, dtype=np.float64)
+		self._thresholds = np.cumsum(P[:,:3], axis=1)
+		self._tacticIndex = tacticIndex
+		#map from markov state (D, PE, LM, E) to tactic id
+		self._tacticOf = np.array([tacticIndex[t] for t in ["discovery", "privilege-escalation", "lateral-movement", "execution"]], dtype=np.int8)
+		self._stepLimit = stepLimit
+		self._batchSize = batchSize
+		self._techniques = None
+		if techniqueCache is not None:
+			tactics = [tactic for tactic, i in sorted(tacticIndex.items(), key = lambda t: t[1])]
+			self._techniques = [techniqueCache.GetTechniques(tactic) for tactic in tactics]
+			self._numTechniques = np.array([len(techs) for techs in self._techniques], dtype=np.int64)
+
+	def _getAdjacency(self, graph):
+		#Returns the CSR neighbor table (hosts, indptr, indices) of networkx graph @graph
+		hosts = list(graph.nodes())
+		hostIds = dict((host, i) for i, host in enumerate(hosts))
+		degrees = np.array([len(graph.adj[host]) for host in hosts], dtype=np.int64)
+		indptr = np.zeros(len(hosts) + 1, dtype=np.int64)
+		np.cumsum(degrees, out=indptr[1:])
+		indices = np.array([hostIds[v] for host in hosts for v in graph.adj[host]], dtype=np.int64)
+		return hosts, indptr, indices
+
+	def _setBits(self, bits, rows, cols):
+		#Sets bit @cols[k] of bitset row @rows[k] of @bits for all k; bits that land in the same byte are OR-ed together first
+		if len(rows) == 0:
+			return
+		keys = rows * bits.shape[1] + (cols >> 3)
+		order = np.argsort(keys, kind="stable")
+		keys, masks = keys[order], _BIT[cols[order] & 7]
+		first = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+		bits.reshape(-1)[keys[first]] |= np.bitwise_or.reduceat(masks, first)
+
+	def _expandBits(self, bits):
+		#Returns the (row, bit) pairs of all set bits of bitset rows @bits, in row order and ascending bit order within each row
+		rows, cols = np.nonzero(bits)
+		values = bits[rows, cols]
+		counts = _POPCOUNT[values].astype(np.int64)
+		ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+		return np.repeat(rows, counts), np.repeat(cols * 8, counts) + _SELECT[np.repeat(values, counts), ranks]
+
+	def _nextStates(self, rows, rng):
+		#Draws the next markov state for each walk from its row of the transition matrix
+		u = rng.random_sample(len(rows))
+		return np.sum(u[:,np.newaxis] >= self._thresholds[rows], axis=1).astype(np.int8)
+
+	def _gatherNeighbors(self, walks, hosts):
+		#Returns (walk, neighbor) pairs for every neighbor of each walk's host, via the CSR table
+		starts = self._indptr[hosts]
+		lengths = self._indptr[hosts + 1] - starts
+		offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+		return np.repeat(walks, lengths), self._indices[offsets + np.arange(lengths.sum())]
+
+	def _simulateBatch(self, numWalks, rng):
+		n = len(self._hosts)
+		state = np.zeros(numWalks, dtype=np.int8)
+		prvState = np.zeros(numWalks, dtype=np.int8)
+		disc = np.zeros(numWalks, dtype=np.int8)
+		privEsc = np.zeros(numWalks, dtype=bool)
+		alive = np.ones(numWalks, dtype=bool)
+		if len(self._starts) > 1:
+			curr = self._starts[rng.randint(len(self._starts), size=numWalks)]
+		else:
+			curr = np.full(numWalks, self._starts[0], dtype=np.int64)
+		hasExec = self._isExec[curr]
+		#visited and available host sets, as bitset rows padded to whole 64-bit words, and a summary bitset of each row's nonzero available words
+		numWords = (n + 63) // 64
+		visited = np.zeros((numWalks, numWords * 8), dtype=np.uint8)
+		visited[np.arange(numWalks), curr >> 3] = _BIT[curr & 7]
+		avail = np.zeros((numWalks, numWords * 8), dtype=np.uint8)
+		availWords = avail.view(np.uint64)
+		summary = np.zeros((numWalks, (numWords + 7) // 8), dtype=np.uint8)
+
+		walkCols, hostCols, tacticCols = [], [], []
+		for _ in range(self._stepLimit):
+			act = np.flatnonzero(alive)
+			if len(act) == 0:
+				break
+			s = state[act]
+			success = np.zeros(len(act), dtype=bool)
+
+			#discovery succeeds for the first two attempts on each host
+			isD = s == 0
+			d = act[isD]
+			disc[d] = np.minimum(disc[d] + 1, 3)
+			success[isD] = disc[d] < 3
+
+			#privilege escalation succeeds once per host
+			isPE = s == 1
+			success[isPE] = ~privEsc[act[isPE]]
+			privEsc[act[isPE]] = True
+
+			#lateral movement moves to a uniformly chosen unvisited neighbor of the attack path
+			isLM = np.flatnonzero(s == 2)
+			if len(isLM) > 0:
+				lm = act[isLM]
+				rows, cols = self._gatherNeighbors(lm, curr[lm])
+				#visited hosts are never added, and each is cleared when visited, so no row ever holds a visited host
+				unvisited = (visited[rows, cols >> 3] & _BIT[cols & 7]) == 0
+				rows, cols = rows[unvisited], cols[unvisited]
+				self._setBits(avail, rows, cols)
+				self._setBits(summary, rows, cols >> 6)
+				#only the nonzero words of each row, found through its summary, are popcounted, so a move costs O(numHosts / 512) plus the available set
+				rowWords, words = self._expandBits(summary[lm])
+				wordBytes = availWords[lm[rowWords], words].view(np.uint8).reshape(-1, 8)
+				byteCounts = _POPCOUNT[wordBytes]
+				wordCounts = byteCounts.sum(axis=1, dtype=np.int64)
+				counts = np.bincount(rowWords, weights=wordCounts, minlength=len(lm)).astype(np.int64)
+				moved = counts > 0
+				if moved.any():
+					#the pick-th available host of each row, in host order: find the word holding it, then the byte, then the bit
+					picks = np.floor(rng.random_sample(moved.sum()) * counts[moved]).astype(np.int64)
+					cumWords = np.cumsum(wordCounts)
+					targets = (np.cumsum(counts) - counts)[moved] + picks
+					w = np.searchsorted(cumWords, targets, side="right")
+					within = targets - cumWords[w] + wordCounts[w]
+					cumBytes = np.cumsum(byteCounts[w], axis=1, dtype=np.int64)
+					b = np.argmax(cumBytes > within[:,np.newaxis], axis=1)
+					k = np.arange(len(w))
+					rank = within - cumBytes[k, b] + byteCounts[w, b]
+					byte = words[w] * 8 + b
+					nextHost = byte * 8 + _SELECT[wordBytes[w, b], rank]
+					lm = lm[moved]
+					curr[lm] = nextHost
+					visited[lm, byte] |= _BIT[nextHost & 7]
+					avail[lm, byte] &= ~_BIT[nextHost & 7]
+					word = nextHost >> 6
+					emptied = availWords[lm, word] == 0
+					summary[lm[emptied], word[emptied] >> 3] &= ~_BIT[word[emptied] & 7]
+					privEsc[lm] = False
+					disc[lm] = 0
+					hasExec[lm] |= self._isExec[nextHost]
+					success[isLM[moved]] = True
+
+			#execution succeeds once any exec node is on the attack path, and ends the walk
+			isE = s == 3
+			success[isE] = hasExec[act[isE]]
+
+			done = act[success]
+			walkCols.append(done)
+			hostCols.append(curr[done])
+			tacticCols.append(self._tacticOf[s[success]])
+
+			#successful steps transition from the current state, failed ones resample from the last successful one
+			rows = np.where(success, s, prvState[act])
+			prvState[done] = s[success]
+			state[act] = self._nextStates(rows, rng)
+			alive[act[success & isE]] = False
+
+		walkIds = np.concatenate(walkCols)
+		order = np.argsort(walkIds, kind="stable")
+		return walkIds[order], np.concatenate(hostCols)[order].astype(np.int32), np.concatenate(tacticCols)[order]
+
+	def Simulate(self, numWalks, seed=None):
+		"""
+		Simulates @numWalks walks, in batches of at most batchSize walks.
+
+		@seed: Seed for the random number generator, for reproducible corpora; an int or a sequence of ints
+
+		Returns: A WalkCorpus of the walks.
+		"""
+		start = time.time()
+		rng = np.random.RandomState(seed)
+		walkCols, hostCols, tacticCols = [], [], []
+		for first in range(0, numWalks, self._batchSize):
+			walkIds, hostIds, tacticIds = self._simulateBatch(min(self._batchSize, numWalks - first), rng)
+			walkCols.append(walkIds + first)
+			hostCols.append(hostIds)
+			tacticCols.append(tacticIds)
+
+		walkIds = np.concatenate(walkCols) if numWalks > 0 else np.zeros(0, dtype=np.int64)
+		hostIds = np.concatenate(hostCols) if numWalks > 0 else np.zeros(0, dtype=np.int32)
+		tacticIds = np.concatenate(tacticCols) if numWalks > 0 else np.zeros(0, dtype=np.int8)
+		techniqueIds = np.full(len(walkIds), -1, dtype=np.int32)
+		if self._techniques is not None:
+			counts = self._numTechniques[tacticIds]
+			techniqueIds = np.where(counts > 0, np.floor(rng.random_sample(len(walkIds)) * counts), -1).astype(np.int32)
+
+		print("Simulated {} walks with {} steps in {:.3f}s".format(numWalks, len(walkIds), time.time() - start))
+		return WalkCorpus(self._hosts, dict(self._tacticIndex), self._techniques, walkIds, hostIds, tacticIds, techniqueIds, numWalks)
+
+	def SimulateParallel(self, numWalks, outPath, seed=0, shardSize=10000, numWorkers=None, mode="w+", keepShards=False, corpus=False):
+		"""
+		Simulates @numWalks walks split into shards of @shardSize walks over a process pool, each shard written to its own file
+		(@outPath + ".shard<i>"), then merges the shards in shard order into @outPath.
+
+		Shard i is simulated with the seed [@seed, i], giving each shard an independent stream that depends only on @seed and
+		the shard number, never on @numWorkers or scheduling, so the merged output is identical for any number of workers.
+
+		@numWorkers: Pool size; defaults to the number of cpus
+		@mode: File mode for @outPath, "w+" to overwrite or "a+" to append
+		@keepShards: Whether to keep the shard files after merging
+		@corpus: If true, @outPath and the shards are WalkCorpus directories (see walk_corpus.py) rather than walk files
+		"""
+		start = time.time()
+		shards = []
+		for i, first in enumerate(range(0, numWalks, shardSize)):
+			shards.append((self, min(shardSize, numWalks - first), [seed, i], "{}.shard{}".format(outPath, i), corpus))
+
+		pool = multiprocessing.Pool(numWorkers)
+		try:
+			shardPaths = pool.map(_simulateShard, shards)
+		finally:
+			pool.close()
+			pool.join()
+
+		if corpus:
+			writer = WalkCorpusWriter(outPath, append = mode == "a+")
+			for shardPath in shardPaths:
+				writer.WriteCorpusFile(shardPath)
+				if not keepShards:
+					shutil.rmtree(shardPath)
+			writer.Close()
+		else:
+			with open(outPath, mode) as ofile:
+				for shardPath in shardPaths:
+					with open(shardPath, "r") as ifile:
+						shutil.copyfileobj(ifile, ofile)
+					if not keepShards:
+						os.remove(shardPath)
+
+		print("Generated {} walks in {} shards to {} in {:.3f}s".format(numWalks, len(shards), outPath, time.time() - start))
+
+def _simulateShard(args):
+	#Process pool worker for BatchWalkSimulator.SimulateParallel(); module-level so that it can be pickled
+	simulator, numWalks, seed, shardPath, corpus = args
+	walks = simulator.Simulate(numWalks, seed=seed)
+	if corpus:
+		writer = WalkCorpusWriter(shardPath)
+		writer.WriteWalkCorpus(walks)
+		writer.Close()
+	else:
+		walks.WriteWalkFile(shardPath)
+	return shardPath
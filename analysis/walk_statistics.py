@@ -0,0 +1,278 @@
+"""
+Streaming statistics over walk corpora (see walk_corpus.py) and legacy walk files, computed in one pass with bounded memory.
+
+A WalkStatistics holds only counts whose size depends on the network and the ATT&CK tables, never on the number of walks:
+the walk length histogram, tactic and technique histograms, per-host step and visit counts, tactic-to-tactic and
+host-to-host transition counts, and a HyperLogLog sketch of the distinct attack paths (host sequences) walked. Walks are
+added a chunk at a time, column-wise, and two WalkStatistics over different walks merge exactly, so the walks of large or
+sharded corpora are split into ranges that are counted over a process pool and then merged; see ComputeWalkStatistics().
+"""
+
+from __future__ import print_function
+
+import ast
+import hashlib
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from walk_corpus import WalkCorpusReader
+
+#HyperLogLog registers are indexed by the top _HLL_PRECISION bits of a path hash; 2^14 registers give about 0.8% relative error
+_HLL_PRECISION = 14
+
+def _mix(z):
+	#The splitmix64 finalizer, applied elementwise to a uint64 array
+	with np.errstate(over="ignore"):
+		z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+		z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+		return z ^ (z >> np.uint64(31))
+
+def _hashNames(names):
+	#Returns a uint64 hash per name, stable across processes and corpora, unlike hash() or the corpora's own ids
+	return np.array([int(hashlib.md5(str(name).encode("utf-8")).hexdigest()[:16], 16) for name in names], dtype=np.uint64)
+
+def _bitLength(x):
+	#Returns the number of significant bits of each element of uint64 array @x, exactly, by binary search over shifts
+	x = x.copy()
+	n = np.zeros(len(x), dtype=np.int64)
+	for shift in [32, 16, 8, 4, 2, 1]:
+		high = x >= np.uint64(1 << shift)
+		n[high] += shift
+		x[high] >>= np.uint64(shift)
+	return n + (x > 0)
+
+class WalkStatistics(object):
+	def __init__(self):
+		self.NumWalks = 0
+		self.NumSteps = 0
+		self._lengths = np.zeros(0, dtype=np.int64)
+		self._tactics = dict()
+		self._techniques = dict()
+		self._hostSteps = dict()
+		self._hostVisits = dict()
+		self._tacticTransitions = dict()
+		self._hostTransitions = dict()
+		self._registers = np.zeros(1 << _HLL_PRECISION, dtype=np.uint8)
+
+	def _add(self, counts, keys, values):
+		#Folds @values, counts per key of @keys, into the dict @counts, skipping zeros
+		for key, value in zip(keys, values.tolist()):
+			if value > 0:
+				counts[key] = counts.get(key, 0) + value
+
+	def _addPairs(self, counts, names, src, dst):
+		#Folds the counts of (@src, @dst) id pairs, as pairs of @names, into the dict @counts
+		if len(src) == 0:
+			return
+		keys, pairCounts = np.unique(src * len(names) + dst, return_counts=True)
+		self._add(counts, [(names[key // len(names)], names[key % len(names)]) for key in keys.tolist()], pairCounts)
+
+	def _addSteps(self, hosts, tactics, techniques, hostIds, tacticIds, techniqueIds, offsets):
+		"""
+		Counts walks in columnar form: step k is at host @hosts[@hostIds[k]] with tactic @tactics[@tacticIds[k]] and technique
+		@techniques[@techniqueIds[k]] (a name; -1 if none), and walk i is steps [@offsets[i], @offsets[i+1]). The tables may be
+		any chunk's own; all counts are folded in by name.
+		"""
+		hostIds = np.asarray(hostIds, dtype=np.int64)
+		tacticIds = np.asarray(tacticIds, dtype=np.int64)
+		techniqueIds = np.asarray(techniqueIds, dtype=np.int64)
+		offsets = np.asarray(offsets, dtype=np.int64)
+		lengths = np.diff(offsets)
+		numSteps = len(hostIds)
+		self.NumWalks += len(lengths)
+		self.NumSteps += numSteps
+
+		lengthCounts = np.bincount(lengths)
+		if len(lengthCounts) > len(self._lengths):
+			self._lengths = np.concatenate((self._lengths, np.zeros(len(lengthCounts) - len(self._lengths), dtype=np.int64)))
+		self._lengths[:len(lengthCounts)] += lengthCounts
+		if numSteps == 0:
+			return
+
+		self._add(self._tactics, tactics, np.bincount(tacticIds, minlength=len(tactics)))
+		hasTechnique = techniqueIds >= 0
+		self._add(self._techniques, techniques, np.bincount(techniqueIds[hasTechnique], minlength=len(techniques)))
+		self._add(self._hostSteps, hosts, np.bincount(hostIds, minlength=len(hosts)))
+
+		#a step continues its walk unless it is the walk's first; a walk arrives at a host on its first step and on every move
+		walkIds = np.repeat(np.arange(len(lengths)), lengths)
+		hasPrev = np.ones(numSteps, dtype=bool)
+		hasPrev[offsets[:-1][lengths > 0]] = False
+		prev = np.roll(np.arange(numSteps), 1)
+		moved = hasPrev & (hostIds != hostIds[prev])
+		arrival = ~hasPrev | moved
+		self._add(self._hostVisits, hosts, np.bincount(hostIds[arrival], minlength=len(hosts)))
+		self._addPairs(self._tacticTransitions, tactics, tacticIds[prev][hasPrev], tacticIds[hasPrev])
+		self._addPairs(self._hostTransitions, hosts, hostIds[prev][moved], hostIds[moved])
+
+		#each walk's attack path, its sequence of hosts, hashes to the mix of the sum of its position-dependent host hashes
+		pathWalks = walkIds[arrival]
+		positions = np.arange(len(pathWalks)) - np.searchsorted(pathWalks, pathWalks)
+		with np.errstate(over="ignore"):
+			terms = _mix(_hashNames(hosts)[hostIds[arrival]] + positions.astype(np.uint64) * np.uint64(0x9e3779b97f4a7c15))
+		starts = np.flatnonzero(np.concatenate(([True], pathWalks[1:] != pathWalks[:-1])))
+		self._addPathHashes(_mix(np.add.reduceat(terms, starts)))
+
+	def _addPathHashes(self, hashes):
+		#Adds path hashes to the HyperLogLog sketch: the top bits pick a register, which keeps the max rank of the remaining bits
+		registers = (hashes >> np.uint64(64 - _HLL_PRECISION)).astype(np.int64)
+		rest = hashes & np.uint64((1 << (64 - _HLL_PRECISION)) - 1)
+		ranks = (64 - _HLL_PRECISION) - _bitLength(rest) + 1
+		np.maximum.at(self._registers, registers, ranks.astype(np.uint8))
+
+	def AddCorpusReader(self, reader, firstWalk=0, lastWalk=None, chunkWalks=100000):
+		"""
+		Counts walks [@firstWalk, @lastWalk) of the corpus opened by @reader, a WalkCorpusReader, @chunkWalks walks at a time,
+		so only one chunk of its memory-mapped step arrays is ever in memory.
+		"""
+		if lastWalk is None:
+			lastWalk = reader.NumWalks
+		techniques = [name for techId, name, techStr in reader.Techniques]
+		for first in range(firstWalk, lastWalk, chunkWalks):
+			last = min(first + chunkWalks, lastWalk)
+			offsets = np.asarray(reader.Offsets[first:last+1], dtype=np.int64)
+			steps = slice(offsets[0], offsets[-1])
+			self._addSteps(reader.Hosts, reader.Tactics, techniques, reader.HostIds[steps], reader.TacticIds[steps],
+							reader.TechniqueIds[steps], offsets - offsets[0])
+
+	def AddWalkFile(self, walkPath, chunkWalks=10000):
+		"""
+		Counts the walks of a legacy walk file, one python-literal walk per line as written by RandomWalkGenerator.GenerateKWalks().
+		Lines are parsed with ast.literal_eval and counted @chunkWalks walks at a time, so the file is never held in memory.
+		"""
+		with open(walkPath, "r") as ifile:
+			chunk = []
+			for line in ifile:
+				if len(line.strip()) > 0:
+					try:
+						chunk.append(ast.literal_eval(line.strip()))
+					except (ValueError, SyntaxError):
+						print("WARNING could not parse walk in AddWalkFile: "+line)
+				if len(chunk) >= chunkWalks:
+					self.AddWalks(chunk)
+					chunk = []
+			self.AddWalks(chunk)
+
+	def AddWalks(self, walks):
+		#Counts @walks, a list of walks in the list-of-step-dicts format of RandomWalkGenerator._generateWalk()
+		tables = [[], [], []]
+		ids = [dict(), dict(), dict()]
+		columns = [[], [], []]
+		for walk in walks:
+			for step in walk:
+				for table, index, column, key in zip(tables, ids, columns, [step["host"], step["tactic"], step["technique_name"]]):
+					if key not in index:
+						index[key] = len(table)
+						table.append(key)
+					column.append(index[key])
+		#steps without a technique have an empty name
+		techniqueIds = [-1 if tables[2][i] == "" else i for i in columns[2]]
+		offsets = np.concatenate(([0], np.cumsum([len(walk) for walk in walks]))).astype(np.int64)
+		self._addSteps(tables[0], tables[1], tables[2], columns[0], columns[1], techniqueIds, offsets)
+
+	def Merge(self, other):
+		#Adds all counts of @other, a WalkStatistics over other walks
+		self.NumWalks += other.NumWalks
+		self.NumSteps += other.NumSteps
+		if len(other._lengths) > len(self._lengths):
+			self._lengths = np.concatenate((self._lengths, np.zeros(len(other._lengths) - len(self._lengths), dtype=np.int64)))
+		self._lengths[:len(other._lengths)] += other._lengths
+		for mine, theirs in [(self._tactics, other._tactics), (self._techniques, other._techniques), (self._hostSteps, other._hostSteps),
+							(self._hostVisits, other._hostVisits), (self._tacticTransitions, other._tacticTransitions),
+							(self._hostTransitions, other._hostTransitions)]:
+			for key, count in theirs.items():
+				mine[key] = mine.get(key, 0) + count
+		np.maximum(self._registers, other._registers, out=self._registers)
+
+	def GetDistinctPathCount(self):
+		#Returns the HyperLogLog estimate of the number of distinct attack paths, with linear counting for small counts
+		m = float(len(self._registers))
+		estimate = 0.7213 / (1.0 + 1.079 / m) * m * m / np.sum(np.power(2.0, -self._registers.astype(np.float64)))
+		zeros = np.count_nonzero(self._registers == 0)
+		if estimate <= 2.5 * m and zeros > 0:
+			estimate = m * np.log(m / zeros)
+		return int(round(estimate))
+
+	def GetLengthPercentile(self, q):
+		#Returns the @q-th percentile (0-100) of walk lengths
+		if self.NumWalks == 0:
+			return 0
+		return int(np.searchsorted(np.cumsum(self._lengths), max(q / 100.0 * self.NumWalks, 1)))
+
+	def Summary(self):
+		"""
+		Returns all statistics as a dict: "walks", "steps", "meanLength", "lengthHistogram" (a list, count per length),
+		"tactics", "techniques", "hostSteps", "hostVisits" (walks that reached each host), "tacticTransitions" and
+		"hostTransitions" (keyed by (from, to) pairs), and "distinctPaths" (estimated).
+		"""
+		return {
+				"walks" : self.NumWalks,
+				"steps" : self.NumSteps,
+				"meanLength" : float(self.NumSteps) / float(max(self.NumWalks, 1)),
+				"lengthHistogram" : self._lengths.tolist(),
+				"tactics" : dict(self._tactics),
+				"techniques" : dict(self._techniques),
+				"hostSteps" : dict(self._hostSteps),
+				"hostVisits" : dict(self._hostVisits),
+				"tacticTransitions" : dict(self._tacticTransitions),
+				"hostTransitions" : dict(self._hostTransitions),
+				"distinctPaths" : self.GetDistinctPathCount()
+			}
+
+	def Print(self, top=10):
+		#Prints a report of the statistics, listing the @top most frequent techniques, hosts, and host transitions
+		byCount = lambda counts: sorted(counts.items(), key = lambda t: (-t[1], t[0]))[:top]
+		print("Walks: {}  Steps: {}  average walk length: {:.3f}".format(self.NumWalks, self.NumSteps, float(self.NumSteps) / float(max(self.NumWalks, 1))))
+		print("Walk length min/median/p90/max: {}/{}/{}/{}".format(self.GetLengthPercentile(0), self.GetLengthPercentile(50),
+			self.GetLengthPercentile(90), len(self._lengths) - 1))
+		print("Length histogram: {}".format(dict((length, int(count)) for length, count in enumerate(self._lengths) if count > 0)))
+		print("Tactic histogram: {}".format(self._tactics))
+		print("Total techniques: {} ({} distinct)".format(sum(self._techniques.values()), len(self._techniques)))
+		print("Top techniques: {}".format(byCount(self._techniques)))
+		print("Top hosts by visits (walks reaching host, steps on host):")
+		for host, visits in byCount(self._hostVisits):
+			print("  {}: {}, {}".format(host, visits, self._hostSteps.get(host, 0)))
+		print("Tactic transitions: {}".format(byCount(self._tacticTransitions)))
+		print("Top host transitions: {}".format(byCount(self._hostTransitions)))
+		print("Distinct attack paths: ~{}".format(self.GetDistinctPathCount()))
+
+def _computeRange(args):
+	#Process pool worker for ComputeWalkStatistics(); module-level so that it can be pickled
+	walkPath, firstWalk, lastWalk = args
+	stats = WalkStatistics()
+	if os.path.isdir(walkPath):
+		stats.AddCorpusReader(WalkCorpusReader(walkPath), firstWalk, lastWalk)
+	else:
+		stats.AddWalkFile(walkPath)
+	return stats
+
+def ComputeWalkStatistics(walkPaths, numWorkers=None, rangeWalks=1000000):
+	"""
+	Computes the WalkStatistics of all walks in @walkPaths, a list of walk corpus directories (e.g. the shards written by
+	BatchWalkSimulator.SimulateParallel(keepShards=True)) and/or legacy walk files. Each corpus is split into ranges of
+	@rangeWalks walks, and the ranges and walk files are counted over a process pool of @numWorkers (default: the number of cpus).
+	"""
+	start = time.time()
+	ranges = []
+	for walkPath in walkPaths:
+		if os.path.isdir(walkPath):
+			numWalks = WalkCorpusReader(walkPath).NumWalks
+			ranges += [(walkPath, first, min(first + rangeWalks, numWalks)) for first in range(0, numWalks, rangeWalks)]
+		else:
+			ranges.append((walkPath, None, None))
+
+	pool = multiprocessing.Pool(numWorkers)
+	try:
+		results = pool.map(_computeRange, ranges)
+	finally:
+		pool.close()
+		pool.join()
+
+	stats = WalkStatistics()
+	for result in results:
+		stats.Merge(result)
+	print("Computed statistics of {} walks in {} ranges of {} in {:.3f}s".format(stats.NumWalks, len(ranges), walkPaths, time.time() - start))
+	return stats